@@ -148,7 +148,7 @@ args = {
 	 			'src/lsd-import-dvo', 'src/lsd-import-smf',
 	 			'src/lsd-query', 'src/lsd-xmatch', 'src/mr-peer',
 	 			'src/lsd-manager', 'src/lsd-admin', 'src/lsd-import',
-	 			'src/lsd-check'],
+	 			'src/lsd-check', 'src/lsd-query-server'],
 	'packages'	: ['lsd', 'lsd.builtins', 'lsd.importers', 'surveys', 'surveys.ps1', 'mr', 'lsd.config'],
 	'package_dir'	: {'': 'src'},
 	'ext_modules'	: [Extension('lsd.native', ['src/native/main.cpp'], include_dirs=inc)],
@@ -227,3 +227,27 @@ def make_canonical(bounds):
 	bounds = [ __part_to_xy_t(part) for part in parts]
 
 	return bounds
+
+def T(*args):
+	""" User friendly specification of time:
+		T([a,b], [b, c], [d, e]) --> intervalset([a,b], [b, c], [d, e])
+		T([a], [b]) --> intervalset([a], [b])
+		T(a) or T([a])--> intervalset([a])
+
+		but, the often used case of:
+
+		T(a, b) --> intervalset[a, b]
+	"""
+	hastuple = sum([ isinstance(a, tuple) or isinstance(a, list) for a in args ]) != 0
+
+	if len(args) != 2 or hastuple:
+		return intervalset(*args)
+	else:
+		return intervalset(tuple(args))
+
+def parse_bounds(s):
+	""" Parse a command-line style bounds specification
+	    (e.g., "beam(10, 20, 0.1), T(55000, 55100)") into a list
+	    suitable to be passed to make_canonical().
+	"""
+	return eval('[' + s + ']', dict(rectangle=rectangle, beam=beam, T=T, intervalset=intervalset))
@@ -9,6 +9,7 @@ import getpass
 import hashlib
 import os.path
 import errno
+import threading
 from contextlib  import contextmanager
 from collections import OrderedDict
 
@@ -18,7 +19,8 @@ class CallResultCache(object):
 	"""
 		A persistent function result cache
 
-		Note: !! Not thread safe !!
+		Note: Thread safe, but only by serializing all calls to
+		      cached functions.
 	"""
 	cache_dir = None	# On-disk cache directory
 	max_memcache = None	# Maximum (pickled) memsize of memory-cached objects (in bytes)
@@ -39,6 +41,7 @@ class CallResultCache(object):
 		
 		self.__cache = OrderedDict()
 		self.__memcachesize = 0
+		self.__lock = threading.RLock()
 
 	@contextmanager
 	def lock(self, fp):
@@ -53,6 +56,10 @@ class CallResultCache(object):
 
 		@functools.wraps(func)
 		def wrapper(*args, **kwds):
+			with self.__lock:
+				return cached_call(*args, **kwds)
+
+		def cached_call(*args, **kwds):
 			# Construct the hash of the arguments, using the buffer protocol where
 			# possible
 			if True:
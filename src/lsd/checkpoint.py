@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Checkpointing of long-running MapReduce jobs.
+
+A Checkpoint records the outputs of completed units of work (cells)
+in a directory specific to a job, identified by a fingerprint of the
+job's parameters. Re-running a job with the same fingerprint skips
+the units that have already completed. See Query.execute() for how
+queries use it.
+"""
+
+import os
+import cPickle
+import cStringIO
+import hashlib
+import logging
+import marshal
+import socket
+import types
+
+import utils
+
+logger = logging.getLogger('lsd.checkpoint')
+
+def _named_object_id(obj):
+	# Identify functions and classes by their module and name (and
+	# functions also by their code), so that lambdas and nested
+	# functions, which can't be pickled, can still be fingerprinted.
+	# Everything else is pickled as usual.
+	if isinstance(obj, (types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.ClassType, type)):
+		id = '%s.%s' % (getattr(obj, '__module__', None), getattr(obj, '__name__', None))
+		if isinstance(obj, types.FunctionType):
+			id += ':' + hashlib.md5(marshal.dumps(obj.func_code)).hexdigest()
+		return id
+	return None
+
+def fingerprint(*objs):
+	""" Return a hex digest uniquely identifying the objects.
+
+	    Functions and classes are identified by their module and
+	    name. Raises an Exception if any other object cannot be
+	    pickled, as there's no stable way to identify it.
+	"""
+	m = hashlib.md5()
+	for obj in objs:
+		buf = cStringIO.StringIO()
+		p = cPickle.Pickler(buf, -1)
+		p.persistent_id = _named_object_id
+		try:
+			p.dump(obj)
+		except (cPickle.PicklingError, TypeError) as e:
+			raise Exception("Cannot fingerprint %s for checkpointing (%s)" % (type(obj).__name__, e))
+		m.update(buf.getvalue())
+	return m.hexdigest()
+
+def callable_fingerprint(kernel):
+	""" Return a picklable description of a kernel, stable
+	    across processes (the name of the callable + its args).
+	"""
+	fun, args = utils.unpack_callable(kernel)
+	name = getattr(fun, '__name__', type(fun).__name__)
+	return (getattr(fun, '__module__', None), name, args)
+
+class Checkpoint(object):
+	""" A directory of completed units of work.
+
+	    The record of each unit is stored in a separate file,
+	    <path>/<fingerprint>/<kind>/<key>.pkl, written atomically
+	    so that a job that is interrupted at any point leaves
+	    behind only complete records.
+	"""
+	path = None	# Directory holding the records of this job
+
+	def __init__(self, path, fingerprint):
+		self.path = os.path.join(path, fingerprint)
+		utils.mkdir_p(self.path)
+
+	def _fn(self, kind, key):
+		return os.path.join(self.path, kind, '%s.pkl' % (key,))
+
+	def has(self, kind, key):
+		return os.path.exists(self._fn(kind, key))
+
+	def load(self, kind, key):
+		""" Return the record of a completed unit, or None """
+		try:
+			with open(self._fn(kind, key), 'rb') as fp:
+				return cPickle.load(fp)
+		except IOError:
+			return None
+
+	def save(self, kind, key, record):
+		fn = self._fn(kind, key)
+		utils.mkdir_p(os.path.dirname(fn))
+
+		tmp = '%s.%s.%d.tmp' % (fn, socket.gethostname(), os.getpid())
+		with open(tmp, 'wb') as fp:
+			cPickle.dump(record, fp, -1)
+		os.rename(tmp, fn)
+
+def run_with_retries(retries, fun, item, args):
+	""" Run a kernel on an item, returning a list of its outputs.
+
+	    If the kernel raises, it is re-run up to <retries> times
+	    before the exception is propagated. The outputs are
+	    buffered, so that a failed attempt leaves no trace.
+	"""
+	for attempt in xrange(retries + 1):
+		try:
+			return list(fun(item, *args))
+		except KeyboardInterrupt:
+			raise
+		except Exception as e:
+			if attempt == retries:
+				raise
+			logger.warning("Attempt %d/%d failed (%s: %s), retrying." % (attempt + 1, retries + 1, type(e).__name__, e))
@@ -6,7 +6,7 @@ Contains (among others) DB, Query, QueryEngine and QueryInstance classes, as
 well as the JOIN machinery.
 
 """
-import os, json, glob, copy, sys
+import os, json, glob, copy, sys, shutil
 import numpy as np
 import cPickle
 import pyfits
@@ -24,13 +24,16 @@ import pool2
 import mr
 import native
 import colgroup
+import checkpoint
 
 from interval    import intervalset
 from colgroup    import ColGroup
-from table       import Table
+from table       import Table, SPARSE_ROWKEY
 
 import caching
 
+logger = logging.getLogger('lsd.join_ops')
+
 @caching.cached
 def cached_proj_bhealpix(lon, lat):
 	return bhpix.proj_bhealpix(lon, lat)
@@ -43,6 +46,45 @@ def set_NULL(col, mask=np.s_[:]):
 	""" Set the NULL marker apropriate for the datatype """
 	col[mask] = 0
 
+class SparseRows:
+	""" The rows of a sparse cgroup tablet, aligned to the rows
+	    of the primary cgroup.
+
+	    Rather than expanding the whole tablet to the length of the
+	    primary cgroup, the columns are gathered (by the row map)
+	    one by one, as they're requested. The rows that are not
+	    present in the tablet are set to NULL.
+	"""
+	def __init__(self, rows, keys):
+		self.rows = rows	# The rows stored in the tablet
+		self.keys = keys	# The primary keys of the primary cgroup's rows
+		self._at = None
+		self._cols = {}
+
+	def _positions(self):
+		# Compute where the stored rows go in the primary cgroup
+		if self._at is None:
+			ii = self.keys.argsort()
+			rowkey = self.rows[SPARSE_ROWKEY]
+			at = np.searchsorted(self.keys, rowkey, sorter=ii)
+			at[at == len(ii)] = 0
+			found = self.keys[ii[at]] == rowkey if len(ii) else np.zeros(len(rowkey), dtype=bool)
+			self._at = ii[at[found]], found
+		return self._at
+
+	def __len__(self):
+		return len(self.keys)
+
+	def __getitem__(self, name):
+		if name not in self._cols:
+			at, found = self._positions()
+			col = self.rows[name]
+			out = np.zeros((len(self.keys),) + col.shape[1:], dtype=col.dtype)
+			set_NULL(out)
+			out[at] = col[found]
+			self._cols[name] = out
+		return self._cols[name]
+
 class TabletCache:
 	""" An cache of tablets loaded while performing a Query.
 
@@ -87,8 +129,11 @@ class TabletCache:
 
 			# Ensure it's as long as the primary table (this allows us to support "sparse" tablets)
 			if autoexpand and cgroup != table.primary_cgroup:
-				nrows = len(self.load_column(cell_id, table.primary_key.name, table))
-				rows.resize(nrows)
+				keys = self.load_column(cell_id, table.primary_key.name, table)
+				if table.is_sparse_cgroup(cgroup):
+					rows = SparseRows(rows, keys)
+				else:
+					rows.resize(len(keys))
 
 			tcache[cgroup] = rows
 		else:
@@ -1036,15 +1081,35 @@ class IntoWriter(object):
 		# Write the rows into the table, and modify them
 		# to keep only the _ID column. Return the result.
 		assert isinstance(rows, ColGroup)
-		self.rows = rows
 
 		# The table may have been created on previous pass
 		if self.table is None:
+			self.rows   = rows
 			self.table  = self.create_into_table()
 
-		rows = self.eval_into(cell_id, rows)
+		# Evaluate on a (shallow) copy, so that threads sharing this
+		# instance can write concurrently
+		w = copy.copy(self)
+		w.rows = rows
+		rows = w.eval_into(cell_id, rows)
 		return (cell_id, rows)
 
+	def _cell_in_snapshot(self, cell_id):
+		# True if the destination table has tablets of cell_id
+		# in the snapshot of the open transaction
+		into_table = self.into_clause[0]
+		if not self.db.table_exists(into_table):
+			return False
+		return os.path.isdir(self.db.table(into_table)._cell_path(cell_id, 'w'))
+
+	def _drop_cell(self, cell_id):
+		# Remove the tablets of cell_id written in the open
+		# transaction (the cell reverts to its older snapshot)
+		path = self.db.table(self.into_clause[0])._cell_path(cell_id, 'w')
+		if os.path.isdir(path):
+			logger.info("Dropping partially written cell %s (%s)" % (cell_id, path))
+			shutil.rmtree(path)
+
 	def _find_into_dest_rows(self, cell_id, table, into_col, vals):
 		""" Return the keys of rows in table whose 'into_col' value
 		    matches vals. Return zero for vals that have no match.
@@ -1270,16 +1335,18 @@ class QueryEngine(object):
 		return QueryInstance(self, cell_id, bounds, include_cached)
 
 	def on_cells(self, partspecs, include_cached=False):
-		# Set up the args for __iter__
-		self._partspecs = partspecs
-		self._include_cached = include_cached
+		# Return a (shallow) copy set up with the args for __iter__,
+		# so that threads sharing this instance don't step on each other
+		qe = copy.copy(self)
+		qe._partspecs = partspecs
+		qe._include_cached = include_cached
 
 		# Set the static cell
 		if partspecs:
 			cell_id = partspecs[0][0]
-			self.static_cell = self.pix.static_cell_for_cell(cell_id)
+			qe.static_cell = self.pix.static_cell_for_cell(cell_id)
 
-		return self
+		return qe
 
 	def __iter__(self):
 		# Generate a single stream of row blocks for a list of cells+bounds
@@ -1319,7 +1386,7 @@ class Query(object):
 		if into_clause:
 			self.qwriter = IntoWriter(db, into_clause, locals)
 
-	def execute(self, kernels, bounds=None, include_cached=False, cells=[], group_by_static_cell=False, testbounds=True, nworkers=None, progress_callback=None, _yield_empty=False):
+	def execute(self, kernels, bounds=None, include_cached=False, cells=[], group_by_static_cell=False, testbounds=True, nworkers=None, nthreads=None, progress_callback=None, checkpoint_dir=None, retries=0, pool=None, _yield_empty=False):
 		"""
 		Map/Reduce a list of functions over query results
 		
@@ -1424,6 +1491,11 @@ class Query(object):
 		    interruption). For more, see the discussion in
 		    "Important notes"
 
+		pool : pool2.Pool
+		    The pool of workers to run the job on (e.g., to reuse
+		    one across queries). If None, a new pool of nworkers
+		    processes is started, and shut down once done.
+
 		Important notes
 		---------------
 		    - Each execution of a mapper is guaranteed to operate on
@@ -1494,22 +1566,39 @@ class Query(object):
 		else:
 			partspecs = dict([ (cell_id, [(cell_id, bounds)]) for (cell_id, bounds) in partspecs.iteritems() ])
 
+		# Set up the checkpoint, if requested
+		if checkpoint_dir is not None:
+			ckpt = checkpoint.Checkpoint(checkpoint_dir, self._fingerprint(kernels, partspecs, include_cached))
+			logger.info("Checkpointing to %s" % ckpt.path)
+		else:
+			ckpt = None
+
 		# Insert our feeder mapper into the kernel chain
+		into = self.qwriter is not None and len(kernels) == 1
 		kernels = list(kernels)
 		kernels[0] = (_mapper, kernels[0], self.qengine, include_cached)
+		if ckpt is not None or retries:
+			kernels[0] = (_checkpointed_mapper, ckpt, retries, into) + kernels[0]
 
 		# Append a writer mapper if the query has an INTO clause
 		if self.qwriter:
-			kernels.append((_into_writer, self.qwriter))
+			if ckpt is not None:
+				kernels.append((_checkpointed_into_writer, ckpt, self.qwriter))
+			else:
+				kernels.append((_into_writer, self.qwriter))
 
 		# start and run the workers
 		peer_directory = os.getenv("PYMR", None)
+		partspecs = partspecs.items()
 		if peer_directory is None:
-			pool = pool2.Pool(nworkers)
+			if pool is None:
+				pool = pool2.Pool(nworkers, nthreads)
+			results = pool.map_reduce_chain(partspecs, kernels, progress_callback=progress_callback)
 		else:
 			pool = mr.Pool(peer_directory)
+			results = pool.map_reduce_chain(partspecs, kernels, progress_callback=progress_callback, locality=self._cell_paths(partspecs))
 		yielded = False
-		for result in pool.map_reduce_chain(partspecs.items(), kernels, progress_callback=progress_callback):
+		for result in results:
 			yield result
 			yielded = True
 
@@ -1524,7 +1613,38 @@ class Query(object):
 		# Shut down the workers
 		del pool
 
-	def iterate(self, bounds=None, include_cached=False, cells=[], return_blocks=False, filter=None, testbounds=True, nworkers=None, progress_callback=None, _yield_empty=False):
+	def _cell_paths(self, partspecs):
+		# Return the list of directories holding the tablets
+		# each item of partspecs will read, for the peers to
+		# place the work close to the data
+		locality = []
+		for _, parts in partspecs:
+			paths = set()
+			for cell_id, _ in parts:
+				for e in self.qengine.tables.itervalues():
+					if e.table.cell_exists(cell_id):
+						paths.add(e.table._cell_path(cell_id))
+			locality.append(sorted(paths))
+		return locality
+
+	def _fingerprint(self, kernels, partspecs, include_cached):
+		# Fingerprint identifying a job, for checkpointing. Includes
+		# the snapshots the tables are read from (or written to)
+		snapshots = []
+		for name, e in sorted(self.qengine.tables.iteritems()):
+			t = e.table
+			snapshots.append((name, t.snapid if t.transaction else t._snapshots[:1]))
+		if self.db.in_transaction():
+			snapshots.append(('', self.db.snapid))
+
+		return checkpoint.fingerprint(
+			self.query_string,
+			[ checkpoint.callable_fingerprint(k) for k in kernels ],
+			sorted(partspecs.iteritems()),
+			include_cached,
+			snapshots)
+
+	def iterate(self, bounds=None, include_cached=False, cells=[], return_blocks=False, filter=None, testbounds=True, nworkers=None, nthreads=None, progress_callback=None, checkpoint_dir=None, retries=0, pool=None, _yield_empty=False):
 		"""
 		Yield query results row-by-row or in blocks
 
@@ -1566,15 +1686,15 @@ class Query(object):
 
 		for (cell_id, rows) in self.execute(
 				[mapper], bounds, include_cached,
-				cells=cells, testbounds=testbounds, nworkers=nworkers, progress_callback=progress_callback,
-				_yield_empty=_yield_empty):
+				cells=cells, testbounds=testbounds, nworkers=nworkers, nthreads=nthreads, progress_callback=progress_callback,
+				checkpoint_dir=checkpoint_dir, retries=retries, pool=pool, _yield_empty=_yield_empty):
 			if return_blocks:
 				yield rows
 			else:
 				for row in rows:
 					yield row
 
-	def fetch(self, bounds=None, include_cached=False, cells=[], filter=None, testbounds=True, nworkers=None, progress_callback=None):
+	def fetch(self, bounds=None, include_cached=False, cells=[], filter=None, testbounds=True, nworkers=None, nthreads=None, progress_callback=None, checkpoint_dir=None, retries=0):
 		"""
 		Returns a table (a ColGroup instance) with query results.
 
@@ -1591,7 +1711,8 @@ class Query(object):
 				self.iterate(
 					bounds, include_cached, cells=cells,
 					return_blocks=True, filter=filter, _yield_empty=True,
-					nworkers=nworkers, progress_callback=progress_callback
+					nworkers=nworkers, nthreads=nthreads, progress_callback=progress_callback,
+					checkpoint_dir=checkpoint_dir, retries=retries
 					),
 				blocks=True
 			)
@@ -1923,6 +2044,10 @@ class DB(object):
 		# Add filters
 		table.set_default_filters(**tabdef.get('filters', {}))
 
+		# Tablet storage backend
+		if 'storage' in tabdef:
+			table.set_default_storage(tabdef['storage'])
+
 		# Commit hooks
 		table.define_commit_hooks(tabdef.get('commit_hooks', table._default_commit_hooks)) # Default commit hook rebuilds the neighbor cache
 
@@ -2352,6 +2477,54 @@ def _mapper(partspec, mapper, qengine, include_cached):
 	for result in mapper(qresult, *mapper_args):
 		yield result
 
+def _checkpointed_mapper(partspec, ckpt, retries, into, mapper, *mapper_args):
+	# Run the mapper on a cell (retrying on failure), recording its
+	# outputs in the checkpoint. For INTO queries, only the keys are
+	# recorded: the cell is skipped if all of them have been written.
+	cell_id = partspec[0]
+
+	if ckpt is not None:
+		record = ckpt.load('map', cell_id)
+		if record is not None:
+			if not into:
+				for result in record:
+					yield result
+				return
+			elif all(ckpt.has('into', key) for key in record):
+				return
+
+	results = checkpoint.run_with_retries(retries, mapper, partspec, mapper_args)
+
+	if ckpt is not None:
+		ckpt.save('map', cell_id, set(key for (key, _) in results) if into else results)
+
+	for result in results:
+		yield result
+
+def _checkpointed_into_writer(kw, ckpt, qwriter):
+	# Write a cell, unless the checkpoint says it has been written.
+	# Appending is not idempotent: the cell is recorded as started
+	# before writing, and if a previous run was interrupted while
+	# writing it, the rows it left behind are dropped first.
+	cell_id, _ = kw
+
+	results = ckpt.load('into', cell_id)
+	if results is None:
+		if qwriter.into_clause[4] == 'append':
+			existed = ckpt.load('into-started', cell_id)
+			if existed is None:
+				ckpt.save('into-started', cell_id, qwriter._cell_in_snapshot(cell_id))
+			elif existed:
+				raise Exception("Cannot resume writing cell %s: it had been written to in this transaction before the interrupted run. Use a keyed INTO, or roll back the transaction." % (cell_id,))
+			else:
+				qwriter._drop_cell(cell_id)
+
+		results = list(_into_writer(kw, qwriter))
+		ckpt.save('into', cell_id, results)
+
+	for result in results:
+		yield result
+
 def _iterate_mapper(qresult):
 	for rows in qresult:
 		if len(rows):	# Don't return empty sets. TODO: Do we need this???
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Columnar tablet storage, with columns memory-mapped on reading.
+
+A tablet of a cgroup with 'storage': 'npy' is a directory (in place of
+an HDF5 file), with a subdirectory for each row group ('main', and the
+neighbor cache, 'cached'). Every column of the cgroup is stored as a
+separate .npy file in the row group directory, with a fixed-size
+header that leaves enough room to rewrite the number of rows in place
+as the column grows. The primary key sequence, if any, is stored in
+_seq_<primary_key>.npy. The tombstone bitmap and base snapshot of a
+delta tablet (see Table._open_tablet) are kept in the 'delta'
+subdirectory.
+
+NpyTablet implements the (small) subset of the PyTables File
+interface that Table uses to access tablets, so the rest of the code
+doesn't need to know how a tablet is stored. When opened read-only,
+Table.read() returns a ColGroup of copy-on-write memory maps of the
+column files, instead of reading and copying the data.
+
+BLOB columns are not supported.
+"""
+
+import os
+import shutil
+import numpy as np
+from numpy.lib import format as npformat
+from colgroup import ColGroup
+
+HEADER_LEN = 128	# Length of the .npy headers we write (a multiple of 64, for alignment)
+
+def _header(dtype, nrows):
+	# Construct a .npy (v1.0) header for a column of nrows
+	# elements of type dtype, padded to HEADER_LEN bytes
+	d = { 'descr': npformat.dtype_to_descr(dtype.base), 'fortran_order': False, 'shape': (nrows,) + dtype.shape }
+	h = repr(d)
+	pad = HEADER_LEN - len(npformat.MAGIC_PREFIX) - 4 - len(h) - 1
+	if pad < 0:
+		raise Exception("Column type %s too complex for npy tablet storage" % (dtype,))
+	h = h + ' '*pad + '\n'
+	return npformat.MAGIC_PREFIX + '\x01\x00' + chr(len(h) & 0xFF) + chr(len(h) >> 8) + h
+
+def _read_header(fp):
+	# Return (shape, dtype) of the .npy file open in fp, leaving fp
+	# positioned at the beginning of the data
+	npformat.read_magic(fp)
+	shape, _, dtype = npformat.read_array_header_1_0(fp)
+	return shape, dtype
+
+def _coldtype(dtype, name):
+	# The dtype of column name in structured dtype dtype (possibly a
+	# subarray dtype)
+	return dtype.fields[name][0]
+
+class NpyTable(object):
+	""" The rows of a row group, stored by column """
+	def __init__(self, path, dtype, mode):
+		self._path = path
+		self._dtype = dtype
+		self._mode = mode
+
+	def _fn(self, name):
+		return '%s/%s.npy' % (self._path, name)
+
+	def _create(self):
+		for name in self._dtype.names:
+			with open(self._fn(name), 'wb') as fp:
+				fp.write(_header(_coldtype(self._dtype, name), 0))
+
+	def __len__(self):
+		with open(self._fn(self._dtype.names[0]), 'rb') as fp:
+			shape, _ = _read_header(fp)
+		return shape[0]
+
+	@property
+	def nrows(self):
+		return len(self)
+
+	def col(self, name):
+		""" Return the contents of column name. Memory-mapped
+		    (copy-on-write), if the tablet is opened read-only.
+		"""
+		dtype = _coldtype(self._dtype, name)
+		fn = self._fn(name)
+		if not os.path.exists(fn):
+			# A column added to the schema after this tablet was written
+			return np.zeros((len(self),) + dtype.shape, dtype=dtype.base)
+
+		with open(fn, 'rb') as fp:
+			shape, dtype = _read_header(fp)
+			offset = fp.tell()
+			if self._mode != 'r' or shape[0] == 0:
+				return np.fromfile(fp, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+		return np.memmap(fn, dtype=dtype, mode='c', offset=offset, shape=shape)
+
+	def read(self):
+		""" Return all rows. For tablets opened read-only, the rows
+		    are returned as a ColGroup of memory-mapped columns;
+		    otherwise as a structured ndarray.
+		"""
+		if self._mode == 'r':
+			return ColGroup([ (name, self.col(name)) for name in self._dtype.names ])
+
+		rows = np.empty(len(self), dtype=self._dtype)
+		for name in self._dtype.names:
+			rows[name] = self.col(name)
+		return rows
+
+	def append(self, rows):
+		assert self._mode != 'r'
+		for name in self._dtype.names:
+			dtype = _coldtype(self._dtype, name)
+			col = np.ascontiguousarray(rows[name], dtype=dtype.base)
+			with open(self._fn(name), 'r+b') as fp:
+				shape, _ = _read_header(fp)
+				fp.seek(0, 2)
+				fp.write(col.data)
+				fp.seek(0)
+				fp.write(_header(dtype, shape[0] + len(col)))
+
+	def truncate(self, nrows):
+		assert self._mode != 'r'
+		for name in self._dtype.names:
+			dtype = _coldtype(self._dtype, name)
+			with open(self._fn(name), 'r+b') as fp:
+				fp.truncate(HEADER_LEN + nrows * dtype.itemsize)
+				fp.seek(0)
+				fp.write(_header(dtype, nrows))
+
+class NpyGroup(object):
+	""" A row group ('main' or 'cached') of a tablet """
+	def __init__(self, path, dtype, mode):
+		self._path = path
+		self._mode = mode
+		self.table = NpyTable(path, dtype, mode)
+
+	def __getattr__(self, name):
+		# The primary key sequence (_seq_<key>)
+		if name.startswith('_seq_'):
+			fn = '%s/%s.npy' % (self._path, name)
+			if os.path.exists(fn):
+				return np.load(fn, mmap_mode='r' if self._mode == 'r' else 'r+')
+		raise AttributeError(name)
+
+class NpyRoot(object):
+	""" The root of the tablet, whose children are the row groups """
+	def __init__(self, tablet):
+		self._tablet = tablet
+
+	def __contains__(self, group):
+		return os.path.isdir('%s/%s' % (self._tablet.filename, group))
+
+	def __getattr__(self, group):
+		if group.startswith('_') or group not in self:
+			raise AttributeError(group)
+		return NpyGroup('%s/%s' % (self._tablet.filename, group), self._tablet.dtype, self._tablet.mode)
+
+class NpyTablet(object):
+	""" A columnar tablet, in directory path.
+
+	    mode is one of 'r' (read-only), 'a' (read/write) or 'w'
+	    (create).
+	"""
+	def __init__(self, path, dtype, mode='r'):
+		self.filename = path
+		self.dtype = np.dtype(dtype)
+		self.mode = mode
+		self.root = NpyRoot(self)
+
+		if mode == 'w':
+			os.mkdir(path)
+		elif not os.path.isdir(path):
+			raise IOError("Tablet '%s' does not exist" % path)
+
+	def createGroup(self, group, seqname=None):
+		""" Create a row group, with empty columns (and a primary
+		    key sequence, if seqname is given)
+		"""
+		assert self.mode != 'r'
+		path = '%s/%s' % (self.filename, group)
+		os.mkdir(path)
+		NpyTable(path, self.dtype, self.mode)._create()
+
+		if seqname is not None:
+			np.save('%s/%s.npy' % (path, seqname), np.array([1], dtype=np.uint64))
+
+		return getattr(self.root, group)
+
+	def removeNode(self, where, name, recursive=False):
+		assert where == '/' and recursive
+		shutil.rmtree('%s/%s' % (self.filename, name))
+
+	def close(self):
+		pass
+
+def nrows(path, group='main'):
+	""" Return the number of rows in a row group of the tablet
+	    in path, without knowing its schema.
+	"""
+	path = '%s/%s' % (path, group)
+	for fn in os.listdir(path):
+		if fn.endswith('.npy') and not fn.startswith('_seq_'):
+			with open('%s/%s' % (path, fn), 'rb') as fp:
+				shape, _ = _read_header(fp)
+			return shape[0]
+	return 0
+
+def get_delta(path):
+	""" Return the (base_snapid, tombstones) of the delta tablet
+	    in path.
+	"""
+	path = '%s/delta' % path
+	with open('%s/base' % path) as fp:
+		base_snapid = fp.read().strip()
+	return base_snapid, np.load('%s/tombstones.npy' % path)
+
+def set_delta(path, base_snapid, tombstones):
+	""" Make the tablet in path a delta of the tablet in snapshot
+	    base_snapid, with the given tombstone bitmap.
+	"""
+	path = '%s/delta' % path
+	if not os.path.isdir(path):
+		os.mkdir(path)
+	np.save('%s/tombstones.npy' % path, np.asarray(tombstones, dtype=bool))
+	with open('%s/base' % path, 'w') as fp:
+		fp.write('%s\n' % base_snapid)
+
+def copy(src, dst):
+	""" Copy the tablet src to dst, making the copy writable """
+	shutil.copytree(src, dst)
+	for root, dirs, files in os.walk(dst):
+		os.chmod(root, 0775)
+		for f in files:
+			os.chmod(os.path.join(root, f), 0664)
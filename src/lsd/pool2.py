@@ -11,12 +11,14 @@ import cPickle
 import os
 import sys
 import tempfile
+import shutil
 import time
-import mmap
 import traceback
-import platform
 import logging
 import signal
+import heapq
+from itertools import groupby, islice
+from operator import itemgetter
 from utils import unpack_callable
 
 logger = logging.getLogger('lsd.pool2')
@@ -24,15 +26,34 @@ logger = logging.getLogger('lsd.pool2')
 RET_KEYVAL = 1
 RET_KEYVAL_LIST = 2
 
-BUFSIZE = 100 * 2**20 if platform.architecture()[0] == '32bit' else 1000 * 2**30
-
-# OS X HFS+ filesystem does not support sparse files
-back_to_disk = platform.system() != 'Darwin'
+# Store intermediate results on disk
+back_to_disk = True
 
 # allow diskless operation with LSD_DISKLESS environment variable
 if os.getenv("LSD_DISKLESS") == "1":
 	back_to_disk = False
 
+# Memory budget (in bytes, shared by all workers) for grouping intermediate
+# map/reduce results by key, and the number of hash partitions these are
+# split into (default: 4 per worker slot). Once the budget is exceeded, the
+# sorted partitions are spilled to disk as runs (see _ExternalShuffle).
+SHUFFLE_MEMORY = int(os.getenv("LSD_SHUFFLE_MEMORY", 256 * 2**20))
+SHUFFLE_PARTITIONS = int(os.getenv("LSD_SHUFFLE_PARTITIONS", 0))
+
+def _rss(pids):
+	""" Return the total resident memory of given processes, in
+	    bytes (Linux only; returns 0 elsewhere).
+	"""
+	pagesize = os.sysconf('SC_PAGE_SIZE')
+	rss = 0
+	for pid in pids:
+		try:
+			with open('/proc/%d/statm' % pid) as fp:
+				rss += int(fp.read().split()[1]) * pagesize
+		except (IOError, OSError, ValueError, IndexError):
+			pass
+	return rss
+
 def _profiled_worker(*args, **kwargs):
 	import cProfile, time
 
@@ -46,56 +67,88 @@ def _profiled_worker(*args, **kwargs):
 		if time.time() - t0 > tmin:
 			profiler.dump_stats('%s/%s.%d.profile' % (os.getenv("PROFILE_DIR", "."), current_process().name, os.getpid()))
 
-def _worker(ident, qcmd, qbroadcast, qin, qout):
-	""" Waits for commands on qcmd. Possible commands are:
-		MAP: On MAP, store mapper and mapper_args, and
-		     begin listening on qin for a stream of
-		     items to be passed to mapper, until a
-		     message 'DONE' is encountered. Return the
-		     results yielded by mapper via qout.
+def _map_items(slot, mapper, mapper_args, qcont, qbroadcast, qin, qout):
+	""" Pass the items from qin to mapper, until a 'DONE'
+	    is encountered, returning the results via qout. The
+	    loop can be paused with a STOP from qbroadcast, and is
+	    resumed by a CONT on qcont.
 	"""
-
 	def check_bqueue():
 		# Check if there's a command in the broadcast queue
 		try:
 			(cmd, args) = qbroadcast.get_nowait()
 			if cmd == "STOP":
-				qout.put((ident, 'STOPPED', None))
-				cmd, args = qcmd.get()	# Expect 'CONT' to unfreeze the job
+				qout.put((slot, 'STOPPED', None))
+				cmd, args = qcont.get()	# Expect 'CONT' to unfreeze the job
 				assert cmd == 'CONT', cmd
 		except Empty:
 			pass
 
+	check_bqueue()
+
+	for (i, item) in iter(qin.get, 'DONE'):
+		# Process an item
+		try:
+			for result in mapper(item, *mapper_args):
+				qout.put((slot, 'RESULT', (i, result)))
+			qout.put((slot, 'DONE', i))
+		except KeyboardInterrupt:
+			# Handle Ctrl-C by just exiting and not spewing output to stderr
+			raise
+		except:
+			type, value, tb = sys.exc_info()
+			tb_str = traceback.format_tb(tb)
+			del tb    # See docs for sys.exec_info() for why this has to be here
+			qout.put((slot, 'EXCEPT', (type, value, tb_str)))
+
+		check_bqueue()
+
+def _worker(ident, nthreads, qcmd, qcont, qbroadcast, qin, qout):
+	""" Waits for commands on qcmd. Possible commands are:
+		MAP: On MAP, store mapper and mapper_args, and
+		     begin listening on qin for a stream of
+		     items to be passed to mapper, until a
+		     message 'DONE' is encountered. Return the
+		     results yielded by mapper via qout.
+
+	    If nthreads > 1, the items are processed by nthreads
+	    threads, each acting as an independent worker slot
+	    (numbered ident*nthreads + thread index), with its
+	    own CONT queue in the qcont list.
+	"""
 
 	try:
 		for cmd, args in iter(qcmd.get, 'EXIT'):
 			if cmd == 'MAP':
 				mapper, mapper_args = cPickle.loads(args)
+				del args
 
-				check_bqueue()
-
-				i, item, result = None, None, None
-				for (i, item) in iter(qin.get, 'DONE'):
-					# Process an item
-					try:
-						for result in mapper(item, *mapper_args):
-							qout.put((ident, 'RESULT', (i, result)))
-						qout.put((ident, 'DONE', i))
-					except KeyboardInterrupt:
-						# Handle Ctrl-C by just exiting and not spewing output to stderr
-						raise
-					except:
-						type, value, tb = sys.exc_info()
-						tb_str = traceback.format_tb(tb)
-						del tb    # See docs for sys.exec_info() for why this has to be here
-						qout.put((ident, 'EXCEPT', (type, value, tb_str)))
-
-					check_bqueue()
+				token = mapper_args[0] if mapper is _output_to_partitions else None
+				try:
+					if nthreads == 1:
+						_map_items(ident, mapper, mapper_args, qcont[0], qbroadcast, qin, qout)
+					else:
+						threads = [ threading.Thread(target=_map_items, args=(ident*nthreads + t, mapper, mapper_args, qcont[t], qbroadcast, qin, qout)) for t in xrange(nthreads) ]
+						for th in threads:
+							th.daemon = True
+							th.start()
+
+						# Note: join() with a timeout, to remain responsive to signals
+						for th in threads:
+							while th.is_alive():
+								th.join(1)
+
+					# Report end-of-output of partitioned kernels
+					if token is not None:
+						for result in _finish_partitions(token):
+							qout.put((ident*nthreads, 'RESULT', (None, result)))
+				finally:
+					# Never let the writers of a failed step leak into the next one
+					if token is not None:
+						_drop_partitions(token)
 
 				# Immediately release memory
-				del result, i, item
 				del mapper, mapper_args
-				del args
 
 				# Announce we're done with this mapper
 				qout.put((ident, 'MAPDONE', None))
@@ -103,42 +156,178 @@ def _worker(ident, qcmd, qbroadcast, qin, qout):
 	except KeyboardInterrupt:
 		# Cancel all queue feeder threads, otherwise the child will
 		# hang trying to send the data back to the parent
-		for q in [qcmd, qbroadcast, qin, qout]:
+		for q in [qcmd, qbroadcast, qin, qout] + qcont:
 			q.cancel_join_thread()
 
-def _unserializer(file, offsets):
-	# Helper for _reduce_from_pickle_jar -- takes a filename and
-	# a list of offsets, and returns a generator unpickling objects
-	# at given offsets
-	with open(file) as f:
-		mm = mmap.mmap(f.fileno(), 0, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
+class _ExternalShuffle(object):
+	""" Groups (key, offset) pairs by key, using an external sort
+	    with a bounded memory footprint.
 
-		for offs in offsets:
-			##print "Seek to ", offs
-			mm.seek(offs)
-			yield cPickle.load(mm)
+	    The pairs are hash-partitioned by key into <npartitions>
+	    buffers. Once the (estimated) size of the buffers exceeds
+	    <membudget> bytes, each buffer is sorted and spilled to disk
+	    as a run. finish() spills what remains, and returns the
+	    list of runs of each partition; these are merged back into
+	    (key, [offsets]) groups by _merge_runs.
 
-		mm.close()
+	    Keys must be hashable and mutually comparable.
+	"""
+	entry_size = 128	# Rough estimate of the memory taken by one buffered pair
+	chunk_size = 4096	# Number of pairs pickled together when spilling
 
-def _reduce_from_pickle_jar(kw, file, reducer, reducer_args):
-	# open the pickle jar, load the objects, pass them on to the
-	# actual reducer
-	key, offsets = kw
-	for result in reducer((key, _unserializer(file, offsets)), *reducer_args):
-		yield result
+	def __init__(self, membudget, npartitions, dir=None):
+		self.membudget = membudget
+		self.npartitions = npartitions
+		self.dir = dir
 
-def _output_pickled_kv(item, K_fun, K_args):
-	# return a pickled value, deduplicating if possible
-	unique_objects = set()
+		self.buffers = [ [] for _ in xrange(self.npartitions) ]
+		self.runs    = [ [] for _ in xrange(self.npartitions) ]	# (filename, offset) of spilled runs, per partition
+		self.files   = []	# Names of spill files
+		self.size    = 0	# Estimated size of buffered pairs
 
-	for (k, v) in K_fun(item, *K_args):
-		p = cPickle.dumps(v, -1)
+	def add(self, key, offs):
+		self.buffers[hash(key) % self.npartitions].append((key, offs))
 
-		hash = digest(p)
-		if hash in unique_objects:
-			p = None
+		self.size += self.entry_size
+		if self.size > self.membudget:
+			self.spill()
 
-		yield (k, (hash, p))
+	def spill(self):
+		""" Sort the buffered pairs and write them out to a
+		    new run file, one run per partition.
+		"""
+		with tempfile.NamedTemporaryFile(mode='wb', prefix='shuffle-', dir=self.dir, suffix='.pkl', delete=False) as fp:
+			self.files.append(fp.name)
+
+			for part, buf in enumerate(self.buffers):
+				if not buf:
+					continue
+				buf.sort()
+
+				self.runs[part].append((fp.name, fp.tell()))
+				for at in xrange(0, len(buf), self.chunk_size):
+					cPickle.dump(buf[at:at+self.chunk_size], fp, -1)
+				cPickle.dump(None, fp, -1)
+
+				self.buffers[part] = []
+
+		self.size = 0
+		logger.debug("Spilled shuffle buffers to %s (%d runs so far)." % (fp.name, len(self.files)))
+
+	def finish(self):
+		""" Spill any buffered pairs, and return the runs """
+		if self.size:
+			self.spill()
+		return self.runs
+
+def _read_run(tag, fn, offs):
+	# Yield the (key, tag, offset) triplets of a spilled run
+	with open(fn, 'rb') as fp:
+		fp.seek(offs)
+		for chunk in iter(lambda: cPickle.load(fp), None):
+			for (key, v) in chunk:
+				yield key, tag, v
+
+def _merge_runs(runs):
+	""" Merge sorted runs, given as a list of (tag, filename, offset)
+	    tuples, into a stream of (key, [(tag, offset), ...]) groups.
+	"""
+	triplets = heapq.merge(*[ _read_run(tag, fn, offs) for (tag, fn, offs) in runs ])
+	for key, group in groupby(triplets, itemgetter(0)):
+		yield key, [ (tag, offs) for (_, tag, offs) in group ]
+
+class _EndOfOutput(object):
+	""" Sent by a worker once it has run out of items to map,
+	    describing the partitioned output it has written out.
+	"""
+	def __init__(self, jar, runs, files):
+		self.jar   = jar	# The pickle jar holding the values
+		self.runs  = runs	# Per-partition lists of (filename, offset) runs
+		self.files = files	# All files written out by the worker
+
+class _PartitionWriter(object):
+	""" The worker-side half of the shuffle. Pickles the values
+	    output by a kernel into a private pickle jar, and
+	    partitions and sorts the (key, offset) pairs using an
+	    _ExternalShuffle.
+	"""
+	def __init__(self, npartitions, membudget, dir):
+		self.jar = tempfile.NamedTemporaryFile(mode='wb', prefix='mapresults-', dir=dir, suffix='.pkl', delete=False)
+		self.shuffle = _ExternalShuffle(membudget, npartitions, dir)
+
+	def write(self, key, value):
+		offs = self.jar.tell()
+		cPickle.dump(value, self.jar, -1)
+		self.shuffle.add(key, offs)
+
+	def finish(self):
+		self.jar.close()
+		runs = self.shuffle.finish()
+		return _EndOfOutput(self.jar.name, runs, [ self.jar.name ] + self.shuffle.files)
+
+# Partition writers of the kernels run by this process, keyed by
+# a token unique to each map_reduce_chain step, and the thread
+_partition_writers = {}
+
+def _output_to_partitions(item, token, npartitions, membudget, dir, K_fun, K_args):
+	# Write the (key, value) pairs output by K_fun to this process'
+	# partition writer. Nothing is returned to the parent until
+	# the process runs out of items (see _finish_partitions)
+	key = (token, threading.current_thread().ident)
+	try:
+		writer = _partition_writers[key]
+	except KeyError:
+		writer = _partition_writers[key] = _PartitionWriter(npartitions, membudget, dir)
+
+	for (k, v) in K_fun(item, *K_args):
+		writer.write(k, v)
+
+	return ()
+
+def _finish_partitions(token):
+	# Flush the partition writers of the map_reduce_chain step
+	# identified by token, returning an _EndOfOutput for each.
+	# Writers of other (e.g., enclosing) jobs are left alone.
+	keys = [ key for key in _partition_writers.keys() if key[0] == token ]
+	return [ _partition_writers.pop(key).finish() for key in keys ]
+
+def _drop_partitions(token):
+	# Discard the partition writers of the step identified by
+	# token (e.g., when the step failed). Their files are removed
+	# along with the job's directory.
+	for key in [ key for key in _partition_writers.keys() if key[0] == token ]:
+		_partition_writers.pop(key).jar.close()
+
+def _unpickle_values(fps, values):
+	# Load the values at given (jar index, offset) locations
+	for (tag, offs) in values:
+		fp = fps[tag]
+		fp.seek(offs)
+		yield cPickle.load(fp)
+
+def _reduce_partition(task, reducer, reducer_args):
+	# Merge the runs of one partition, and call the reducer once
+	# for each key, unpickling the values from the jars
+	jars, runs = task
+	fps = [ open(fn, 'rb') for fn in jars ]
+	try:
+		for key, values in _merge_runs(runs):
+			for result in reducer((key, _unpickle_values(fps, values)), *reducer_args):
+				yield result
+	finally:
+		for fp in fps:
+			fp.close()
+
+def _partition_tasks(eoos, npartitions):
+	# Turn the end-of-output reports of all workers into a list of
+	# (jars, runs) reduce tasks, one per non-empty partition
+	jars = [ eoo.jar for eoo in eoos ]
+	tasks = []
+	for part in xrange(npartitions):
+		runs = [ (tag, fn, offs) for (tag, eoo) in enumerate(eoos) for (fn, offs) in eoo.runs[part] ]
+		if runs:
+			tasks.append((jars, runs))
+	return tasks
 
 def _reduce_from_pickled(kw, pkl, reducer, args):
 	# open the piclke jar, load the objects, pass them on to the
@@ -157,7 +346,10 @@ def _reduce_from_pickled(kw, pkl, reducer, args):
 def progress_default(stage, step, input, index, result):
 	self = progress_default
 
-	if  step == 'begin':
+	# Choose the style on the outermost 'begin', and stick with it
+	# until the matching 'end'
+	if  step == 'begin' and getattr(self, 'outer', None) is None:
+		self.outer = stage
 		if '__len__' in dir(input):
 			self.dispatch = progress_pct
 		else:
@@ -165,6 +357,9 @@ def progress_default(stage, step, input, index, result):
 
 	self.dispatch(stage, step, input, index, result)
 
+	if step == 'end' and stage == self.outer:
+		self.outer = None
+
 def progress_pct(stage, step, input, index, result):
 	running = progress_pct_nnl(stage, step, input, index, result)
 	if not running:
@@ -180,7 +375,8 @@ def progress_pct_nnl(stage, step, input, index, result):
 		self.head = 'm/r' if stage == 'mapreduce' else 'm'
 
 	if step == 'begin' and (stage == 'map' or stage == 'reduce'):
-			self.len = len(input)
+			# Streamed inputs (e.g., shuffled key groups) have no length
+			self.len = len(input) if '__len__' in dir(input) else None
 			self.at = 0
 			self.pct = 5
 
@@ -190,9 +386,17 @@ def progress_pct_nnl(stage, step, input, index, result):
 			elif stage == "reduce":
 #				sys.stderr.write('|'),
 				self.sign = '+'
-			sys.stderr.write("[%d el.]" % self.len),
+			if self.len is not None:
+				sys.stderr.write("[%d el.]" % self.len),
+			else:
+				sys.stderr.write("[? el.]"),
 	elif step == 'step':
 		self.at = self.at + 1
+		if self.len is None:
+			# Unknown length: a sign for every power of two
+			if self.at & (self.at - 1) == 0:
+				sys.stderr.write(self.sign)
+			return True
 		pct = 100. * self.at / self.len
 		while self.pct <= pct:
 			sys.stderr.write(self.sign)
@@ -226,13 +430,19 @@ def where(cond, a, b):
 
 class Pool:
 	qcmd = None
+	qcont = None
 	qin = None
 	qbroadcast = None
 	qout = None
 	ps = []
 	min_tasks_for_parallel = 3
+	max_pending_per_worker = 4	# Max. number of queued input items, per worker slot
 	DEBUG = None	# Filled in in __init__ from getenv
 	nworkers = None	# Filled in in __init__ from getenv or cpu_count()
+	nthreads = None	# Threads per worker process. Filled in in __init__ from getenv or 1
+	nslots = None	# Total number of worker threads (nworkers * nthreads)
+	mem_hint = None	# Expected memory use per worker process (bytes), reported to lsd-manager
+	priority = None	# Priority class reported to lsd-manager ('interactive' or 'batch')
 
 	def __del__(self):
 		self.close()
@@ -280,7 +490,7 @@ class Pool:
 		del self.ps[:]
 
 		# Close all queues
-		for qq in [ self.qcmd, self.qin, self.qbroadcast, self.qout ]:
+		for qq in [ self.qcmd, self.qcont, self.qin, self.qbroadcast, self.qout ]:
 			if qq is None:
 				continue
 
@@ -288,7 +498,7 @@ class Pool:
 				qq = [ qq ]
 			for q in qq:
 				q.close()
-		self.qcmd = self.qin = self.qbroadcast = self.qout = None
+		self.qcmd = self.qcont = self.qin = self.qbroadcast = self.qout = None
 
 	def _create_workers(self):
 		""" Lazily create workers, when needed. This routine
@@ -300,32 +510,66 @@ class Pool:
 
 		self.qin = Queue()
 		self.qbroadcast = Queue()
-		self.qout = Queue(self.nworkers*2)
+		self.qout = Queue(self.nslots*2)
 		self.qcmd = [ Queue() for _ in xrange(self.nworkers) ]
+		self.qcont = [ Queue() for _ in xrange(self.nslots) ]
 		
 		target = _worker if not os.getenv("PROFILE", 0) else _profiled_worker
-		self.ps = [ Process(target=target, name="%s{%02d}" % (current_process().name, i), args=(i, self.qcmd[i], self.qbroadcast, self.qin, self.qout)) for i in xrange(self.nworkers) ]
+		nt = self.nthreads
+		self.ps = [ Process(target=target, name="%s{%02d}" % (current_process().name, i), args=(i, nt, self.qcmd[i], self.qcont[i*nt:(i+1)*nt], self.qbroadcast, self.qin, self.qout)) for i in xrange(self.nworkers) ]
 
 		for p in self.ps:
 			p.daemon = True
 			p.start()
 
-	def __init__(self, nworkers = None):
+	def __init__(self, nworkers = None, nthreads = None, mem_hint = None, priority = None):
+		""" Create a pool of nworkers processes, each running
+		    nthreads threads.
+
+		    The number of active workers is throttled by lsd-manager,
+		    if running, based on the load, the memory use of the
+		    workers, and the priority class of the pool. A hint on
+		    the memory a worker will need (in bytes) can be given
+		    in mem_hint (default: $LSD_MEM_HINT), and the priority
+		    class ('interactive' or 'batch') in priority (default:
+		    $LSD_PRIORITY, or 'batch').
+
+		    Running more than one thread per process pays off
+		    for I/O bound kernels (or those spending their time
+		    in code that releases the GIL), as fewer processes
+		    make for less memory and cheaper transfers to the
+		    parent. The kernels must then be thread-safe (and
+		    so must be the HDF5 library, if used).
+		"""
 		self.DEBUG    = int(os.getenv('DEBUG', False))
 		self.nworkers = int(os.getenv('NWORKERS', cpu_count()))
+		self.nthreads = int(os.getenv('NTHREADS', 1))
+
+		self.mem_hint = int(os.getenv('LSD_MEM_HINT', 0))
+		self.priority = os.getenv('LSD_PRIORITY', 'batch')
 
 		if nworkers != None:
 			self.nworkers = nworkers
+		if nthreads != None:
+			self.nthreads = nthreads
+		if mem_hint != None:
+			self.mem_hint = mem_hint
+		if priority != None:
+			self.priority = priority
+		self.nslots = self.nworkers * self.nthreads
 
-		self._ntarget = self.nworkers
+		self._ntarget = self.nslots
 
 	_ntarget_time = 0	# Last time _ntarget was refreshed
 	_ntarget = None		# Target number of active workers
+	ntarget_refresh = 10	# Interval (in seconds) between refreshes of _ntarget
 	def get_active_workers_target(self, _mgr):
-		""" Return the target number of active workers """
-		if time.time() - self._ntarget_time > 30:
+		""" Return the target number of active worker slots """
+		if time.time() - self._ntarget_time > self.ntarget_refresh:
 			try:
-				self._ntarget = min(_mgr.nworkers(), self.nworkers)
+				rss = _rss([ p.pid for p in self.ps ])
+				nworkers = _mgr.nworkers(rss, len(self.ps), self.mem_hint, self.priority)
+				self._ntarget = min(nworkers * self.nthreads, self.nslots)
 			except RPCError:
 				_mgr.close()
 				logger.warning("Error contacting lsd-manager. Cannot coordinate resource usage with others, using %d cores." % self._ntarget)
@@ -334,6 +578,23 @@ class Pool:
 
 		return self._ntarget
 
+	def _queue_items(self, items, count):
+		""" Queue up to <count> (index, item) pairs from <items>
+		    into the input queue. Queue the end-of-map markers once
+		    <items> is exhausted. Return the number of items queued.
+		"""
+		nqueued = 0
+		for (i, item) in islice(items, count):
+			self.qin.put( (i, item) )
+			nqueued += 1
+
+		if nqueued < count:
+			# Queue the end-of-map markers
+			for _ in xrange(self.nslots):
+				self.qin.put('DONE')
+
+		return nqueued
+
 	def imap_unordered(self, input, mapper, mapper_args=(), progress_callback=None, progress_callback_stage='map'):
 		""" Execute in parallel a callable <mapper> on all values of
 		    iterable <input>, ensuring that no more than ~nworkers
@@ -350,20 +611,22 @@ class Pool:
 		except TypeError:
 			parallel = True
 
-		parallel = parallel and self.nworkers > 1 and not self.DEBUG
+		parallel = parallel and self.nslots > 1 and not self.DEBUG
 
 		# Dispatch/execute
 		if parallel:
+			abandoned = False	# Set if the consumer closed this iterator before the end
+			error = None		# The first exception raised by the mapper
 			try:
 				# Create workers (if not created already)
 				_mgr = PyRPCProxy("localhost", 9029)
 				self._create_workers()
 
 				# Connect to worker manager and stop workers over the limit
-				stopped   = set()				# Idents of stopped workers
-				nrunning  = self.nworkers			# Number of running workers
-				ntarget   = self.get_active_workers_target(_mgr)# Desired number of running workers
-				nstopping = self.nworkers - ntarget		# Number of workers to which the stop command has been sent
+				stopped   = set()				# Idents of stopped worker slots
+				nrunning  = self.nslots				# Number of running worker slots
+				ntarget   = self.get_active_workers_target(_mgr)# Desired number of running worker slots
+				nstopping = self.nslots - ntarget		# Number of slots to which the stop command has been sent
 				for _ in xrange(nstopping):
 					self.qbroadcast.put( ('STOP', None) )
 
@@ -372,52 +635,71 @@ class Pool:
 				for q in self.qcmd:
 					q.put( ('MAP', map_args) )
 
-				# Queue the data to operate on
-				i = -1
-				for (i, item) in enumerate(input):
-					self.qin.put( (i, item) )
-				n = i + 1
-
-				# Queue the end-of-map markers
-				for _ in xrange(self.nworkers):
-					self.qin.put('DONE')
-
+				# Queue the data to operate on. The input is consumed
+				# lazily, keeping no more than maxpending items in the
+				# queue, so that streamed inputs are never materialized
+				# in memory all at once.
+				items = enumerate(input)
+				maxpending = self.nslots * self.max_pending_per_worker
+				n = self._queue_items(items, maxpending)	# Number of items queued so far
+				exhausted = n < maxpending
 
 				# yield the outputs
 				k = 0	# Number of items that have been processed
 				wf = 0	# Number of workers that have finished
-				while wf != self.nworkers or k != n or nstopping != 0:
+				while wf != self.nworkers or not exhausted or k != n or nstopping != 0:
 					(ident, what, data) = self.qout.get()
 					if what == 'RESULT':
-						i, result = data
-						yield result
+						if not abandoned and error is None:
+							i, result = data
+							try:
+								yield result
+							except GeneratorExit:
+								# The consumer is gone. Stop feeding the workers and
+								# drain them, so that the pool remains usable.
+								abandoned = True
+								if not exhausted:
+									self._queue_items(iter(()), 1)
+									exhausted = True
 					elif what == 'MAPDONE':
 						wf += 1
 					elif what == 'DONE':
 						k += 1
 						progress_callback(progress_callback_stage, 'step', input, k, None)
+
+						# Replenish the input queue
+						if not exhausted:
+							nq = self._queue_items(items, 1)
+							n += nq
+							exhausted = nq == 0
 					elif what == 'STOPPED':
 						assert ident not in stopped
 						stopped.add(ident)
 						nstopping -= 1
 						nrunning -= 1
 					elif what == 'EXCEPT':
-						# Unhandled Exception was raised in one of the workers.
-						# The workers will be terminated by the except clause at the end
+						# Unhandled Exception was raised in one of the workers,
+						# while processing an item. Stop feeding the workers, and
+						# raise it once the items already queued are drained.
+						k += 1
 						type, value, tb_str = data
-						print >> sys.stderr, 'Remote Traceback (most recent call last):\n', ''.join(tb_str),
-						print >> sys.stderr, ''.join(traceback.format_exception_only(type, value))
-						raise value
+						if error is None and not abandoned:
+							print >> sys.stderr, 'Remote Traceback (most recent call last):\n', ''.join(tb_str),
+							print >> sys.stderr, ''.join(traceback.format_exception_only(type, value))
+							error = value
+						if not exhausted:
+							self._queue_items(iter(()), 1)
+							exhausted = True
 
 					#
 					# Adjust the number of active workers
 					#
-					if k != n:
+					if not exhausted or k != n:
 						ntarget = self.get_active_workers_target(_mgr)
 					else:
 						# If all items have been exhausted, unstop all workers so they can
 						# finish cleanly
-						ntarget = self.nworkers
+						ntarget = self.nslots
 					
 						# Rescind outstanding STOP orders, if any
 						if wf == self.nworkers:
@@ -435,7 +717,7 @@ class Pool:
 						if len(stopped) == 0:
 							break
 						ident = stopped.pop()
-						self.qcmd[ident].put(("CONT", None))
+						self.qcont[ident].put(("CONT", None))
 						nrunning += 1
 
 				assert wf == self.nworkers	# All workers must have finished
@@ -453,12 +735,26 @@ class Pool:
 				# Make sure the connection to manager is closed (e.g., if an
 				# exception is thrown)
 				_mgr.close()
+
+			if error is not None:
+				raise error
+			if abandoned:
+				return
 		else:
 			# Execute in-thread, without external workers
-			for (i, item) in enumerate(input):
-				for result in mapper(item, *mapper_args):
-					yield result
-				progress_callback(progress_callback_stage, 'step', input, i, None)
+			token = mapper_args[0] if mapper is _output_to_partitions else None
+			try:
+				for (i, item) in enumerate(input):
+					for result in mapper(item, *mapper_args):
+						yield result
+					progress_callback(progress_callback_stage, 'step', input, i, None)
+
+				if token is not None:
+					for result in _finish_partitions(token):
+						yield result
+			finally:
+				if token is not None:
+					_drop_partitions(token)
 
 		progress_callback(progress_callback_stage, 'end', input, None, None)
 
@@ -550,6 +846,19 @@ class Pool:
 		    	- mapper must return a dictionary of (key, value) pairs
 		    	- reducer must expect a (key, value) pair as the first
 		    	  argument, where the value will be an iterable
+		    	- keys must be hashable and mutually comparable; when
+		    	  backed by disk, the intermediate results are grouped
+		    	  by an external sort whose memory use is bounded by
+		    	  LSD_SHUFFLE_MEMORY (see _ExternalShuffle)
+
+		    When backed by disk, the workers write the outputs of
+		    all but the last kernel straight into their own
+		    partitioned pickle jars, and report end-of-output once
+		    they run out of items. A partition is complete once every
+		    worker has reported; each complete partition becomes one
+		    task of the next step, where the runs are merged and the
+		    reducer is called on every key. The intermediate results
+		    never pass through (or get assembled in) the parent.
 		"""
 
 		if progress_callback == None:
@@ -558,98 +867,66 @@ class Pool:
 		progress_callback('mapreduce', 'begin', input, None, None)
 
 		if back_to_disk:
-			fp, prev_fp = None, None
-			mm, prev_mm = None, None
-
-		for i, K in enumerate(kernels):
-			K_fun, K_args = unpack_callable(K)
-			last_step = (i + 1 == len(kernels))
-			stage = where(i == 0, 'map', 'reduce')
-
-			if back_to_disk:
-				# Reinitialize the unique_hash->file_offset map
-				unique_objects = {}
+			# Directory for the pickle jars and shuffle runs of this job
+			jobdir = tempfile.mkdtemp(prefix='mapreduce-', dir=os.getenv('LSD_TEMPDIR'))
+			npartitions = SHUFFLE_PARTITIONS or 4*self.nslots
+			membudget = max(SHUFFLE_MEMORY // self.nslots, _ExternalShuffle.entry_size)
 
-				# Insert picklers/unpicklers
-				if i != 0:
-					# Insert unpickler
-					K_fun, K_args = _reduce_from_pickle_jar, (prev_fp.name, K_fun, K_args)
+		try:
+			for i, K in enumerate(kernels):
+				K_fun, K_args = unpack_callable(K)
+				last_step = (i + 1 == len(kernels))
+				stage = where(i == 0, 'map', 'reduce')
 
-				if not last_step:
-					# Insert pickler
-					K_fun, K_args = _output_pickled_kv, (K_fun, K_args)
+				if back_to_disk:
+					if i != 0:
+						# Each input item is a partition to reduce
+						K_fun, K_args = _reduce_partition, (K_fun, K_args)
 
-					# Create a disk backing store for intermediate results
-					fp = tempfile.NamedTemporaryFile(mode='wb', prefix='mapresults-', dir=os.getenv('LSD_TEMPDIR'), suffix='.pkl', delete=True)
-					fd = fp.file.fileno()
-					os.ftruncate(fd, BUFSIZE)
-					mm = mmap.mmap(fd, 0)
+					if not last_step:
+						# Insert partitioned pickler
+						token = '%s.%d' % (jobdir, i)
+						K_fun, K_args = _output_to_partitions, (token, npartitions, membudget, jobdir, K_fun, K_args)
 
-			try:
 				# Call the distributed mappers
 				mresult = defaultdict(list)
-				for r in self.imap_unordered(input, K_fun, K_args, progress_callback=progress_callback, progress_callback_stage=stage):
-					if last_step:
-						# yield the final result
-						yield r
-					else:
-						(k, v) = r
-
-						if back_to_disk:
-							(hash, v) = v
-							if hash in unique_objects:
-								v = unique_objects[hash]
-							else:
-								# The output value has already been pickled (but not the key). Store the
-								# pickled value into the pickle jar, and keep the (key, offset) tuple.
-								offs = mm.tell()
-								mm.write(v)
-								assert len(v) == mm.tell() - offs
-								v = offs
-								unique_objects[hash] = offs
-
-						# Prepare for next reduction
-						mresult[k].append(v)
-
-				input = mresult.items()
-			except:
-				# In case of an exception, delete the temporary file so the kernel
-				# won't attempt to flush them to the disk
-				if back_to_disk:
-					if mm is not None:
-						mm.resize(1)
-						mm.close()
-						mm = None
-
-					if fp is not None:
-						os.ftruncate(fp.file.fileno(), 0)
-						fp.close()
-						fp = None
-				raise
-			finally:
+				eoos = []
+				results = self.imap_unordered(input, K_fun, K_args, progress_callback=progress_callback, progress_callback_stage=stage)
+				try:
+					for r in results:
+						if last_step:
+							# yield the final result
+							yield r
+						elif back_to_disk:
+							# End-of-output report of a worker
+							assert isinstance(r, _EndOfOutput)
+							eoos.append(r)
+						else:
+							# Prepare for next reduction
+							(k, v) = r
+							mresult[k].append(v)
+				finally:
+					# Drain the workers (if we're being closed early)
+					# before the job directory is removed
+					results.close()
+
 				if back_to_disk:
-					# Close/clear the intermediate result backing store from the previous step
-					# ensuring it's truncated first so it doesn't hit the disk if it hasn't
-					# already.
-					if prev_fp is not None:
-						prev_mm.resize(1)
-						prev_mm.close()
-						os.ftruncate(prev_fp.file.fileno(), 0)
-						prev_fp.close()
-
-					if fp is not None:
-						prev_fp, prev_mm = fp, mm
-						fp, mm = None, None
+					# Remove the partitions this step has consumed
+					if i != 0:
+						for fn in prev_files:
+							os.unlink(fn)
+
+					prev_files = [ fn for eoo in eoos for fn in eoo.files ]
+					input = _partition_tasks(eoos, npartitions)
+				else:
+					input = mresult.items()
+		finally:
+			if back_to_disk:
+				shutil.rmtree(jobdir, ignore_errors=True)
 
 		if progress_callback != None:
 			progress_callback('mapreduce', 'end', None, None, None)
 
-def digest(s):
-	import hashlib
-	#return hashlib.md5(s).hexdigest()
-	#return hashlib.sha1(s).digest()
-	return hashlib.md5(s).digest()
-
 ############ Unit tests
 
 # ====
@@ -758,3 +1035,31 @@ class Test_Pool:
 			print r3
 			assert np.all(res == r3)
 
+	def test_mapred_spill(self):
+		""" Map-Reduce: external shuffle, spilling to disk """
+		global SHUFFLE_MEMORY, SHUFFLE_PARTITIONS
+		membudget, npartitions = SHUFFLE_MEMORY, SHUFFLE_PARTITIONS
+		SHUFFLE_MEMORY, SHUFFLE_PARTITIONS = 10 * _ExternalShuffle.entry_size, 3
+		try:
+			self.test_mapred2()
+		finally:
+			SHUFFLE_MEMORY, SHUFFLE_PARTITIONS = membudget, npartitions
+
+	def test_shuffle(self):
+		""" External shuffle: grouping by key """
+		shuffle = _ExternalShuffle(membudget=7 * _ExternalShuffle.entry_size, npartitions=2)
+		for offs in xrange(100):
+			shuffle.add(offs % 13, offs)
+
+		res = {}
+		for runs in shuffle.finish():
+			for key, values in _merge_runs([ (0, fn, offs) for (fn, offs) in runs ]):
+				assert key not in res
+				res[key] = [ offs for (_, offs) in values ]
+		for fn in shuffle.files:
+			os.unlink(fn)
+
+		assert sorted(res.keys()) == range(13)
+		for k, offsets in res.iteritems():
+			assert offsets == range(k, 100, 13)
+
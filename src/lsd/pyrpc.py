@@ -7,9 +7,17 @@ import json
 import re
 import logging
 import os
+import struct
+import itertools
+import numpy as np
 
 logger = logging.getLogger('lsd.pyrpc')
 
+# Binary frames start with a NUL byte, which can never begin a line
+# of the line protocol (a function name, or an empty heartbeat line).
+FRAME_MARKER = '\x00'
+_frame_header = struct.Struct('<II')	# JSON metadata length, number of raw buffers
+
 def escape_nl(s):
 	r""" Escape any newlines with \n, and backslashes with \\ """
 	def repl(match):
@@ -41,6 +49,89 @@ def _unicode_to_str(val):
 		return val
 
 
+def _descr_to_dtype(descr):
+	# Convert a JSON-decoded dtype.descr (or dtype.str) back to a
+	# numpy dtype (JSON turns the descr tuples into lists)
+	def fix(descr):
+		if not isinstance(descr, list):
+			return str(descr)
+		fields = []
+		for field in descr:
+			name, t = str(field[0]), fix(field[1])
+			fields.append((name, t) if len(field) == 2 else (name, t, tuple(field[2])))
+		return fields
+	return np.dtype(fix(descr))
+
+def _json_default(obj):
+	# Line protocol: ndarrays and numpy scalars are sent as plain
+	# JSON lists/numbers
+	if isinstance(obj, np.ndarray):
+		return obj.tolist()
+	if isinstance(obj, np.generic):
+		return obj.item()
+	raise TypeError("%r is not JSON serializable" % (obj,))
+
+def send_frame(sock, meta):
+	""" Send a binary frame with JSON-serializable metadata <meta>.
+
+	    Any ndarrays found within <meta> are sent as raw buffers
+	    following the JSON, and are replaced in the JSON by a
+	    reference ({'__ndarray__': index, 'dtype': ..., 'shape': ...}).
+	    The frame layout is:
+
+	    	FRAME_MARKER
+	    	<u4 length of JSON> <u4 number of buffers>
+	    	<u8 length of buffer> (one per buffer)
+	    	JSON
+	    	buffers
+	"""
+	buffers = []
+	def default(obj):
+		if isinstance(obj, np.ndarray):
+			if obj.dtype.hasobject:
+				raise TypeError("Arrays of objects cannot be sent")
+			buffers.append(np.ascontiguousarray(obj))
+			dtype = obj.dtype.descr if obj.dtype.names is not None else obj.dtype.str
+			return { '__ndarray__': len(buffers) - 1, 'dtype': dtype, 'shape': obj.shape }
+		if isinstance(obj, np.generic):
+			return obj.item()
+		raise TypeError("%r is not JSON serializable" % (obj,))
+	js = json.dumps(meta, default=default)
+
+	head = FRAME_MARKER + _frame_header.pack(len(js), len(buffers)) + \
+		struct.pack('<%dQ' % len(buffers), *[ b.nbytes for b in buffers ]) + js
+	sock.sendall(head)
+	for b in buffers:
+		if b.nbytes:
+			sock.sendall(buffer(b))
+
+def recv_frame(rfile):
+	""" Read the remainder of a binary frame (sent with
+	    send_frame()) from file-like object rfile, once its
+	    FRAME_MARKER has been consumed. Returns the metadata with
+	    the ndarrays reconstructed.
+	"""
+	def read(n):
+		data = rfile.read(n)
+		if len(data) != n:
+			raise RPCError("Connection closed")
+		return data
+
+	jslen, nbuf = _frame_header.unpack(read(_frame_header.size))
+	lens = struct.unpack('<%dQ' % nbuf, read(8*nbuf))
+	js = read(jslen)
+	buffers = [ read(n) for n in lens ]
+
+	def hook(obj):
+		if '__ndarray__' in obj:
+			dtype, shape = _descr_to_dtype(obj['dtype']), tuple(obj['shape'])
+			data = buffers[obj['__ndarray__']]
+			if not len(data):
+				return np.empty(shape, dtype=dtype)
+			return np.fromstring(data, dtype=dtype).reshape(shape)
+		return obj
+	return _unicode_to_str(json.loads(js, object_hook=hook))
+
 class RPCError(Exception):
 	def __init__(self, msg, *args, **kwargs):
 		Exception.__init__(self, msg, *args, **kwargs)
@@ -80,6 +171,7 @@ class SimpleAccessControl:
 class PyRPCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 	funcs = None		# Function name->Callable dictionary
 	instances = None	# Object instances with functions
+	_tls = None		# Per-connection (thread-local) state
 
 	timeout = float(os.getenv("PYRPCTIMEOUT", "30."))		# Timeout before the connection is presumed dead and dropped
 
@@ -87,6 +179,13 @@ class PyRPCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 		socketserver.TCPServer.__init__(self, (host, port), PyRPCHandler, *args, **kwargs)
 		self.funcs = dict()
 		self.instances = set()
+		self._tls = threading.local()
+
+	def client_address(self):
+		""" Return the address of the client whose call is being
+		    dispatched (to be called from within the called function).
+		"""
+		return self._tls.client_address
 
 	def _get_func(self, func):
 		""" Get a pointer to the named function """
@@ -145,7 +244,7 @@ class PyRPCHandler(socketserver.StreamRequestHandler):
 	creds = Credentials()		# The currently logged-in users' credentials
 
 	def encode(self, v):
-		return escape_nl(json.dumps(v))
+		return escape_nl(json.dumps(v, default=_json_default))
 
 	def decode(self, v):
 		return _unicode_to_str(json.loads(unescape_nl(v)))
@@ -157,6 +256,9 @@ class PyRPCHandler(socketserver.StreamRequestHandler):
 		self.formatted_addr = "%s:%s" % self.client_address
 		logger.info("[%s] Connection opened" % self.formatted_addr)
 
+		# Each connection is handled in its own thread
+		self.server._tls.client_address = self.client_address
+
 		# Call __connect__ hook in server
 		self.server.on_connect(self.client_address)
 
@@ -172,13 +274,59 @@ class PyRPCHandler(socketserver.StreamRequestHandler):
 
 		return socketserver.StreamRequestHandler.finish(self)
 
+	def _call(self, func, args):
+		# Check for authorization
+		if func[0] == '_' or not self.server.on_auth(self.creds, func):
+			raise RPCError("Access denied")
+
+		# Call the function
+		result = self.server._dispatch(func, args)
+
+		# Check for special results
+		if isinstance(result, Credentials):
+			self.creds, result = result, len(result) != 0
+
+		return result
+
+	def handle_frame(self):
+		# A binary frame. Requests are answered in the order they
+		# were received, tagged by their sequence numbers, so the
+		# clients may pipeline them.
+		req = recv_frame(self.rfile)
+		func, args, seq = req['func'], req['args'], req['seq']
+		logger.info("[%s] CALL %s (#%d)" % (self.formatted_addr, func, seq))
+
+		try:
+			result, status = self._call(func, args), "RESULT"
+		except Exception as e:
+			result, status = str(e), "FAULT"
+		logger.info("[%s] %s (#%d)" % (self.formatted_addr, status, seq))
+
+		try:
+			send_frame(self.connection, dict(seq=seq, status=status, result=result))
+		except (TypeError, ValueError) as e:
+			# The result could not be serialized (nothing has
+			# been sent yet)
+			send_frame(self.connection, dict(seq=seq, status="FAULT", result=str(e)))
+
 	def handle(self):
 		# Wait for procedure call requests
 		while True:
 			try:
-				line = self.rfile.readline()
-				if line == '': break			# Client hung up
-
+				c = self.rfile.read(1)
+				if c == '': break			# Client hung up
+
+				if c == FRAME_MARKER:
+					try:
+						self.handle_frame()
+					except socket.timeout:
+						raise
+					except (socket.error, RPCError) as e:
+						logger.info("[%s] Connection error (%s)" % (self.formatted_addr, e))
+						break
+					continue
+
+				line = c if c == '\n' else c + self.rfile.readline()
 				line = line.strip()
 				if len(line) == 0:
 					logger.info("[%s] HEARTBEAT" % (self.formatted_addr,))
@@ -188,17 +336,8 @@ class PyRPCHandler(socketserver.StreamRequestHandler):
 				func, args = tokens[:2]
 				logger.info("[%s] CALL %s %s" % (self.formatted_addr, func, args))
 
-				# Check for authorization
-				if func[0] == '_' or not self.server.on_auth(self.creds, func):
-					raise RPCError("Access denied")
-
 				# Parse the arguments and call the function
-				args = self.decode(args)
-				result = self.server._dispatch(func, args)
-
-				# Check for special results
-				if isinstance(result, Credentials):
-					self.creds, result = result, len(result) != 0
+				result = self._call(func, self.decode(args))
 
 				# Return the result
 				self.rpc_return("RESULT", result)
@@ -217,16 +356,21 @@ class PyRPCProxy(object):
 	_wfile = None	# file-like object for writing from socket
 	_lock = None	# lock protecting rfile/wfile/sock
 
-	_heatbeat_interval = None	# The interval in which to send heartbeats to the server
+	_heatbeat_interval = None	# The interval in which to send heartbeats to the server (None: don't)
 	_hbeat_run = True		# Whether to run a heartbeat thread or not
 	_hbeat = None			# The heatbeat timer thread
 
-	def __init__(self, host, port, heartbeat_interval=5.):
+	_binary = True			# Whether to use binary frames (or the line protocol)
+	_seq = None			# Sequence number generator for binary frames
+
+	def __init__(self, host, port, heartbeat_interval=5., binary=True):
 		# Set up the call lock
 		self._lock = threading.Lock()
 		self._addr = (host, port)
 		self._heartbeat_interval = heartbeat_interval
 		self._hbeat_run = False
+		self._binary = binary
+		self._seq = itertools.count()
 
 		#self._connect()
 
@@ -239,8 +383,9 @@ class PyRPCProxy(object):
 			self._wfile = self._sock.makefile('wb', 0)
 
 			# Start the hearbeat thread
-			self._hbeat_run = True
-			self._heartbeat()
+			if self._heartbeat_interval:
+				self._hbeat_run = True
+				self._heartbeat()
 
 	# Deletion/closure of proxy object
 	def close(self):
@@ -271,6 +416,8 @@ class PyRPCProxy(object):
 	def _heartbeat(self):
 		try:
 			with self._lock:
+				if self._wfile is None:
+					return
 				self._wfile.write("\n")
 
 				# Schedule next firing
@@ -297,8 +444,22 @@ class PyRPCProxy(object):
 		def __call__(self, *args):
 			return self.__call(self.__func, args)
 
+	def _send_request(self, seq, func, args):
+		send_frame(self._sock, dict(seq=seq, func=func, args=args))
+
+	def _recv_response(self, seq):
+		if self._rfile.read(1) != FRAME_MARKER:
+			raise RPCError("Connection closed")
+		resp = recv_frame(self._rfile)
+		if resp['seq'] != seq:
+			raise RPCError("Out of sequence response (#%d, expected #%d)" % (resp['seq'], seq))
+		return resp['status'], resp['result']
+
 	def __call(self, func, args):
-		a = escape_nl(json.dumps(args))
+		if self._binary:
+			return self.pipeline([(func, args)])[0]
+
+		a = escape_nl(json.dumps(args, default=_json_default))
 
 		try:
 			self._connect()
@@ -307,6 +468,7 @@ class PyRPCProxy(object):
 				line = self._rfile.readline().strip()	# Response
 		except socket.error as e:
 			# Pass any socket error as RPCError
+			self.close()
 			raise RPCError(str(e))
 
 		# Check if the server hung up on us
@@ -321,9 +483,138 @@ class PyRPCProxy(object):
 
 		raise RPCError(data)
 
+	def pipeline(self, calls):
+		""" Call a sequence of remote functions, given as a list
+		    of (func, args) tuples, without waiting for the result
+		    of one call before issuing the next.
+
+		    Returns the list of results. If any of the calls
+		    failed, raises an RPCError once all results have been
+		    received. Requires binary frames.
+		"""
+		if not self._binary:
+			raise RPCError("Pipelined calls require binary frames")
+
+		results, faults = [], []
+		try:
+			self._connect()
+			with self._lock:
+				seqs = [ self._seq.next() for _ in calls ]
+
+				# Send the requests from a separate thread, so
+				# that the server never blocks on writing results
+				# that we're not reading yet
+				sender = None
+				if len(calls) > 1:
+					errors = []
+					def send():
+						try:
+							for seq, (func, args) in zip(seqs, calls):
+								self._send_request(seq, func, list(args))
+						except socket.error as e:
+							errors.append(e)
+					sender = threading.Thread(target=send)
+					sender.daemon = True
+					sender.start()
+				else:
+					self._send_request(seqs[0], calls[0][0], list(calls[0][1]))
+
+				for seq in seqs:
+					status, result = self._recv_response(seq)
+					results.append(result)
+					if status != "RESULT":
+						faults.append(result)
+
+				if sender is not None:
+					sender.join()
+					if errors:
+						raise errors[0]
+		except (socket.error, RPCError) as e:
+			# Pass any socket error as RPCError; the connection
+			# is in an unknown state, so drop it
+			self.close()
+			raise RPCError(str(e))
+
+		if faults:
+			raise RPCError(faults[0])
+
+		return results
+
 	def __getattr__(self, func):
 		return self._Method(self.__call, func)
 
+class PyRPCProxyPool(object):
+	""" A thread-safe pool of connections to a PyRPC server.
+
+	    Calls made through the pool (in the same way as through a
+	    PyRPCProxy) are run on a connection not in use by any other
+	    thread; new connections are opened as needed, up to maxsize
+	    connections. Instead of a heartbeat thread per connection,
+	    a single timer keeps the idle connections alive.
+	"""
+	_idle = None		# Connections not in use by any thread
+	_nconn = 0		# Number of open connections
+	_cond = None		# Condition variable protecting the above
+	_hbeat = None		# The heartbeat timer thread
+
+	def __init__(self, host, port, maxsize=8, heartbeat_interval=5.):
+		self._addr = (host, port)
+		self._maxsize = maxsize
+		self._heartbeat_interval = heartbeat_interval
+		self._idle = []
+		self._cond = threading.Condition()
+		self._heartbeat()
+
+	def _acquire(self):
+		with self._cond:
+			while not self._idle and self._nconn >= self._maxsize:
+				self._cond.wait()
+			if self._idle:
+				return self._idle.pop()
+			self._nconn += 1
+		return PyRPCProxy(self._addr[0], self._addr[1], heartbeat_interval=None)
+
+	def _release(self, proxy):
+		with self._cond:
+			self._idle.append(proxy)
+			self._cond.notify()
+
+	def _heartbeat(self):
+		with self._cond:
+			for proxy in self._idle:
+				proxy._heartbeat()
+
+			if self._heartbeat_interval:
+				self._hbeat = threading.Timer(self._heartbeat_interval, self._heartbeat)
+				self._hbeat.daemon = True
+				self._hbeat.start()
+
+	def close(self):
+		with self._cond:
+			if self._hbeat:
+				self._hbeat.cancel()
+				self._hbeat = None
+			self._heartbeat_interval = None
+
+			for proxy in self._idle:
+				proxy.close()
+			self._nconn -= len(self._idle)
+			del self._idle[:]
+
+	def pipeline(self, calls):
+		""" See PyRPCProxy.pipeline() """
+		proxy = self._acquire()
+		try:
+			return proxy.pipeline(calls)
+		finally:
+			self._release(proxy)
+
+	def __call(self, func, args):
+		return self.pipeline([(func, args)])[0]
+
+	def __getattr__(self, func):
+		return PyRPCProxy._Method(self.__call, func)
+
 ########### Unit tests
 
 def test_unicode_to_str():
@@ -343,6 +634,33 @@ def test_escape_nl():
 
 		assert us == s
 
+def test_frame():
+	"send_frame/recv_frame"
+	import StringIO
+	class Sock(list):
+		def sendall(self, data):
+			self.append(str(data))
+
+	rows = np.zeros(5, dtype=[('a', 'i4'), ('b', 'f8', (3,)), ('c', [('x', 'u1'), ('y', 'a5')])])
+	rows['a'] = np.arange(5)
+	rows['b'] = np.arange(15).reshape(5, 3)
+	rows['c']['y'] = 'foo'
+	meta = dict(seq=1, result=[rows, np.arange(6, dtype='>i2').reshape(2, 3), np.empty(0), np.float32(1.5), 'foo\nbar'])
+
+	sock = Sock()
+	send_frame(sock, meta)
+	rfile = StringIO.StringIO(''.join(sock))
+	assert rfile.read(1) == FRAME_MARKER
+	meta2 = recv_frame(rfile)
+
+	r = meta2['result']
+	assert r[0].dtype == rows.dtype and (r[0] == rows).all()
+	assert r[1].dtype == np.dtype('>i2') and r[1].shape == (2, 3) and (r[1] == np.arange(6).reshape(2, 3)).all()
+	assert r[2].shape == (0,)
+	assert r[3] == 1.5
+	assert r[4] == 'foo\nbar' and type(r[4]) == str
+	assert rfile.read() == ''
+
 class TestPyRPCProxy:
 	host, port = "localhost", 0
 
@@ -387,6 +705,60 @@ class TestPyRPCProxy:
 
 		svr.close()
 
+	def test_line_protocol(self):
+		""" PyRPCProxy: Line protocol """
+		svr = PyRPCProxy(self.host, self.port, binary=False)
+
+		assert svr.login("mjuric", "bla")
+		assert svr.foo(10) == 52
+		assert svr.arange(3) == [0, 1, 2]
+		for s in ['true', '\n', '\\n', '[ a, "foo\nbar"]\nSomething else', 'B\\\nla\nGla\\\n']:
+			assert svr.echo(s) == s
+
+		svr.close()
+
+	def test_pipeline(self):
+		""" PyRPCProxy: Pipelined calls and arrays """
+		svr = PyRPCProxy(self.host, self.port)
+
+		assert svr.login("mjuric", "bla")
+		a = svr.echo(np.arange(10, dtype='f4'))
+		assert a.dtype == np.dtype('f4') and (a == np.arange(10)).all()
+
+		results = svr.pipeline([ ('arange', (n,)) for n in xrange(0, 1000000, 100000) ])
+		for n, a in zip(xrange(0, 1000000, 100000), results):
+			assert (a == np.arange(n)).all()
+
+		try:
+			svr.pipeline([ ('bar', ()), ('nonexistent', ()), ('bar', ()) ])
+			assert 0, "Should have failed"
+		except RPCError:
+			pass
+		assert svr.bar() == "bar"
+
+		svr.close()
+
+	def test_pool(self):
+		""" PyRPCProxyPool: Concurrent calls """
+		pool = PyRPCProxyPool(self.host, self.port, maxsize=3)
+
+		errors = []
+		def run():
+			try:
+				for _ in xrange(20):
+					# Credentials are per-connection, so log in
+					# on the same connection as the call
+					assert pool.pipeline([('login', ('mjuric', 'bla')), ('bla', ())]) == [True, "Bla!"]
+			except Exception as e:
+				errors.append(e)
+		threads = [ threading.Thread(target=run) for _ in xrange(10) ]
+		[ th.start() for th in threads ]
+		[ th.join() for th in threads ]
+
+		assert not errors, errors
+		assert pool._nconn <= 3
+		pool.close()
+
 
 	def test_timeout(self):
 		""" PyRPCProxy: Timeouts """
@@ -469,6 +841,9 @@ class A(object):
 	def echo(self, s):
 		return s
 
+	def arange(self, n):
+		return np.arange(n)
+
 	def shutdown(self):
 		self._server.shutdown()
 
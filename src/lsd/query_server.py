@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+A long-running LSD query service.
+
+Every lsd-query invocation pays for opening the database, loading
+the UDFs, table schemas and catalogs, before it can run a single
+query. For small (e.g., cone search) queries that start-up cost
+dominates the runtime. The QueryServer keeps a DB instance (and,
+through it, the Table instances with their catalogs and open tablet
+handles) alive between queries, and is exported over PyRPC (see
+lsd-query-server). Clients submit the query text and bounds with
+execute(), and stream the results back block-by-block with
+fetch_block(). The blocks travel as raw ndarray buffers in pyrpc's
+binary frames. QueryClient wraps this protocol on the client side,
+and is what lsd-query --server=host:port uses.
+
+The worker processes are started once, with the server (before it
+starts any threads), and kept for its lifetime. Only one query runs
+on them at a time; queries submitted while they're busy run in the
+thread serving the request.
+"""
+
+import os
+import threading
+import logging
+import time
+import itertools
+import numpy as np
+from collections import OrderedDict
+
+import pool2
+import readahead
+import query_parser as qp
+from join_ops import DB
+from bounds   import make_canonical, parse_bounds
+from pyrpc    import PyRPCProxy, RPCError
+
+logger = logging.getLogger('lsd.query_server')
+
+QUERY_CACHE_SIZE = int(os.getenv('LSD_QUERY_CACHE_SIZE', 100))	# Number of parsed queries kept by the server
+
+class Cursor(object):
+	""" The state of a query whose results are being streamed
+	    back to a client.
+	"""
+	def __init__(self, client_address, it, pool_lock=None):
+		self.client_address = client_address
+		self.lock = threading.Lock()
+		self.it = it
+		self.pool_lock = pool_lock	# Released once the query no longer runs on the server's pool
+		self.nrows = 0
+		self.t0 = time.time()
+
+	def close(self):
+		with self.lock:
+			if self.it is not None:
+				self.it.close()
+				self.it = None
+				if self.pool_lock is not None:
+					self.pool_lock.release()
+
+class QueryServer(object):
+	""" Runs queries against a DB that is kept open (warm)
+	    across queries.
+
+	    The DB is reopened (to see the snapshots committed in the
+	    meantime) once it is older than <refresh> seconds; with the
+	    default refresh=0, the DB is opened once and kept for the
+	    lifetime of the server. Queries with an INTO clause are not
+	    accepted -- the query service is read-only.
+	"""
+	db = None		# The (warm) DB instance
+	_cursors = None		# Cursor ID -> Cursor
+	_queries = None		# Query string -> Query instance LRU cache
+	_pool = None		# The worker processes, shared by all queries
+
+	def __init__(self, dbdir, udfs={}, refresh=0, nworkers=None):
+		self.dbdir    = dbdir
+		self.udfs     = udfs
+		self.refresh  = refresh
+		self.nworkers = nworkers
+
+		self._lock = threading.Lock()
+		self._cursors = dict()
+		self._cursor_ids = itertools.count(1)
+		self._open_db()
+
+		# Start the workers now, as forking once the server is
+		# serving requests from multiple threads isn't safe
+		self._pool = pool2.Pool(nworkers)
+		self._pool_lock = threading.Lock()
+		if self._pool.nslots > 1:
+			self._pool._create_workers()
+
+	def _open_db(self):
+		db = DB(self.dbdir)
+		for name, code in self.udfs.iteritems():
+			g = db.get_globals()
+			db.register_udf(eval(code, g), name)
+
+		self.db = db
+		self._queries = OrderedDict()
+		self._opened = time.time()
+		logger.info("Opened database %s (snapshot %s)" % (self.dbdir, db.snapid))
+
+	def _query(self, query):
+		# Return a (cached) Query instance. Must be called with
+		# the lock held.
+		if self.refresh and time.time() - self._opened > self.refresh:
+			self._open_db()
+
+		q = self._queries.pop(query, None)
+		if q is None:
+			(_, _, _, into_clause) = qp.parse(query)
+			if into_clause is not None:
+				raise Exception("Queries with an INTO clause cannot be run through the query server.")
+			q = self.db.query(query)
+
+		self._queries[query] = q
+		while len(self._queries) > QUERY_CACHE_SIZE:
+			self._queries.popitem(last=False)
+		return q
+
+	def _cursor(self, cursor_id):
+		with self._lock:
+			try:
+				return self._cursors[cursor_id]
+			except KeyError:
+				raise Exception("Unknown cursor %s" % cursor_id)
+
+	def __disconnect__(self, client_address):
+		# Close all cursors left open by the client
+		with self._lock:
+			cursors = [ (cid, c) for cid, c in self._cursors.iteritems() if c.client_address == client_address ]
+			for cid, _ in cursors:
+				del self._cursors[cid]
+		for _, c in cursors:
+			c.close()
+
+	def execute(self, query, bounds=None, testbounds=True, include_cached=False, yield_empty=False):
+		""" Start executing a query, returning the ID of the
+		    cursor with which to fetch its results.
+
+		    bounds      -- the bounds, in the syntax of lsd-query's
+		                   --bounds option (e.g., "beam(10, 20, 0.1)")
+		    yield_empty -- return empty blocks as well (useful to
+		                   learn the dtype of an empty result)
+		"""
+		if bounds is not None:
+			bounds = make_canonical(parse_bounds(bounds))
+
+		with self._lock:
+			q = self._query(query)
+
+		# Run on the workers if no other query is using them, and
+		# in this thread otherwise
+		if self._pool_lock.acquire(False):
+			pool, pool_lock = self._pool, self._pool_lock
+		else:
+			pool, pool_lock = pool2.Pool(1, 1), None
+
+		it = q.iterate(bounds, testbounds=testbounds, include_cached=include_cached, return_blocks=True,
+			pool=pool, progress_callback=pool2.progress_pass, _yield_empty=yield_empty)
+
+		with self._lock:
+			cursor_id = self._cursor_ids.next()
+			self._cursors[cursor_id] = Cursor(self._server.client_address(), it, pool_lock)
+
+		logger.info("[%s] %s: %s" % (cursor_id, bounds, query))
+		return cursor_id
+
+	def fetch_block(self, cursor_id):
+		""" Return the next block of results of a query, or None
+		    once all results have been returned (at which point
+		    the cursor is closed).
+		"""
+		c = self._cursor(cursor_id)
+		with c.lock:
+			try:
+				rows = next(c.it)
+			except StopIteration:
+				rows = None
+
+		if rows is None:
+			self.close_cursor(cursor_id)
+			logger.info("[%s] %d rows in %.2f sec (readahead=%s)" % (cursor_id, c.nrows, time.time() - c.t0, readahead.policy()))
+			return None
+
+		c.nrows += len(rows)
+		if not isinstance(rows, np.ndarray):
+			rows = rows.as_ndarray()
+		return rows
+
+	def close_cursor(self, cursor_id):
+		""" Abandon a query, before all of its results were fetched """
+		with self._lock:
+			c = self._cursors.pop(cursor_id, None)
+		if c is not None:
+			c.close()
+		return True
+
+class QueryClient(object):
+	""" Client-side interface to a QueryServer """
+	def __init__(self, host, port):
+		self._server = PyRPCProxy(host, port)
+
+	def iterate(self, query, bounds=None, testbounds=True, include_cached=False, yield_empty=False):
+		""" Yield the results of a query as blocks of rows
+		    (structured ndarrays).
+
+		    bounds -- string with the bounds, in the syntax of
+		              lsd-query's --bounds option
+		"""
+		cursor_id = self._server.execute(query, bounds, testbounds, include_cached, yield_empty)
+		done = False
+		try:
+			while True:
+				block = self._server.fetch_block(cursor_id)
+				if block is None:
+					done = True
+					break
+				yield block
+		finally:
+			if not done:
+				try:
+					self._server.close_cursor(cursor_id)
+				except RPCError:
+					pass
+
+	def close(self):
+		self._server.close()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Readahead policies for tablets opened for reading.
+
+Tablets are read with many small, scattered, reads (by HDF5); on
+networked filesystems these are far faster if the file has been
+brought into the page cache beforehand. The policy is chosen with the
+LSD_READAHEAD environment variable:
+
+	none    -- do nothing (let the OS/filesystem decide)
+	fadvise -- ask the kernel to read the file in the background,
+	           with posix_fadvise(POSIX_FADV_WILLNEED) (default)
+	whole   -- read the entire file (in blocks of READ_BLOCK bytes),
+	           discarding the data
+
+Additional policies can be registered in the policies dict.
+"""
+
+import os
+import logging
+import ctypes, ctypes.util
+
+logger = logging.getLogger('lsd.readahead')
+
+READ_BLOCK = 1024*1024
+POSIX_FADV_WILLNEED = 3
+
+# Python 2 has no os.posix_fadvise, so call it through ctypes
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	_posix_fadvise = _libc.posix_fadvise
+	_posix_fadvise.argtypes = [ ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int ]
+except (OSError, AttributeError):
+	_posix_fadvise = None
+
+def readahead_none(fn):
+	pass
+
+def readahead_fadvise(fn):
+	if _posix_fadvise is None:
+		return readahead_whole(fn)
+
+	fd = os.open(fn, os.O_RDONLY)
+	try:
+		_posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+	finally:
+		os.close(fd)
+
+def readahead_whole(fn):
+	with open(fn, 'rb') as fp:
+		while fp.read(READ_BLOCK):
+			pass
+
+policies = {
+	'none':    readahead_none,
+	'fadvise': readahead_fadvise,
+	'whole':   readahead_whole,
+}
+
+def policy():
+	""" Return the name of the readahead policy in effect """
+	name = os.getenv('LSD_READAHEAD', 'fadvise')
+	if name not in policies:
+		raise Exception("Unknown readahead policy LSD_READAHEAD=%s (must be one of %s)" % (name, ', '.join(sorted(policies))))
+	if name == 'fadvise' and _posix_fadvise is None:
+		return 'whole'
+	return name
+
+def readahead(fn):
+	""" Prepare the file fn for reading, according to the
+	    readahead policy in effect.
+	"""
+	policies[policy()](fn)
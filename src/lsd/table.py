@@ -17,15 +17,155 @@ import copy
 import glob
 import shutil
 import errno
+import socket
 from table_catalog import TableCatalog
 from utils        import is_scalar_of_type
 from pixelization import Pixelization
 from collections  import OrderedDict
 from contextlib   import contextmanager
 from colgroup     import ColGroup
+from readahead    import readahead
+from npytablet    import NpyTablet
+import npytablet
 
 logger = logging.getLogger("lsd.table")
 
+# If set, cells are locked through the lock manager located by this
+# .url file (see transman.LockManager), instead of with lockfiles
+LOCKSERVER = os.getenv("LSD_LOCKSERVER")
+
+_lock_manager = None	# (pid, LockManager) tuple, see _get_lock_manager()
+
+# If set, writing to a cell whose tablet is in an older snapshot creates
+# a delta tablet (holding only the new rows, and a bitmap of deleted base
+# rows) instead of copying the whole tablet into the new snapshot. See
+# Table._read_merged() and Table.compact().
+DELTA_TABLETS = os.getenv("LSD_DELTA_TABLETS", "1") != "0"
+
+# The expectedrows (from which PyTables derives the chunk shape) of new
+# HDF5 tablets, for tables that haven't been committed yet (otherwise, it
+# is derived from the mean number of rows per cell; see _default_expectedrows)
+EXPECTEDROWS     = 20*1000*1000
+MIN_EXPECTEDROWS = 10*1000
+
+def _get_lock_manager():
+	""" Return the LockManager of this process, connecting to (or
+	    spawning) the lock server on first use.
+	"""
+	global _lock_manager
+	if _lock_manager is None or _lock_manager[0] != os.getpid():
+		import transman
+		_lock_manager = (os.getpid(), transman.LockManager(LOCKSERVER))
+	return _lock_manager[1]
+
+# The row map column of sparse cgroup tablets: the primary key of the
+# row each stored row belongs to
+SPARSE_ROWKEY = '_ROWKEY'
+
+def _insertion_points(id1, id2):
+	"""
+	Find where rows with keys id2 go in a tablet with keys id1
+	(the "find-insertion-points" idiom; if only np.in1d returned
+	indices...)
+
+	Returns (idx, nnew), where idx are the positions of the rows
+	(existing rows are updated in place, new ones are placed past
+	the end), and nnew the number of new rows. If all rows are new,
+	returns (slice(None), None).
+	"""
+	ii = id1.argsort()
+	id1 = id1[ii]
+	idx = np.searchsorted(id1, id2)
+
+	# If this is a pure append, unset idx
+	if np.min(idx) == len(id1):
+		return slice(None), None
+
+	# Find rows which will be added, and those which will be updated
+	in_      = idx < len(id1)		    # Rows with IDs less than the maximum existing one
+	app      = np.ones(len(id2), dtype=np.bool)
+	app[in_] = id1[idx[in_]] != id2[in_]	 # These rows will be appended
+	nnew     = app.sum()
+
+	# Reindex new rows past the end
+	idx[app] = np.arange(len(id1), len(id1)+nnew)
+
+	# Reindex existing rows to unsorted id1 ordering
+	napp = ~app
+	idx[napp] = ii[idx[napp]]
+
+	return idx, nnew
+
+def _get_delta(fp):
+	"""
+	Return (base_snapid, tombstones) if the tablet open in fp is
+	a delta tablet, and None otherwise.
+	"""
+	if 'delta' not in fp.root:
+		return None
+
+	if isinstance(fp, NpyTablet):
+		return npytablet.get_delta(fp.filename)
+
+	g = fp.root.delta
+	return g._v_attrs.base_snapid, g.tombstones.read()
+
+def _set_delta(fp, base_snapid, tombstones):
+	"""
+	Make the tablet open in fp a delta of the tablet in snapshot
+	base_snapid, with the given tombstone bitmap (one entry per
+	row of the base, True for rows that have been deleted).
+	"""
+	base_snapid = str(base_snapid)
+	if isinstance(fp, NpyTablet):
+		return npytablet.set_delta(fp.filename, base_snapid, tombstones)
+
+	if 'delta' in fp.root:
+		fp.removeNode('/', 'delta', recursive=True)
+
+	# An EArray, as a plain Array can't be zero-length
+	t = fp.createEArray('/delta', 'tombstones', tables.BoolAtom(), (0,), createparents=True, expectedrows=max(len(tombstones), 1))
+	if len(tombstones):
+		t.append(np.asarray(tombstones, dtype=bool))
+	fp.root.delta._v_attrs.base_snapid = base_snapid
+
+def _concat_rows(dtype, blocks):
+	"""
+	Concatenate blocks of rows (structured ndarrays or ColGroups)
+	into a newly allocated structured ndarray of the given dtype.
+	"""
+	rows = np.empty(sum(len(b) for b in blocks), dtype=dtype)
+	at = 0
+	for b in blocks:
+		for name in dtype.names:
+			rows[name][at:at+len(b)] = b[name]
+		at += len(b)
+	return rows
+
+def _read_table_into(t, out):
+	""" Read the rows of PyTables table t into the preallocated
+	    array out.
+	"""
+	if len(out) == 0:
+		return
+	try:
+		t.read(out=out)
+	except TypeError:
+		# PyTables < 3.0 has no out= argument
+		out[:] = t.read()
+
+def _read_group_into(t, out):
+	""" Read the rows of table t (a PyTables or npy tablet table)
+	    into the preallocated structured array out.
+	"""
+	if len(out) == 0:
+		return
+	if isinstance(t, tables.Table) and t.dtype == out.dtype:
+		_read_table_into(t, out)
+	else:
+		for name in out.dtype.names:
+			out[name] = t.col(name)
+
 class BLOBAtom(tables.ObjectAtom):
 	"""
 	A PyTables atom representing BLOBs
@@ -71,10 +211,12 @@ class Table:
 				# t0: default starting epoch (== 2pm HST, Aug 22 2007 (night of GPC1 first light))
 				# td: default temporal resolution (in days)
 	_nrows = 0		#: The number of rows in the table (use nrows() to access)
+	_rows_per_cell = None	#: The mean number of rows in a (non-empty) cell, as of the last commit
 
 	_cgroups = None		#: Column groups in the table ( OrderedDict of table definitions (dicts), keyed by tablename; the first table is the primary one)
 	_fgroups = None		#: Map of file group name -> file group definition. File groups define where and how external blobs are stored.
 	_filters = None		#: Default PyTables filters to be applied to every Leaf in the file (can be overridden on per-tablet and per-blob basis)
+	_storage = 'hdf5'	#: Default tablet storage backend, 'hdf5' or 'npy' (can be overridden on per-cgroup basis)
 	_commit_hooks = None	#: List of hooks to be called upon COMMIT
 
 	columns        = None	#: OrderedDict of ColumnType objects describing the columns in the table
@@ -86,6 +228,7 @@ class Table:
 	snapid         = 0      #: Snapshot ID of the opened table
 	_snapshots     = [ 0 ]  #: Sorted (newest to oldest) list of available, committed, snapshots
 	transaction    = False  #: True if we're in a transaction (the current snapshot is writable)
+	_manifest_cells = None  #: Cells this process has recorded in the manifest of the open transaction
 
 	_default_commit_hooks = [('Updating neighbors', 0, 'lsd.tasks', 'build_neighbor_cache')] #: Default commit hook rebuilds the neighbor cache
 
@@ -115,12 +258,20 @@ class Table:
 			for snapid in snapids:
 				local = self._snapshot_path(snapid) + '/'
 				utils.mkdir_p(local)
-				for fn in ['catalog.pkl', 'schema.cfg', '.committed']:
+				for fn in ['catalog.mmap', 'schema.cfg', '.committed']:
 					if str(snapid) == "0" and fn == '.committed':	# Backwards compatibility
 						continue
+					if fn == 'catalog.mmap' and os.path.exists(local + 'catalog.pkl'):
+						continue
 					local_fn = local + fn
 					if not os.path.exists(local_fn):
-						self.fetch_from_remote(local_fn)
+						try:
+							self.fetch_from_remote(local_fn)
+						except IOError:
+							if fn != 'catalog.mmap':
+								raise
+							# Snapshots committed by older versions of LSD have a pickled catalog
+							self.fetch_from_remote(local + 'catalog.pkl')
 
 		self._snapshots = self.list_snapshots(snapid)
 		# Sorted list of snapshots, newest first
@@ -139,9 +290,12 @@ class Table:
         def _load_catalog(self):
 		# Load the tablet cache.
 		#
-		tabtreepkl = self._find_metadata_path('catalog.pkl')
-		if os.path.isfile(tabtreepkl):
-			self.catalog = TableCatalog(fn=tabtreepkl)
+		tabtreefn = self._find_metadata_path('catalog.mmap')
+		if not os.path.isfile(tabtreefn):
+			# Snapshots committed by older versions of LSD have a pickled catalog
+			tabtreefn = self._find_metadata_path('catalog.pkl')
+		if os.path.isfile(tabtreefn):
+			self.catalog = TableCatalog(fn=tabtreefn)
 		elif os.path.isdir(os.path.join(self.path, 'tablets')) and not os.path.isdir(os.path.join(self.path, 'tablets', 'snapshots')):
 			# Backwards compatibility: Auto-create it for old-style (pre v0.4) tables
 		        assert self._snapshots[0] == 0
@@ -156,7 +310,19 @@ class Table:
 	def get_cells_in_snapshot(self, snapid, include_cached=True):
 		return self.catalog.get_cells_in_snapshot(snapid, include_cached=include_cached)
 
-	def rebuild_catalog(self, rebuild_pre_v050_snap=False):
+	def rebuild_catalog(self, rebuild_pre_v050_snap=False, rescan=False):
+		""" Update the tablet catalog with the cells written to in
+		    the open transaction.
+
+		    The cells recorded in the transaction's manifests are
+		    merged into the catalog (the manifests are removed at
+		    commit); an empty manifest directory means no cells
+		    were modified (e.g., only the schema was changed). The
+		    tablet tree is rescanned in full only if rescan=True
+		    (e.g., to repair the catalog), or if the snapshot has
+		    no manifest directory (it was written by an older
+		    version of LSD).
+		"""
 		self._check_transaction()
 
 		# A bit of backwards compatibility for older tables
@@ -168,12 +334,48 @@ class Table:
 
 		# Update to the requested snapshot
 		pattern = self._tablet_filename(self.primary_cgroup)
-		self.catalog.update(self.path, pattern, snapid)
+		cgroups = [ (cgroup, self._tablet_filename(cgroup)) for cgroup in self._cgroups if not self._is_pseudotablet(cgroup) ]
+		manifest = self._manifest_path(snapid)
+		if rescan or rebuild_pre_v050_snap or not os.path.isdir(manifest):
+			self.catalog.update(self.path, pattern, snapid, cgroups)
+		else:
+			manifests = glob.glob(os.path.join(manifest, '*'))
+			cells = set()
+			for fn in manifests:
+				cells.update(int(line) for line in open(fn) if line.strip())
+			self.catalog.update_cells(self.path, pattern, snapid, cells, cgroups)
 
 		# Save
-		fn = os.path.join(self._snapshot_path(snapid), 'catalog.pkl')
+		fn = os.path.join(self._snapshot_path(snapid), 'catalog.mmap')
 		self.catalog.save(fn)
 
+		# The manifests are kept (merging them again is harmless) until
+		# the commit completes: processes still writing to this snapshot
+		# remember the cells they've already recorded, and wouldn't
+		# record them again in a fresh manifest.
+
+	def _manifest_path(self, snapid):
+		""" The directory with the manifests of cells modified in snapshot snapid """
+		return os.path.join(self._snapshot_path(snapid), '.manifest')
+
+	def _record_in_manifest(self, cell_id):
+		"""
+		Record that cell_id is being written to in the open
+		transaction.
+
+		Each process appends to its own manifest file, so no
+		locking is needed; rebuild_catalog() merges them.
+		"""
+		if cell_id in self._manifest_cells:
+			return
+
+		path = self._manifest_path(self.snapid)
+		utils.mkdir_p(path)
+		with open('%s/%s.%d' % (path, socket.gethostname(), os.getpid()), 'a') as fp:
+			fp.write('%d\n' % cell_id)
+
+		self._manifest_cells.add(cell_id)
+
 	def _check_transaction(self):
 		if not self.transaction:
 			raise Exception("Trying to modify a table without starting a transaction")
@@ -190,6 +392,7 @@ class Table:
 			raise Exception("Trying to reopen an already committed transaction")
 
 		self.transaction = True
+		self._manifest_cells = set()
 
 		if load_state:
         		# Reload state
@@ -231,8 +434,16 @@ class Table:
 			# Compute summary stats (hardwired)
 			from tasks import compute_counts
 			self._nrows = compute_counts(db, self.name)
+			ncells = len(self.get_cells(include_cached=False))
+			self._rows_per_cell = int(np.ceil(float(self._nrows) / ncells)) if ncells else None
 			self._store_schema()
 
+			# The catalog has been updated from all manifests by now
+			manifest = self._manifest_path(self.snapid)
+			if os.path.isdir(manifest):
+				shutil.rmtree(manifest)
+			self._manifest_cells = set()
+
 			# Set all files read only
 			print >>sys.stderr, "[%s] Marking tablets read-only..." % self.name
 			path = os.path.abspath(self._snapshot_path(self.snapid))
@@ -358,6 +569,10 @@ class Table:
 
 		if create:
 			utils.mkdir_p(path)
+			if self.transaction and path != self.path and str(snapid) == str(self.snapid):
+				# Mark the snapshot as one whose modified cells are
+				# recorded in manifests (see rebuild_catalog)
+				utils.mkdir_p(os.path.join(path, '.manifest'))
 
 		return path
 
@@ -373,10 +588,47 @@ class Table:
 
 		return '%s/tablets/%s' % (self._snapshot_path(snapid), self.pix.path_to_cell(cell_id))
 
+	def is_sparse_cgroup(self, cgroup):
+		"""
+		Return True if cgroup is sparse.
+
+		Tablets of a sparse cgroup (one with 'sparse': True in its
+		schema) store only the rows that were given values for the
+		cgroup's columns, together with an explicit row map (the
+		SPARSE_ROWKEY column, with the primary keys of the rows).
+		Rows of other cgroups are aligned with the primary cgroup's
+		rows by position.
+		"""
+		return self._get_schema(cgroup).get('sparse', False)
+
+	def _tablet_dtype(self, cgroup):
+		""" Return the dtype of rows stored in tablets of cgroup """
+		columns = self._get_schema(cgroup)['columns']
+		if self.is_sparse_cgroup(cgroup):
+			columns = columns + [ (SPARSE_ROWKEY, 'u8') ]
+		return np.dtype(columns)
+
+	def _tablet_storage(self, cgroup):
+		""" Return the storage backend of the tablets of the given cgroup """
+		storage = self._get_schema(cgroup).get('storage', self._storage)
+		if storage not in ['hdf5', 'npy']:
+			raise Exception("Unknown tablet storage '%s' for cgroup %s" % (storage, cgroup))
+		return storage
+
 	def _tablet_filename(self, cgroup):
 		""" Return the filename of a tablet of the given cgroup """
+		if self._tablet_storage(cgroup) == 'npy':
+			return '%s.%s.cols' % (self.name, cgroup)
 		return '%s.%s.h5' % (self.name, cgroup)
 
+	def _open_tablet_file(self, fn, cgroup, mode):
+		""" Open the tablet file (or directory) fn of the given cgroup,
+		    with the appropriate storage backend.
+		"""
+		if self._tablet_storage(cgroup) == 'npy':
+			return NpyTablet(fn, self._tablet_dtype(cgroup), mode=mode)
+		return tables.openFile(fn, mode=mode)
+
 	def _tablet_file(self, cell_id, cgroup, mode='r'):
 		"""
 		Return the full path to the tablet of the given cgroup
@@ -414,6 +666,11 @@ class Table:
 		Return True if the given tablet exists in cell_id. For
 		pseudo-cgroups check the existence of primary_cgroup.
 
+		The catalog records which cgroups have tablets in each
+		cell, so the filesystem is only consulted for cells
+		cataloged by older versions of LSD, cells in the snapshot
+		being written to, and for tablets that need to be fetched
+		from a remote database.
 		"""
 		if cgroup is None or self._is_pseudotablet(cgroup):
 			cgroup = self.primary_cgroup
@@ -422,9 +679,20 @@ class Table:
 
 		try:
 			fn = self._tablet_file(cell_id, cgroup)
+			exists = self.catalog.tablet_exists(cell_id, cgroup)
 		except LookupError:
 			return False
 
+		# Tablets in the snapshot being written to may have been
+		# created after the catalog was last rebuilt
+		if exists is not None and self.transaction and self.catalog.snapshot_of_cell(cell_id) == self.snapid:
+			exists = None
+
+		if exists is False:
+			return False
+		if exists and self.remote is None:
+			return True
+
 		if os.access(fn, os.R_OK):
 			return True
 		if self.remote is None:
@@ -553,6 +821,54 @@ class Table:
 		self._filters = filters
 		self._store_schema()
 
+	def set_default_storage(self, storage):
+		"""
+		Set the default tablet storage backend ('hdf5', or 'npy'
+		for memory-mappable columnar storage; see npytablet).
+		Can be overridden per-cgroup, with the 'storage' key of the
+		cgroup schema.
+
+		The new default applies only to cgroups created from now on:
+		existing cgroups keep the storage of their tablets, which is
+		recorded in their schema.
+
+		Immediately commits the change to disk.
+		"""
+		for cgroup, schema in self._cgroups.iteritems():
+			if not self._is_pseudotablet(cgroup) and 'storage' not in schema:
+				schema['storage'] = self._storage
+		self._storage = storage
+		self._store_schema()
+
+	def set_cgroup_layout(self, cgroup, filters=None, chunkshape=None, expectedrows=None):
+		"""
+		Set the PyTables filters (compression), chunk shape and/or
+		expected number of rows with which new HDF5 tablets of the
+		given cgroup will be created (see lsd-admin tune). Existing
+		tablets are not affected until rewritten (see compact()).
+
+		Immediately commits the change to disk.
+		"""
+		schema = self._get_schema(cgroup)
+		if filters is not None:
+			schema['filters'] = filters
+		if chunkshape is not None:
+			schema['chunkshape'] = list(chunkshape)
+		if expectedrows is not None:
+			schema['expectedrows'] = int(expectedrows)
+		self._store_schema()
+
+	def _default_expectedrows(self):
+		"""
+		The expectedrows of new HDF5 tablets, for cgroups whose
+		schema doesn't set it: twice the mean number of rows per
+		cell (leaving room for the cell to grow), or EXPECTEDROWS if
+		the table has not been committed yet.
+		"""
+		if not self._rows_per_cell:
+			return EXPECTEDROWS
+		return max(2 * self._rows_per_cell, MIN_EXPECTEDROWS)
+
 	def define_commit_hooks(self, hooks):
 		self._commit_hooks = hooks
 		self._store_schema()
@@ -610,6 +926,7 @@ class Table:
 
 		self.name = data["name"]
 		self._nrows = data.get("nrows", None)
+		self._rows_per_cell = data.get("rows_per_cell", None)
 
 		######################
 		# Backwards compatibility
@@ -630,6 +947,7 @@ class Table:
 
 		self._fgroups = data.get('fgroups', {})
 		self._filters = data.get('filters', {})
+		self._storage = data.get('storage', 'hdf5')
 		self._aliases = data.get('aliases', {})
 		self._commit_hooks = data.get('commit_hooks', self._default_commit_hooks)
 		
@@ -656,10 +974,12 @@ class Table:
 		data = dict()
 		data["level"], data["t0"], data["dt"] = self.pix.level, self.pix.t0, self.pix.dt
 		data["nrows"] = self._nrows
+		data["rows_per_cell"] = self._rows_per_cell
 		data["cgroups"] = [ (name, schema) for (name, schema) in self._cgroups.iteritems() if name[0] != '_' ]
 		data["name"] = self.name
 		data["fgroups"] = self._fgroups
 		data["filters"] = self._filters
+		data["storage"] = self._storage
 		data["aliases"] = self._aliases
 		data["commit_hooks"] = self._commit_hooks
 
@@ -779,6 +1099,9 @@ class Table:
 		if 'spatial_keys' in schema and 'primary_key' not in schema:
 			raise Exception('Trying to create spatial keys in a non-primary cgroup!')
 
+		if schema.get('sparse', False) and 'primary_key' in schema:
+			raise Exception('The primary cgroup cannot be sparse!')
+
 		if 'primary_key' in schema:
 			if self.primary_cgroup is not None:
 				raise Exception('Trying to create a primary cgroup ("%s") while one ("%s") already exists!' % (cgroup, self.primary_cgroup))
@@ -813,25 +1136,113 @@ class Table:
 		"""
 		self._check_transaction()
 
-		# create directory if needed
-		path = self._cell_path(cell_id, 'w')
-		if not os.path.exists(path):
-			utils.mkdir_p(path)
+		fn = self._cell_lock_name(cell_id)
 
-		fn = '%s/.__%s.lock' % (path, self.name)
+		if LOCKSERVER:
+			if not _get_lock_manager().acquire_many([fn], timeout):
+				raise locking.LockTimeout("Timed out waiting to lock %s" % (fn))
+			lock = fn
+		else:
+			# create directory if needed
+			path = os.path.dirname(fn)
+			if not os.path.exists(path):
+				utils.mkdir_p(path)
 
-		lock = locking.acquire(fn, timeout)
+			lock = locking.acquire(fn, timeout)
 		logger.debug("Acquired lock %s" % (fn))
 
 		return lock
 
+	def _lock_some_cells(self, cell_ids):
+		"""
+		Low-level: Lock at least one of the cells in cell_ids for
+		writing, waiting for them to become available if needed.
+
+		With a lock server, all cells that are available are
+		locked in a single request. Otherwise, the cells are tried
+		one by one with lockfiles.
+
+		Returns
+		-------
+		locked : list of (cell_id, lock) tuples
+		    The locked cells, and their lock handles.
+		"""
+		self._check_transaction()
+
+		if LOCKSERVER:
+			names = dict((self._cell_lock_name(cell_id), cell_id) for cell_id in cell_ids)
+			acquired = _get_lock_manager().acquire_some(names.keys(), 3600)
+			if not acquired:
+				raise Exception('Appear to be stuck on a lock!')
+			logger.debug("Acquired %d locks" % (len(acquired)))
+			return [ (names[fn], fn) for fn in acquired ]
+
+		for k in xrange(3600):
+			try:
+				cell_id = cell_ids[k % len(cell_ids)]
+
+				# Try to acquire a lock for the entire cell
+				return [ (cell_id, self._lock_cell(cell_id, timeout=1)) ]
+			except locking.LockTimeout as _:
+				pass
+		else:
+			raise Exception('Appear to be stuck on a lock file!')
+
+	def _cell_lock_name(self, cell_id):
+		# The name of the lockfile (or lock server lock) for a cell
+		return '%s/.__%s.lock' % (self._cell_path(cell_id, 'w'), self.name)
+
 	def _unlock_cell(self, lock):
 		"""
 		Unlock a previously locked cell.
 		"""
-		locking.release(lock)
+		if LOCKSERVER:
+			_get_lock_manager().release_many([lock])
+		else:
+			locking.release(lock)
 		logger.debug("Released lock %s" % (lock))
 
+	def _unlock_cells(self, locks):
+		"""
+		Unlock a list of previously locked cells.
+		"""
+		if LOCKSERVER:
+			_get_lock_manager().release_many(locks)
+		else:
+			for lock in locks:
+				locking.release(lock)
+		logger.debug("Released %d locks" % (len(locks)))
+
+	def _locked_cells(self, cell_ids):
+		"""
+		Lock the cells in cell_ids for writing, yielding (cell_id,
+		lock) tuples in the order they become available (not
+		locked by another writer). The caller unlocks each cell
+		before asking for the next one.
+
+		If the caller stops early (e.g., on an exception), the cell
+		it was given last and the cells locked but not yet yielded
+		are unlocked.
+		"""
+		cell_ids = list(cell_ids)
+		locked = []
+		lock = None
+		try:
+			while cell_ids or locked:
+				if not locked:
+					locked = self._lock_some_cells(cell_ids)
+					for cell_id, _ in locked:
+						cell_ids.remove(cell_id)
+				cell_id, lock = locked.pop(0)
+				yield cell_id, lock
+				lock = None
+		finally:
+			held = [ l for _, l in locked ]
+			if lock is not None:
+				held.append(lock)
+			if held:
+				self._unlock_cells(held)
+
 	#### Low level tablet creation/access routines. These employ no locking
 	def _get_row_group(self, fp, group, cgroup):
 		"""
@@ -853,14 +1264,22 @@ class Table:
 
 		g = getattr(fp.root, group, None)
 
-		if g is None:
+		if g is None and isinstance(fp, NpyTablet):
+			schema = self._get_schema(cgroup)
+			if 'blobs' in schema:
+				raise Exception("BLOB columns are not supported by the npy tablet storage (cgroup %s)" % cgroup)
+
+			seqname = '_seq_' + schema['primary_key'] if (group == 'main' and 'primary_key' in schema) else None
+			g = fp.createGroup(group, seqname)
+		elif g is None:
 			schema = self._get_schema(cgroup)
 
 			# cgroup
 			filters      = schema.get('filters', self._filters)
-			expectedrows = schema.get('expectedrows', 20*1000*1000)
+			expectedrows = schema.get('expectedrows', self._default_expectedrows())
+			chunkshape   = tuple(schema['chunkshape']) if 'chunkshape' in schema else None
 
-			fp.createTable('/' + group, 'table', np.dtype(schema["columns"]), createparents=True, expectedrows=expectedrows, filters=tables.Filters(**filters))
+			fp.createTable('/' + group, 'table', self._tablet_dtype(cgroup), createparents=True, expectedrows=expectedrows, chunkshape=chunkshape, filters=tables.Filters(**filters))
 			g = getattr(fp.root, group)
 
 			# Primary key sequence
@@ -903,9 +1322,18 @@ class Table:
 				if self._is_pseudotablet(cgroup):
 					continue
 				with cell.open(cgroup) as fp:
+					delta = _get_delta(fp)
+					if delta is not None and group == 'main':
+						raise Exception("Dropping the main row group of a delta tablet is not supported")
+
 					if group in fp.root:
 						fp.removeNode('/', group, recursive=True);
 
+					if delta is not None:
+						# Give the delta an (empty) neighbor cache of its own,
+						# so that the one of its base doesn't show through
+						self._get_row_group(fp, group, cgroup)
+
 	def _create_tablet(self, fn, cgroup):
 		"""
 		Create a new tablet.
@@ -924,13 +1352,78 @@ class Table:
 
 		# Create the tablet
 		logger.debug("Creating tablet %s" % (fn))
-		fp  = tables.openFile(fn, mode='w')
+		fp  = self._open_tablet_file(fn, cgroup, mode='w')
 
 		# Force creation of the main subgroup
 		self._get_row_group(fp, 'main', cgroup)
 
 		return fp
 
+	def _use_delta(self, cgroup):
+		"""
+		Return True if modifications of tablets of cgroup in older
+		snapshots should be written as delta tablets.
+
+		Tablets with BLOBs are always copied, as BLOB references
+		can't be resolved across a delta and its base.
+		"""
+		return DELTA_TABLETS and 'blobs' not in self._get_schema(cgroup)
+
+	@contextmanager
+	def _open_base(self, cell_id, cgroup, snapid):
+		"""
+		Internal: Open, read-only, the tablet of cgroup in cell_id
+		as it is in snapshot snapid (the base of a delta tablet).
+		"""
+		fn = '%s/tablets/%s/%s' % (self._snapshot_path(snapid), self.pix.path_to_cell(cell_id), self._tablet_filename(cgroup))
+		if self.remote is not None and not os.access(fn, os.R_OK):
+			self.fetch_from_remote(fn)
+
+		fp = self._open_tablet_file(fn, cgroup, mode='r')
+		try:
+			yield fp
+		finally:
+			fp.close()
+
+	def _create_delta(self, cell_id, cgroup, fn):
+		"""
+		Create a delta tablet in file fn, on top of the tablet of
+		cgroup in the (older) snapshot that cell_id is in.
+
+		The delta starts out with no rows and no tombstones. The
+		primary key sequence is carried over from the base.
+		"""
+		base_snapid = self.catalog.snapshot_of_cell(cell_id)
+		schema = self._get_schema(cgroup)
+		seqname = '_seq_' + schema['primary_key'] if 'primary_key' in schema else None
+
+		with self._open_base(cell_id, cgroup, base_snapid) as bfp:
+			nbase = self._nrows_fp(bfp, cell_id, cgroup)
+			if seqname is not None:
+				seq = getattr(bfp.root.main, seqname)[0]
+
+		logger.debug("Creating delta tablet %s (base snapshot %s)" % (fn, base_snapid))
+		fp = self._create_tablet(fn, cgroup)
+		_set_delta(fp, base_snapid, np.zeros(nbase, dtype=bool))
+		if seqname is not None:
+			getattr(fp.root.main, seqname)[0] = seq
+
+		return fp
+
+	def _delta_depth(self, cell_id, cgroup):
+		"""
+		Internal: Return the length of the chain of delta tablets
+		of cgroup in cell_id (0 if the tablet is not a delta).
+		"""
+		depth = 0
+		with self.read_tablet(cell_id, cgroup) as fp:
+			delta = _get_delta(fp)
+		while delta is not None:
+			depth += 1
+			with self._open_base(cell_id, cgroup, delta[0]) as fp:
+				delta = _get_delta(fp)
+		return depth
+
 	def _open_tablet(self, cell_id, cgroup, mode='r'):
 		"""
 		Open (or create) a tablet.
@@ -947,29 +1440,37 @@ class Table:
 
 		if mode == 'r':
 			fn_r = self._tablet_file(cell_id, cgroup)
-		        # --- hack: preload the entire file to have it appear in filesystem cache
-		        #     this will speed up subsequent random reads within the file
-			with open(fn_r) as f:
-				f.read()
-			# ---
-			fp = tables.openFile(fn_r)
+			if self._tablet_storage(cgroup) == 'hdf5':
+				# Bring the file into the filesystem cache, to speed up
+				# subsequent random reads within the file
+				readahead(fn_r)
+			fp = self._open_tablet_file(fn_r, cgroup, mode='r')
 		elif mode == 'r+':
 			self._check_transaction()
+			self._record_in_manifest(cell_id)
 			fn_w = self._tablet_file(cell_id, cgroup, mode='w')
-			if os.path.isfile(fn_w):
-				fp = tables.openFile(fn_w, mode='a')
+			if os.path.exists(fn_w):
+				fp = self._open_tablet_file(fn_w, cgroup, mode='a')
 			elif self.tablet_exists(cell_id, cgroup): 	# Note: this will download the tablet from remote, if needed
-				# A file exists in an older snapshot. Copy it over here.
+				# A file exists in an older snapshot. Copy it over here
+				# (or just record the changes to it, in a delta).
 				fn_r = self._tablet_file(cell_id, cgroup)
 				assert fn_r != fn_w, (fn_r, fn_w)
-				shutil.copy(fn_r, fn_w)
-				os.chmod(fn_w, 0664)	# Ensure it's writable
-				fp = tables.openFile(fn_w, mode='a')
+				if self._use_delta(cgroup):
+					fp = self._create_delta(cell_id, cgroup, fn_w)
+				elif self._tablet_storage(cgroup) == 'npy':
+					npytablet.copy(fn_r, fn_w)
+					fp = self._open_tablet_file(fn_w, cgroup, mode='a')
+				else:
+					shutil.copy(fn_r, fn_w)
+					os.chmod(fn_w, 0664)	# Ensure it's writable
+					fp = self._open_tablet_file(fn_w, cgroup, mode='a')
 			else:
 				# No file exists
 				fp = self._create_tablet(fn_w, cgroup)
 		elif mode == 'w':
 			self._check_transaction()
+			self._record_in_manifest(cell_id)
 			fn_w = self._tablet_file(cell_id, cgroup, mode='w')
 			fp = self._create_tablet(fn_w, cgroup)
 		else:
@@ -1016,6 +1517,7 @@ class Table:
 		self._cgroups = OrderedDict()
 		self._fgroups = dict()
 		self._filters = dict()
+		self._storage = 'hdf5'
 		self._aliases = dict()
 		self._commit_hooks = []
 		self.columns = OrderedDict()
@@ -1173,36 +1675,34 @@ class Table:
 		# Do the storing, cell by cell
 		#
 		ntot = 0
-		unique_cells = list(set(cells))
-		while unique_cells:
-			# Find a cell that is ready to be written to (that isn't locked
-			# by another writer) and lock it
-			for k in xrange(3600):
-				try:
-					i = k % len(unique_cells)
-					cur_cell_id = unique_cells[i]
-
-					# Try to acquire a lock for the entire cell
-					lock = self._lock_cell(cur_cell_id, timeout=1)
-
-					unique_cells.pop(i)
-					break
-				except locking.LockTimeout as _:
-#					print "LOCK:", _
-					pass
-			else:
-				raise Exception('Appear to be stuck on a lock file!')
-
+		for cur_cell_id, lock in self._locked_cells(set(cells)):
 			# Mask for rows belonging to this cell
 			incell = cells == cur_cell_id
 
-			# Store cell groups into their tablets
-			for cgroup, schema in self._cgroups.iteritems():
+			# Store cell groups into their tablets. The sparse cgroups go last,
+			# as they don't share the row positions (idx, nrows, nnew) of the
+			# primary cgroup.
+			for cgroup, schema in sorted(self._cgroups.iteritems(), key=lambda (cgroup, _): self._is_pseudotablet(cgroup) or self.is_sparse_cgroup(cgroup)):
 				if self._is_pseudotablet(cgroup):
 					continue
 
 				# Get the tablet file handles
 				fp    = self._open_tablet(cur_cell_id, mode='r+', cgroup=cgroup)
+
+				sparse = self.is_sparse_cgroup(cgroup)
+				if sparse and not any(colname in cols for colname, _ in schema['columns']):
+					# No rows to store in this sparse cgroup (but the tablet
+					# must still be carried over into this snapshot, above)
+					fp.close()
+					continue
+
+				if group == 'cached' and 'cached' not in fp.root and _get_delta(fp) is not None:
+					# Start the delta's own neighbor cache from that of its base
+					cached = self._read_merged(fp, cur_cell_id, cgroup, 'cached')
+					self._get_row_group(fp, group, cgroup)
+					if len(cached):
+						fp.root.cached.table.append(cached)
+
 				g     = self._get_row_group(fp, group, cgroup)
 				t     = g.table
 				blobs = schema['blobs'] if 'blobs' in schema else dict()
@@ -1213,7 +1713,7 @@ class Table:
 
 				if cgroup == self.primary_cgroup:
 					# Logical number of rows in this cell
-					nrows = len(t)
+					nrows = self._nrows_fp(fp, cur_cell_id, cgroup, group)
 
 					# Find keys needing an autogenerated ID and generate it
 					_, _, _, i = self.pix._xyti_from_id(colsT[key])
@@ -1243,35 +1743,40 @@ class Table:
 
 					# If this is an update, find where the new rows map
 					if _update:
-						id1 = t.col(self.primary_key.name)	# Load the primary keys of existing rows
+						id1 = self._read_merged(fp, cur_cell_id, cgroup, group, self.primary_key.name)	# Load the primary keys of existing rows
 						id2 = colsT[key]			# Primary keys of new rows
+						idx, nnew = _insertion_points(id1, id2)
+				elif sparse:
+					# Sparse tablets have rows of their own, mapped to
+					# the primary cgroup's rows by the row map
+					nrows = self._nrows_fp(fp, cur_cell_id, cgroup, group)
+					nnew_prim = nnew
+					idx = slice(None)
 
-						# The "find-insertion-points" idiom (if only np.in1d returned indices...)
-						ii = id1.argsort()
-						id1 = id1[ii]
-						idx = np.searchsorted(id1, id2)
-
-						# If this is a pure append, unset idx
-						if np.min(idx) == len(id1):
-							idx = slice(None)
-						else:
-							# Find rows which will be added, and those which will be updated
-							in_      = idx < len(id1)		    # Rows with IDs less than the maximum existing one
-							app      = np.ones(len(id2), dtype=np.bool)
-							app[in_] = id1[idx[in_]] != id2[in_]	 # These rows will be appended
-							nnew     = app.sum()
-
-							# Reindex new rows past the end
-							idx[app] = np.arange(len(id1), len(id1)+nnew)
-							
-							# Reindex existing rows to unsorted id1 ordering
-							napp = ~app
-							idx[napp] = ii[idx[napp]]
-#							print id1, id2, idx, app, nnew; exit()
+					if _update:
+						id1 = self._read_merged(fp, cur_cell_id, cgroup, group, SPARSE_ROWKEY)
+						id2 = cols[key][incell]
+						idx, nnew = _insertion_points(id1, id2)
 
 				if _update and not isinstance(idx, slice):
-					# Load existing rows (and imediately delete them)
-					rows = t.read()
+					delta = _get_delta(fp) if group == 'main' else None
+					if delta is not None:
+						# Rewrite the delta from the first updated row of the
+						# base on (marking those base rows as deleted), so that
+						# the rows keep their order
+						base_snapid, tombstones = delta
+						live = np.nonzero(~tombstones)[0]
+						upd = idx[idx < len(live)]
+						p0 = upd.min() if len(upd) else len(live)
+
+						with self._open_base(cur_cell_id, cgroup, base_snapid) as bfp:
+							base = self._read_merged(bfp, cur_cell_id, cgroup)
+						rows = _concat_rows(self._tablet_dtype(cgroup), [ base[live[p0:]], t.read() ])
+						tombstones[live[p0:]] = True
+					else:
+						# Load existing rows (and imediately delete them)
+						p0 = 0
+						rows = t.read()
 					t.truncate(0)
 
 					# Resolve blobs, merge them with ours (and immediately delete)
@@ -1294,8 +1799,12 @@ class Table:
 					g  = self._get_row_group(fp, group, cgroup)
 					t  = g.table
 
+					if delta is not None:
+						_set_delta(fp, base_snapid, tombstones)
+
 					# Enlarge the array to accommodate new rows (this will also set them to zero)
-					rows.resize(nrows + nnew)
+					rows.resize(nrows - p0 + nnew)
+					at = idx - p0
 
 #					print len(colsB['hdr']), len(rows), nnew
 #					print colsB['hdr']
@@ -1304,14 +1813,18 @@ class Table:
 					# Construct a compatible numpy array, that will leave
 					# unspecified columns set to zero
 					nnew = np.sum(incell)
-					rows = np.zeros(nnew, dtype=np.dtype(schema['columns']))
-					idx = slice(None)
+					rows = np.zeros(nnew, dtype=self._tablet_dtype(cgroup))
+					idx = at = slice(None)
 
 				# Update/add regular columns
 				for colname in colsT.keys():
 					if colname in blobs:
 						continue
-					rows[colname][idx] = colsT[colname]
+					rows[colname][at] = colsT[colname]
+
+				# Update/add the row map
+				if sparse:
+					rows[SPARSE_ROWKEY][at] = cols[key][incell]
 
 				# Update/add blobs. They're different as they'll touch all
 				# the rows, every time (even when updating).
@@ -1358,6 +1871,10 @@ class Table:
 				fp.close()
 #				exit()
 
+				if sparse:
+					# The number of (logical) rows is that of the primary cgroup
+					nnew = nnew_prim
+
 			self._unlock_cell(lock)
 
 			#print '[', nrows, ']'
@@ -1543,9 +2060,8 @@ class Table:
 		cell_id = self.static_if_no_temporal(cell_id)
 
 		# load the blobs arrays
-		with self.lock_cell(cell_id) as cell:
-			with cell.open(cgroup) as fp:
-				blobs = self._fetch_blobs_fp(fp, column, refs, include_cached)
+		with self.read_tablet(cell_id, cgroup) as fp:
+			blobs = self._fetch_blobs_fp(fp, column, refs, include_cached)
 
 		return blobs
 
@@ -1595,25 +2111,148 @@ class Table:
 			return self._fetch_pseudotablet(cell_id, cgroup, include_cached)
 
 		if self.tablet_exists(cell_id, cgroup):	# Note: this will download the tablet from remote, if needed
-			with self.lock_cell(cell_id) as cell:
-				with cell.open(cgroup) as fp:
-					rows = fp.root.main.table.read()
-					if include_cached and 'cached' in fp.root:
-						rows2 = fp.root.cached.table.read()
-						# Make any neighbor cache BLOBs negative (so that fetch_blobs() know to
-						# look for them in the cache, instead of 'main')
-						schema = self._get_schema(cgroup)
-						if 'blobs' in schema:
-							for blobcol in schema['blobs']:
-								rows2[blobcol] *= -1
-						# Append the data from cache to the main tablet
-						rows = np.append(rows, rows2)
+			with self.read_tablet(cell_id, cgroup) as fp:
+				rows = self._read_rows(fp, cell_id, cgroup, include_cached)
 		else:
-			schema = self._get_schema(cgroup)
-			rows = np.empty(0, dtype=np.dtype(schema['columns']))
+			rows = np.empty(0, dtype=self._tablet_dtype(cgroup))
 
 		return rows
 
+	def _read_rows(self, fp, cell_id, cgroup, include_cached):
+		"""
+		Internal: Read the rows of the tablet open in fp, followed
+		by the rows from its neighbor cache if include_cached=True.
+
+		The output is allocated once, sized for both row groups,
+		and each group is read directly into its slice. The BLOB
+		refs of the cached rows are negated in place, in that
+		slice.
+		"""
+		if _get_delta(fp) is not None:
+			# Delta tablets have no BLOBs, so there are no refs to negate
+			n1 = self._nrows_fp(fp, cell_id, cgroup, 'main')
+			n2 = self._nrows_fp(fp, cell_id, cgroup, 'cached') if include_cached else 0
+			rows = np.empty(n1 + n2, dtype=self._tablet_dtype(cgroup))
+			self._read_merged_into(fp, cell_id, cgroup, 'main', rows[:n1])
+			if include_cached:
+				self._read_merged_into(fp, cell_id, cgroup, 'cached', rows[n1:])
+			return rows
+
+		main = fp.root.main.table
+		if not include_cached or 'cached' not in fp.root:
+			return main.read()
+		cached = fp.root.cached.table
+
+		n1, n2 = len(main), len(cached)
+		if isinstance(fp, NpyTablet):
+			rows = ColGroup()
+			for name in fp.dtype.names:
+				col = np.empty(n1 + n2, dtype=fp.dtype.fields[name][0])
+				col[:n1] = main.col(name)
+				col[n1:] = cached.col(name)
+				rows.add_column(name, col)
+		else:
+			rows = np.empty(n1 + n2, dtype=main.dtype)
+			_read_table_into(main,   rows[:n1])
+			_read_table_into(cached, rows[n1:])
+
+		# Make any neighbor cache BLOBs negative (so that fetch_blobs() know to
+		# look for them in the cache, instead of 'main')
+		for blobcol in self._get_schema(cgroup).get('blobs', []):
+			rows[blobcol][n1:] *= -1
+
+		return rows
+
+	def _read_merged(self, fp, cell_id, cgroup, group='main', name=None):
+		"""
+		Internal: Read the rows (or only the column 'name') of row
+		group 'group' of the tablet open in fp.
+
+		A delta tablet holds only the rows added to its base (the
+		tablet of the same cell and cgroup in an older snapshot),
+		and a tombstone bitmap of the base rows that have been
+		deleted (or rewritten into the delta). Its rows are the
+		rows of the base not marked in the bitmap, followed by its
+		own. The neighbor cache of a delta is its own, if it has
+		one, or that of its base otherwise. Bases may themselves be
+		deltas.
+		"""
+		delta = _get_delta(fp)
+		if delta is None or (group == 'cached' and group in fp.root):
+			if group not in fp.root:
+				dtype = self._tablet_dtype(cgroup)
+				return np.empty(0, dtype=dtype if name is None else dtype[name])
+
+			t = getattr(fp.root, group).table
+			return t.read() if name is None else t.col(name)
+
+		if name is None:
+			rows = np.empty(self._nrows_fp(fp, cell_id, cgroup, group), dtype=self._tablet_dtype(cgroup))
+			self._read_merged_into(fp, cell_id, cgroup, group, rows)
+			return rows
+
+		base_snapid, tombstones = delta
+		with self._open_base(cell_id, cgroup, base_snapid) as bfp:
+			base = self._read_merged(bfp, cell_id, cgroup, group, name)
+
+		if group == 'cached':
+			return base
+
+		assert len(base) == len(tombstones), (fp.filename, len(base), len(tombstones))
+		return np.concatenate((base[~tombstones], fp.root.main.table.col(name)))
+
+	def _read_merged_into(self, fp, cell_id, cgroup, group, out):
+		"""
+		Internal: Read the rows of row group 'group' of the tablet
+		open in fp into out, preallocated to the size returned by
+		_nrows_fp(). See _read_merged().
+
+		The rows of each tablet in a chain of deltas are read
+		straight into their slice of out. Only a base with
+		deleted rows needs a temporary, to drop them from.
+		"""
+		delta = _get_delta(fp)
+		if delta is None or (group == 'cached' and group in fp.root):
+			if group in fp.root:
+				_read_group_into(getattr(fp.root, group).table, out)
+			return
+
+		base_snapid, tombstones = delta
+		with self._open_base(cell_id, cgroup, base_snapid) as bfp:
+			if group == 'cached':
+				self._read_merged_into(bfp, cell_id, cgroup, group, out)
+				return
+
+			t = fp.root.main.table
+			nlive = len(out) - len(t)
+			if not tombstones.any():
+				self._read_merged_into(bfp, cell_id, cgroup, group, out[:nlive])
+			else:
+				base = np.empty(len(tombstones), dtype=out.dtype)
+				self._read_merged_into(bfp, cell_id, cgroup, group, base)
+				np.compress(~tombstones, base, out=out[:nlive])
+
+		_read_group_into(t, out[nlive:])
+
+	def _nrows_fp(self, fp, cell_id, cgroup, group='main'):
+		"""
+		Internal: Return the number of rows in row group 'group' of
+		the tablet open in fp (including those of the base, if it's
+		a delta tablet; see _read_merged()).
+		"""
+		delta = _get_delta(fp)
+		if delta is not None and (group == 'main' or group not in fp.root):
+			base_snapid, tombstones = delta
+			if group == 'main':
+				return int((~tombstones).sum()) + len(fp.root.main.table)
+
+			with self._open_base(cell_id, cgroup, base_snapid) as bfp:
+				return self._nrows_fp(bfp, cell_id, cgroup, group)
+
+		if group not in fp.root:
+			return 0
+		return len(getattr(fp.root, group).table)
+
 	def _fetch_pseudotablet(self, cell_id, cgroup, include_cached=False):
 		"""
 		Internal: Fetch a "pseudotablet".
@@ -1632,10 +2271,9 @@ class Table:
 		# Find out how many rows are there in this cell
 		nrows1 = nrows2 = 0
 		if self.cell_exists(cell_id):
-			with self.lock_cell(cell_id) as cell:
-				with cell.open(self.primary_cgroup) as fp:
-					nrows1 = len(fp.root.main.table)
-					nrows2 = len(fp.root.cached.table) if (include_cached and 'cached' in fp.root) else 0
+			with self.read_tablet(cell_id) as fp:
+				nrows1 = self._nrows_fp(fp, cell_id, self.primary_cgroup)
+				nrows2 = self._nrows_fp(fp, cell_id, self.primary_cgroup, 'cached') if include_cached else 0
 		nrows = nrows1 + nrows2
 
 		cached = np.zeros(nrows, dtype=np.bool)			# _CACHED
@@ -1683,6 +2321,34 @@ class Table:
 			logger.debug("Closing tablet (%s)" % (fp.filename))
 			fp.close()
 
+	@contextmanager
+	def read_tablet(self, cell_id, cgroup=None):
+		""" Open a tablet for reading.
+
+		    Tablets of committed snapshots are read-only and can
+		    never change, so they're opened without any locking.
+		    Only if the tablet belongs to the snapshot of the open
+		    transaction (where other writers may be modifying it),
+		    the cell is locked while the tablet is open.
+		"""
+		if cgroup is None:
+			cgroup = self.primary_cgroup
+
+		lock = None
+		if self.transaction and self.catalog.snapshot_of_cell(cell_id) == self.snapid:
+			lock = self._lock_cell(cell_id)
+
+		try:
+			fp = self._open_tablet(cell_id, mode='r', cgroup=cgroup)
+			try:
+				yield fp
+			finally:
+				logger.debug("Closing tablet (%s)" % (fp.filename))
+				fp.close()
+		finally:
+			if lock is not None:
+				self._unlock_cell(lock)
+
 	@contextmanager
 	def lock_cell(self, cell_id, mode='r', timeout=None):
 		""" Open and return a proxy object for the given cell, that allows
@@ -1700,6 +2366,81 @@ class Table:
         		if lock != None:
         			self._unlock_cell(lock)
 
+	def count_rows(self, cell_id, include_cached=False):
+		"""
+		Return the number of rows in cell cell_id (including the
+		neighbor cache, if include_cached=True).
+
+		Raises LookupError if the cell doesn't exist.
+		"""
+		with self.read_tablet(cell_id) as fp:
+			n = self._nrows_fp(fp, cell_id, self.primary_cgroup)
+			if include_cached:
+				n += self._nrows_fp(fp, cell_id, self.primary_cgroup, 'cached')
+		return n
+
+	def compact(self, cell_id, min_depth=1, cgroups=None):
+		"""
+		Fold the delta tablets of a cell into full tablets.
+
+		The merged rows of every tablet of the cell are written out
+		as a new (full) tablet into the snapshot of the open
+		transaction, if any tablet of the cell sits on top of a
+		chain of at least min_depth delta tablets. The tablets of
+		older snapshots are left untouched.
+
+		If cgroups is given, only the tablets of those cgroups are
+		rewritten. With min_depth=0 they're rewritten regardless
+		of deltas (e.g., to apply a new layout; see
+		set_cgroup_layout()). Tablets with BLOBs are never
+		rewritten.
+
+		Returns True if the cell was compacted.
+		"""
+		self._check_transaction()
+
+		present = [ cgroup for cgroup in self._cgroups if not self._is_pseudotablet(cgroup) and self.tablet_exists(cell_id, cgroup) ]
+		rewrite = [ cgroup for cgroup in present if (cgroups is None or cgroup in cgroups) and 'blobs' not in self._get_schema(cgroup) ]
+		if not rewrite or max(self._delta_depth(cell_id, cgroup) for cgroup in rewrite) < min_depth:
+			return False
+
+		with self.lock_cell(cell_id, mode='r+') as cell:
+			for cgroup in present:
+				# Opening the tablets carries them over into this
+				# snapshot (as deltas, or copies for BLOB tablets)
+				with cell.open(cgroup) as fp:
+					if cgroup not in rewrite:
+						continue
+
+					schema = self._get_schema(cgroup)
+					seqname = '_seq_' + schema['primary_key'] if 'primary_key' in schema else None
+
+					main   = self._read_merged(fp, cell_id, cgroup, 'main')
+					cached = self._read_merged(fp, cell_id, cgroup, 'cached')
+					if seqname is not None:
+						seq = getattr(fp.root.main, seqname)[0]
+					fn = fp.filename
+
+				# Replace the delta with a full tablet
+				logger.debug("Compacting %s (%d rows, %d cached)" % (fn, len(main), len(cached)))
+				if os.path.isdir(fn):
+					shutil.rmtree(fn)
+				else:
+					os.unlink(fn)
+
+				fp = self._open_tablet(cell_id, cgroup, mode='w')
+				try:
+					if len(main):
+						fp.root.main.table.append(main)
+					if len(cached):
+						self._get_row_group(fp, 'cached', cgroup).table.append(cached)
+					if seqname is not None:
+						getattr(fp.root.main, seqname)[0] = seq
+				finally:
+					fp.close()
+
+		return True
+
 	def get_spatial_keys(self):
 		"""
 		Names of spatial keys, or (None, None) if they don't exist.
@@ -1719,3 +2460,113 @@ class Table:
 		defined.
 		"""
 		return self.temporal_key.name if self.temporal_key is not None else None
+
+########### Unit tests
+
+class Test_Delta:
+	""" Delta tablets: reading, updating and compacting them """
+	def setUp(self):
+		import tempfile
+		from join_ops import DB
+		self.dir = tempfile.mkdtemp()
+		self.db = DB(self.dir)
+		with self.db.transaction():
+			self.db.create_table('t', {
+				'commit_hooks': [],
+				'schema': {
+					'main': {
+						'columns': [ ('id', 'u8'), ('ra', 'f8'), ('dec', 'f8'), ('x', 'i4') ],
+						'primary_key': 'id',
+						'spatial_keys': ('ra', 'dec'),
+					}
+				}
+			})
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _rows(self, x, ids=None):
+		x = np.asarray(x, dtype='i4')
+		rows = ColGroup([ ('ra', 10. + 1e-5*x), ('dec', np.zeros(len(x)) + 10.), ('x', x) ])
+		if ids is not None:
+			rows.add_column('id', np.asarray(ids, dtype='u8'))
+		return rows
+
+	def _write(self, rows, **kwargs):
+		with self.db.transaction():
+			return self.db.table('t').append(rows, **kwargs)
+
+	def _check(self, ids, x, include_cached=False):
+		# The rows read back are the expected ones, in the expected order
+		t = self.db.table('t')
+		cell_id = t.pix.cell_for_id(ids[0])
+		rows = t.fetch_tablet(cell_id, include_cached=include_cached)
+		assert np.all(rows['id'] == ids) and np.all(rows['x'] == x), (rows['id'], ids, rows['x'], x)
+		if not include_cached:
+			with t.read_tablet(cell_id) as fp:
+				assert t._nrows_fp(fp, cell_id, t.primary_cgroup) == len(ids)
+		return rows
+
+	def _depth(self, ids):
+		t = self.db.table('t')
+		return t._delta_depth(t.pix.cell_for_id(ids[0]), t.primary_cgroup)
+
+	def test_append(self):
+		""" Delta: append in a newer snapshot """
+		ids1 = self._write(self._rows([1, 2, 3, 4, 5]))
+		ids2 = self._write(self._rows([6, 7, 8]))
+		assert self._depth(ids1) == 1
+		self._check(np.concatenate((ids1, ids2)), [1, 2, 3, 4, 5, 6, 7, 8])
+
+	def test_update(self):
+		""" Delta: keyed update of rows of the base """
+		ids = self._write(self._rows([1, 2, 3, 4, 5]))
+		self._write(self._rows([20, 40], ids=ids[[1, 3]]), _update=True)
+		assert self._depth(ids) == 1
+		self._check(ids, [1, 20, 3, 40, 5])
+
+		# The base rows from the first updated one on were rewritten into the delta
+		t = self.db.table('t')
+		cell_id = t.pix.cell_for_id(ids[0])
+		with t.read_tablet(cell_id) as fp:
+			_, tombstones = _get_delta(fp)
+			assert list(tombstones) == [False, True, True, True, True]
+
+	def test_delta_on_delta(self):
+		""" Delta: update and append on top of a delta """
+		ids1 = self._write(self._rows([1, 2, 3]))
+		ids2 = self._write(self._rows([4, 5]))
+		self._write(self._rows([30], ids=ids1[[2]]), _update=True)
+		ids3 = self._write(self._rows([6]))
+		assert self._depth(ids1) == 3
+		self._check(np.concatenate((ids1, ids2, ids3)), [1, 2, 30, 4, 5, 6])
+
+	def test_cached_missing_from_delta(self):
+		""" Delta: neighbor cache read from the base """
+		t = self.db.table('t')
+		with self.db.transaction():
+			ids1 = t.append(self._rows([1, 2, 3]))
+			cell_id = t.pix.cell_for_id(ids1[0])
+			cids = t.pix.obj_id_from_pos(200., -30.) + np.arange(1, 3, dtype=np.uint64)
+			t.append(self._rows([-1, -2], ids=cids), group='cached', cell_id=cell_id)
+		ids2 = self._write(self._rows([4]))
+
+		with t.read_tablet(cell_id) as fp:
+			assert _get_delta(fp) is not None and 'cached' not in fp.root
+			assert t._nrows_fp(fp, cell_id, t.primary_cgroup, 'cached') == 2
+		self._check(np.concatenate((ids1, ids2, cids)), [1, 2, 3, 4, -1, -2], include_cached=True)
+
+	def test_compact(self):
+		""" Delta: compaction leaves the rows unchanged """
+		ids1 = self._write(self._rows([1, 2, 3]))
+		ids2 = self._write(self._rows([4, 5]))
+		self._write(self._rows([20], ids=ids1[[1]]), _update=True)
+		ids, x = np.concatenate((ids1, ids2)), [1, 20, 3, 4, 5]
+		rows = self._check(ids, x)
+
+		t = self.db.table('t')
+		with self.db.transaction():
+			assert t.compact(t.pix.cell_for_id(ids[0]))
+		assert self._depth(ids) == 0
+		rows2 = self._check(ids, x)
+		assert rows.dtype == rows2.dtype and np.all(rows == rows2)
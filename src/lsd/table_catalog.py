@@ -43,31 +43,63 @@ contains do:
 	  search of that entire subtree can be avoided). TableCatalog
 	  makes use of these 'mipmaps' to accelerate get_cells().
 
-TODO:
-	- the catalog should be build/maintained whenever the database is
-	  modified. Modifications to Table._create_tablet and Table.append
-	  should do the trick.
-	  	- Note however that there needs to be a synchronization
-	  	  mechanism if multiple processes are operating on the same
-	  	  table (we probably need a server)
+The catalog is stored in the snapshot directory as catalog.mmap, a
+file with the raw bmaps and leaves arrays that is memory-mapped when
+loaded (so opening it is nearly instantaneous, and all processes on a
+node share the same pages). Catalogs of snapshots committed by older
+versions of LSD are pickled in catalog.pkl, which is still readable.
+
+The catalog is maintained incrementally: as tablets are written in a
+transaction, Table records the modified cells in per-process manifest
+files in the snapshot, and update_cells() merges them into the catalog
+at commit time. A full rescan of the tablet tree (update()) is only
+needed for snapshots without a manifest, or to repair a catalog.
 """
 import logging
 import cPickle, os, glob
+import mmap, struct, socket
 import tables
 import pool2
+import npytablet
 import numpy as np
 import bounds as bn
 import bhpix
 import utils
 from pixelization import Pixelization
 from interval import intervalset
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from itertools import izip
 
 logger = logging.getLogger('lsd.table_catalog')
 
 END_MARKER=0x7FFFFFFF
 
+# The dtype of the leaves array. The snapshot of each cell is stored as
+# an index into the (sorted) list of snapshots, TableCatalog._snapids.
+# The cgroups column is a bitmask of cgroups with a tablet in the cell,
+# with bit k set if the cell has a tablet of TableCatalog._cgroups[k].
+LEAF_DTYPE = [('mjd', 'f4'), ('snapidx', 'i4'), ('cell_id', 'u8'), ('next', 'i4'), ('cgroups', 'u8')]
+
+# Set in the cgroups bitmask if the bitmask is valid (cells cataloged by
+# older versions of LSD have cgroups=0). This leaves room for 63 cgroups.
+CGROUPS_KNOWN = 1 << 63
+MAX_CGROUPS = 63
+
+# The on-disk catalog (catalog.mmap) consists of MMAP_MAGIC, a
+# little-endian uint64 length of the pickled header, the header, and
+# the raw arrays listed in the header. The arrays begin at the first
+# MMAP_ALIGN-aligned offset following the header, and each is aligned
+# to MMAP_ALIGN bytes.
+MMAP_MAGIC = 'LSDCAT01'
+MMAP_ALIGN = 64
+
+# Queries with no more than this many candidate leaf cells are
+# looked up in-process, instead of fanning out to a pool
+LOCAL_MAXCELLS = int(os.getenv('LSD_CATALOG_LOCAL_MAXCELLS', 4096))
+
+# Number of get_cells() results to keep in the LRU cache
+CELLS_CACHE_SIZE = int(os.getenv('LSD_CATALOG_CACHE_SIZE', 32))
+
 def _add_bounds(outcells, cell_id, xybounds, tbounds):
 	# cells is a dictionary of cell_id -> dict objects,
 	# where each dict object is another dictionary of xybounds -> tbounds
@@ -90,6 +122,18 @@ def _get_cells_kernel(ij, lev, cc, bounds):
 		cc._get_cells_recursive(cells, bounds_xy, bounds_t, i, j, lev, bhpix.pix_size(lev))
 	yield cells
 
+def _bounds_key(bounds):
+	# A hashable representation of a list of (Polygon, intervalset)
+	# tuples, to be used as a key of the get_cells() cache
+	if bounds is None:
+		return None
+
+	key = []
+	for bounds_xy, bounds_t in bounds:
+		poly = tuple( (tuple(map(tuple, contour)), bounds_xy.isHole(k)) for k, contour in enumerate(bounds_xy) )
+		key.append((poly, tuple(bounds_t)))
+	return tuple(key)
+
 def _scan_recursive_kernel(xy, lev, cc):
 	x, y = xy
 
@@ -110,6 +154,9 @@ def iter_siblings(a, at):
 
 		offs = abs(a['next'][at])
 
+def _round_up(n, k):
+	return (n + k - 1) // k * k
+
 def get_snapshot_path(table_path, snapid):
 	if snapid == 0:
 		return table_path
@@ -139,10 +186,102 @@ def isnapshots(table_path, return_path=False, first=None, last=None, no_first=Fa
 class TableCatalog:
 	_bmaps = None
 	_leaves = None
+	_snapids = None		# Sorted list of snapshots referred to by the 'snapidx' column of _leaves
+	_cgroups = None		# List of cgroups referred to by the bits of the 'cgroups' column of _leaves
+	_cgroup_bits = None	# (bit, tablet filename) of cgroups to look for while updating
+	_cells = None		# Sorted array of cell_ids in _leaves ...
+	_cells_at = None	# ... and their positions in _leaves
 	_pix = None
+	_cells_cache = None	# LRU cache of get_cells() results (reset whenever the catalog changes)
 	
 	#################
 
+	def _add_temporal_siblings(self, outcells, x, y, offs, xybounds, bounds_t, include_cached):
+		""" Add the temporal cells of the leaf at (x, y), whose
+		    list of siblings begins at offs, that overlap bounds_t
+		"""
+		next = 0
+		while next != END_MARKER:
+			(t, _, _, next, _) = self._leaves[offs]
+			has_data = next > 0
+			next = abs(next)
+			if next != END_MARKER:	# Not really necessary, but numpy warns of overflow otherwise.
+				offs += next
+
+			if not has_data and not include_cached:
+				continue
+
+			if t != self._pix.t0:
+				# Cut on the time component
+				tival = intervalset((t, t+self._pix.dt))
+				tolap = bounds_t & tival
+				if len(tolap):
+					(l, r) = tolap[-1]				# Get the right-most interval component
+					if l == r == t+self._pix.dt:				# Is it a single point?
+						tolap = intervalset(*tolap[:-1])	# Since objects in this cell have time in [t, t+dt), remove the t+dt point
+
+				if len(tolap) == 0:					# No overlap between the intervals -- skip this cell
+					continue;
+
+				# Return None if the cell is fully contained in the requested interval
+				tbounds = None if tival == tolap else tolap
+			else:
+				# Static cell
+				tbounds = bounds_t
+				assert next == END_MARKER, "There can be only one static cell (x,y,t=%s,%s,%s)" % (x, y, t)
+
+			# Compute cell ID
+			cell_id = (x, y, t)
+
+			# Add to output
+			_add_bounds(outcells, cell_id, xybounds, tbounds)
+
+	def _candidate_leaves(self, bounds_xy):
+		""" Return the (i, j, x, y) coordinates of populated leaf
+		    cells that overlap the bounding box of bounds_xy.
+
+		    Descends the mipmap pyramid one level at a time,
+		    culling all unpopulated cells and the cells outside
+		    of the bounding box in one (vectorized) step per level.
+		"""
+		(xmin, xmax, ymin, ymax) = bounds_xy.boundingBox()
+
+		di = np.array([0, 0, 1, 1])
+		dj = np.array([0, 1, 0, 1])
+		i, j = di, dj
+		for lev in xrange(1, self._pix.level+1):
+			if lev != 1:
+				# Subdivide into four subpixels
+				i = (2*i[:, np.newaxis] + di).ravel()
+				j = (2*j[:, np.newaxis] + dj).ravel()
+
+			dx = bhpix.pix_size(lev)
+			w2 = 1 << (lev-1)
+			x, y =  (i - w2 + 0.5)*dx, (j - w2 + 0.5)*dx
+
+			keep  = self._bmaps[lev][i, j] != 0
+			keep &= (x + 0.5*dx >= xmin) & (x - 0.5*dx <= xmax)
+			keep &= (y + 0.5*dx >= ymin) & (y - 0.5*dx <= ymax)
+			i, j, x, y = i[keep], j[keep], x[keep], y[keep]
+
+		return i, j, x, y
+
+	def _get_cells_local(self, outcells, bounds_xy, bounds_t, leaves, include_cached):
+		""" Helper for get_cells(). Single-process lookup of
+		    the candidate leaves returned by _candidate_leaves()
+		"""
+		bmap = self._bmaps[self._pix.level]
+		dx = bhpix.pix_size(self._pix.level)
+		for i, j, x, y in izip(*leaves):
+			# Check for nonzero overlap
+			box  = self._pix._cell_bounds_xy(x, y, dx)
+			bounds = bounds_xy & box
+			if not bounds:
+				continue
+
+			xybounds = None if(bounds.area() == box.area()) else bounds
+			self._add_temporal_siblings(outcells, x, y, bmap[i, j], xybounds, bounds_t, include_cached)
+
 	def _get_cells_recursive(self, outcells, bounds_xy, bounds_t, i = 0, j = 0, lev = 0, dx = 2.):
 		""" Helper for get_cells(). See documentation of
 		    get_cells() for usage
@@ -166,41 +305,7 @@ class TableCatalog:
 		if offs > 1:
 			# Get the cell_ids for leaf cells matching pattern
 			xybounds = None if(bounds_xy.area() == box.area()) else bounds_xy
-			next = 0
-			while next != END_MARKER:
-				(t, _, _, next) = self._leaves[offs]
-				has_data = next > 0
-				next = abs(next)
-				if next != END_MARKER:	# Not really necessary, but numpy warns of overflow otherwise.
-					offs += next
-
-				if not has_data and not self._include_cached:
-					continue
-
-				if t != self._pix.t0:
-					# Cut on the time component
-					tival = intervalset((t, t+self._pix.dt))
-					tolap = bounds_t & tival
-					if len(tolap):
-						(l, r) = tolap[-1]				# Get the right-most interval component
-						if l == r == t+self._pix.dt:				# Is it a single point?
-							tolap = intervalset(*tolap[:-1])	# Since objects in this cell have time in [t, t+dt), remove the t+dt point
-	
-					if len(tolap) == 0:					# No overlap between the intervals -- skip this cell
-						continue;
-	
-					# Return None if the cell is fully contained in the requested interval
-					tbounds = None if tival == tolap else tolap
-				else:
-					# Static cell
-					tbounds = bounds_t
-					assert next == END_MARKER, "There can be only one static cell (x,y,t=%s,%s,%s)" % (x, y, t)
-
-				# Compute cell ID
-				cell_id = (x, y, t)
-
-				# Add to output
-				_add_bounds(outcells, cell_id, xybounds, tbounds)
+			self._add_temporal_siblings(outcells, x, y, offs, xybounds, bounds_t, self._include_cached)
 		else:
 			# Recursively subdivide the four subpixels
 			for (di, dj) in [(0, 0), (0, 1), (1, 0), (1, 1)]:
@@ -217,6 +322,29 @@ class TableCatalog:
 		    Output is a list of (cell_id, xybounds, tbounds) tuples,
 		    unless return_bounds=False when the output is just a
 		    list of cell_ids.
+
+		    Small queries (e.g., cone searches) are looked up
+		    in-process, large ones in parallel. The results of the
+		    last CELLS_CACHE_SIZE lookups are cached; the cache is
+		    reset whenever the catalog changes.
+		"""
+		# See if we've recently answered the same query
+		key = (_bounds_key(bounds), include_cached)
+		cells = self._cells_cache.pop(key, None)
+		if cells is None:
+			cells = self._get_cells(bounds, include_cached)
+
+		self._cells_cache[key] = cells
+		while len(self._cells_cache) > CELLS_CACHE_SIZE:
+			self._cells_cache.popitem(last=False)
+
+		if not return_bounds:
+			return cells.keys()
+		else:
+			return dict( (cell_id, list(b)) for cell_id, b in cells.iteritems() )
+
+	def _get_cells(self, bounds, include_cached):
+		""" Helper for get_cells() doing the actual lookup
 		"""
 		self._include_cached = include_cached
 
@@ -224,15 +352,16 @@ class TableCatalog:
 		if bounds == None:
 			bounds = [(bn.ALLSKY, intervalset((-np.inf, np.inf)))]
 
+		# Find the populated leaves within the bounding boxes of the bounds
+		leaves = [ self._candidate_leaves(bounds_xy) for bounds_xy, _ in bounds ]
+
 		# Find all existing cells satisfying the bounds
 		cells = defaultdict(dict)
-		if False:
-			# Single-threaded implementation
-			for bounds_xy, bounds_t in bounds:
-				self._get_cells_recursive(cells, bounds_xy, bounds_t, 0, 0, 1, 1.)
-				self._get_cells_recursive(cells, bounds_xy, bounds_t, 0, 1, 1, 1.)
-				self._get_cells_recursive(cells, bounds_xy, bounds_t, 1, 0, 1, 1.)
-				self._get_cells_recursive(cells, bounds_xy, bounds_t, 1, 1, 1, 1.)
+		if sum(len(l[0]) for l in leaves) <= LOCAL_MAXCELLS:
+			# Single-process implementation (for small queries, where
+			# the overhead of starting a pool dominates)
+			for (bounds_xy, bounds_t), l in izip(bounds, leaves):
+				self._get_cells_local(cells, bounds_xy, bounds_t, l, include_cached)
 		else:
 			# Multi-process implementation (appears to be as good or better than single thread in
 			# nearly all cases of interest)
@@ -252,25 +381,113 @@ class TableCatalog:
 
 			# Reorder cells to be a dict of cell: [(poly, time), (poly, time)] entries
 			cells = dict(( (cell_id, v.items()) for (cell_id, (k, v)) in izip(cell_ids, cells.iteritems()) ))
-
-		if not return_bounds:
-			return cells.keys()
 		else:
-			return cells
+			cells = dict()
+
+		return cells
 
 	def get_cells_in_snapshot(self, snapid, include_cached=True):
 		""" Return a list of cells that are physically stored in snapshot snapid """
-		keep = self._leaves['snapid'] == snapid
+		try:
+			snapidx = self._snapids.index(snapid)
+		except ValueError:
+			return np.empty(0, dtype='u8')
+
+		keep = self._leaves['snapidx'] == snapidx
 		if not include_cached:
 			keep &= self._leaves['next'] > 0
 		cells = self._leaves['cell_id'][keep]
 		return cells
 
+	def _cell_offset(self, cell_id):
+		# Return the offset of cell_id's entry in leaves
+		cell_id = np.uint64(cell_id)
+		i = np.searchsorted(self._cells, cell_id)
+		if i == len(self._cells) or self._cells[i] != cell_id:
+			raise LookupError()
+
+		return self._cells_at[i]
+
 	def snapshot_of_cell(self, cell_id):
+		return self._snapids[self._leaves['snapidx'][self._cell_offset(cell_id)]]
+
+	def tablet_exists(self, cell_id, cgroup):
+		""" Return True if cell_id has a tablet of the given
+		    cgroup, and False if it doesn't.
+
+		    Returns None if the catalog doesn't know (the cell was
+		    cataloged by an older version of LSD, or the cgroup is
+		    not known to the catalog). Raises LookupError if the
+		    cell is not in the catalog.
+		"""
+		mask = int(self._leaves['cgroups'][self._cell_offset(cell_id)])
+		if not mask & CGROUPS_KNOWN:
+			return None
+
 		try:
-			return self._cell_to_snapshot[cell_id]
-		except KeyError:
-			raise LookupError()
+			bit = self._cgroups.index(cgroup)
+		except ValueError:
+			return None
+		if bit >= MAX_CGROUPS:
+			return None
+
+		return bool(mask & (1 << bit))
+
+	def _siblings(self, offs):
+		""" Iterate through the (mjd, snapid, cell_id, next, cgroups)
+		    entries of the temporal siblings starting at offs
+		"""
+		for (mjd, snapidx, cell_id, next, cgroups) in iter_siblings(self._leaves, offs):
+			yield mjd, self._snapids[snapidx], cell_id, next, cgroups
+
+	def _set_cgroups(self, cgroups):
+		# Register the cgroups (a list of (cgroup, tablet filename)
+		# tuples) whose tablets are to be looked for when updating
+		# the catalog
+		if cgroups is None:
+			cgroups = []
+
+		self._cgroup_bits = []
+		for cgroup, fn in cgroups:
+			if cgroup not in self._cgroups:
+				self._cgroups.append(cgroup)
+			bit = self._cgroups.index(cgroup)
+			if bit < MAX_CGROUPS:
+				self._cgroup_bits.append((1 << bit, fn))
+
+	def _examine_tablet(self, fn):
+		""" Return (has_data, cgroups) for the cell whose primary
+		    tablet is fn.
+		"""
+		# check if there are any non-cached data in here. A delta
+		# tablet also has data if any of its base rows haven't been
+		# deleted (its tombstone bitmap is as long as the base).
+		if os.path.isdir(fn):
+			# A columnar (npy) tablet
+			has_data = npytablet.nrows(fn) > 0
+			if not has_data and os.path.isdir(fn + '/delta'):
+				_, tombstones = npytablet.get_delta(fn)
+				has_data = not tombstones.all()
+		else:
+			try:
+				with tables.openFile(fn) as fp:
+					has_data = len(fp.root.main.table) > 0
+					if not has_data and 'delta' in fp.root:
+						has_data = not fp.root.delta.tombstones.read().all()
+			except tables.exceptions.NoSuchNodeError:
+				has_data = False
+
+		# check which cgroups have tablets in this cell
+		if self._cgroup_bits:
+			files = set(os.listdir(os.path.dirname(fn)))
+			cgroups = CGROUPS_KNOWN
+			for bit, tabletfn in self._cgroup_bits:
+				if tabletfn in files:
+					cgroups |= bit
+		else:
+			cgroups = 0
+
+		return has_data, cgroups
 
 	#################
 
@@ -316,29 +533,23 @@ class TableCatalog:
 			for snapid, path in paths:
 				for tcell, fn in self._get_temporal_siblings(path, self.__pattern):
 					if tcell not in siblings: # Add only if there's no newer version
-						# check if there are any non-cached data in here
-						try:
-							with tables.openFile(fn) as fp:
-								has_data = len(fp.root.main.table) > 0
-						except tables.exceptions.NoSuchNodeError:
-							has_data = False
-						
-						siblings[tcell] = snapid, has_data
+						has_data, cgroups = self._examine_tablet(fn)
+						siblings[tcell] = snapid, has_data, cgroups
 
 			# Add any relevant pre-existing data
 			offs = self._bmaps[self._pix.level][i, j]
 			if offs != 0:
-				for mjd, snapid, _, next in iter_siblings(self._leaves, offs):
+				for mjd, snapid, _, next, cgroups in self._siblings(offs):
 					if mjd not in siblings:
-						siblings[mjd] = snapid, next > 0
+						siblings[mjd] = snapid, next > 0, cgroups
 
 			# Add this list to bitmap
 			assert bmap[i, j] == 0
-			bmap[i, j] = [ (tcell, snapid, self._pix._cell_id_for_xyt(x, y, tcell), has_data) for (tcell, (snapid, has_data)) in siblings.iteritems() ]
+			bmap[i, j] = [ (tcell, snapid, self._pix._cell_id_for_xyt(x, y, tcell), has_data, cgroups) for (tcell, (snapid, has_data, cgroups)) in siblings.iteritems() ]
 
 	def _update(self, table_path, snapid):
 		# Find what we already have loaded
-		prevsnap = np.max(self._leaves['snapid']) if len(self._leaves) > 2 else None
+		prevsnap = self._snapids[-1] if len(self._leaves) > 2 else None
 		assert prevsnap <= snapid, "Cannot update a catalog to an older snapshot"
 
 		## Enumerate all existing snapshots older or equal to snapid, and newer than prevsnap, and sort them, newest first
@@ -369,7 +580,7 @@ class TableCatalog:
 		# Add data about cells that were not touched by this update
 		bmap_cur = self._bmaps[self._pix.level]
 		mask_cur = (bmap_cur != 0) & (bmap == 0)
-		lists_cur = [ [ (mjd, snapid, cell_id, next > 0) for (mjd, snapid, cell_id, next) in iter_siblings(self._leaves, offs) ] for offs in bmap_cur[mask_cur] ]
+		lists_cur = [ [ (mjd, snapid, cell_id, next > 0, cgroups) for (mjd, snapid, cell_id, next, cgroups) in self._siblings(offs) ] for offs in bmap_cur[mask_cur] ]
 		try:
 			bmap[mask_cur] = lists_cur
 		except ValueError:
@@ -378,27 +589,29 @@ class TableCatalog:
 			for (ii, jj), vv in izip(coords, lists_cur):
 				bmap[ii, jj] = vv
 
+		return self._pack(bmap)
+
+	def _pack(self, bmap):
+		""" Pack a (W x W) map of lists of (mjd, snapid, cell_id,
+		    has_data, cgroups) tuples of temporal siblings into the
+		    (bmaps, leaves, snapids) structure.
+		"""
 		# Repack the temporal siblings to a single numpy array, emulating a linked list
 		lists = bmap[bmap != 0]
 		llens = np.fromiter( (len(l) for l in lists), dtype=np.int32 )
-		leaves = np.empty(np.sum(llens)+2, dtype=[('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')])
-		leaves[:2] = [(np.inf, 0, 0, END_MARKER)]*2	# We start with two dummy entries, so that offs=0 and 1 are invalid and can take other meanings.
-		seen = dict()
+		snapids = sorted(set( snapid for l in lists for (_, snapid, _, _, _) in l ))
+		snapidx = dict( (snapid, k) for k, snapid in enumerate(snapids) )
+		leaves = np.empty(np.sum(llens)+2, dtype=LEAF_DTYPE)
+		leaves[:2] = [(np.inf, -1, 0, END_MARKER, 0)]*2	# We start with two dummy entries, so that offs=0 and 1 are invalid and can take other meanings.
 		at = 2
 		for l in lists:
 			last_i = len(l) - 1
-			for (i, (mjd, snapid, cell_id, has_data)) in enumerate(l):
-				# Make equal strings refer to the same string object
-				try:
-					snapid = seen[snapid]
-				except KeyError:
-					seen[snapid] = snapid
-
+			for (i, (mjd, snapid, cell_id, has_data, cgroups)) in enumerate(l):
 				next = 1 if has_data else -1
 				if i == last_i:
 					next *= END_MARKER
 
-				leaves[at] = (mjd, snapid, cell_id, next)
+				leaves[at] = (mjd, snapidx[snapid], cell_id, next, cgroups)
 				at += 1
 
 		# Construct bmap that has offsets to head of the linked list of siblings
@@ -412,7 +625,61 @@ class TableCatalog:
 		# Recompute mipmaps
 		bmaps = self._compute_mipmaps(obmap)
 
-		return bmaps, leaves
+		return bmaps, leaves, snapids
+
+	def update_cells(self, table_path, pattern, snapid, cell_ids, cgroups=None):
+		""" Incrementally update the catalog with cells written
+		    to in snapshot snapid.
+
+		    Only the tablets (matching pattern) of the given cells
+		    are examined; the rest of the catalog is carried over
+		    from its current state. Cells whose tablets don't exist
+		    in snapid are ignored.
+
+		    cgroups is a list of (cgroup, tablet filename) tuples,
+		    of cgroups whose tablets should be recorded in the
+		    catalog (see tablet_exists()).
+		"""
+		self._set_cgroups(cgroups)
+
+		lev = self._pix.level
+		w = bhpix.width(lev)
+		w2 = w // 2
+		snapshot_path = get_snapshot_path(table_path, snapid)
+
+		# Load the current lists of temporal siblings, as
+		# mjd -> (snapid, cell_id, has_data, cgroups) dicts
+		bmap_cur = self._bmaps[lev]
+		bmap = np.zeros((w, w), dtype=object)
+		for i, j in izip(*np.nonzero(bmap_cur)):
+			bmap[i, j] = dict((float(mjd), (snapid_, cell_id, next > 0, cgroups)) for (mjd, snapid_, cell_id, next, cgroups) in self._siblings(bmap_cur[i, j]))
+
+		# Add/replace the entries of modified cells
+		for cell_id in set(cell_ids):
+			cell_path = self._pix.path_to_cell(cell_id)
+			fn = '%s/tablets/%s/%s' % (snapshot_path, cell_path, pattern)
+			if not os.path.exists(fn):	# npy tablets are directories
+				continue
+
+			has_data, cgroups = self._examine_tablet(fn)
+
+			# The time is parsed out of the path, as in _get_temporal_siblings()
+			kind = cell_path.split('/')[-1]
+			t = self._pix.t0 if kind == 'static' else float(kind[1:])
+
+			x, y, _ = self._pix._xyt_from_cell_id(cell_id)
+			i, j = bhpix.xy_to_ij(x, y, lev)
+			i, j = int(i) + w2, int(j) + w2
+			if bmap[i, j] == 0:
+				bmap[i, j] = dict()
+			bmap[i, j][float(np.float32(t))] = (snapid, cell_id, has_data, cgroups)
+
+		# Convert back to lists of siblings
+		for i, j in izip(*np.nonzero(bmap)):
+			bmap[i, j] = [ (mjd,) + v for mjd, v in sorted(bmap[i, j].iteritems(), reverse=True) ]
+
+		self._bmaps, self._leaves, self._snapids = self._pack(bmap)
+		self._rebuild_internal_state()
 
 	def _compute_mipmaps(self, bmap):
 		# Create mip-maps
@@ -429,33 +696,139 @@ class TableCatalog:
 
 		return bmaps
 
-	def _rebuild_internal_state(self):
-		self._cell_to_snapshot = dict(v for v in izip(self._leaves['cell_id'][2:], self._leaves['snapid'][2:]))
-		assert len(self._cell_to_snapshot) == len(self._leaves)-2, (len(self._cell_to_snapshot), len(self._leaves))
+	def _rebuild_internal_state(self, index=None):
+		self._cells_cache = OrderedDict()
+
+		if index is None:
+			# Index the cells, for snapshot_of_cell() lookups
+			cell_ids = self._leaves['cell_id'][2:]
+			at = np.argsort(cell_ids)
+			index = cell_ids[at], at + 2
+			assert np.all(index[0][1:] != index[0][:-1]), "Duplicate cells in the catalog"
+
+		self._cells, self._cells_at = index
 
-	def update(self, table_path, pattern, snapid):
+	def update(self, table_path, pattern, snapid, cgroups=None):
+		""" Update the catalog to snapshot snapid, by scanning
+		    the tablet tree for primary tablets (matching pattern).
+
+		    cgroups is a list of (cgroup, tablet filename) tuples,
+		    of cgroups whose tablets should be recorded in the
+		    catalog (see tablet_exists()).
+		"""
 		self.__pattern = pattern
+		self._set_cgroups(cgroups)
 
-		self._bmaps, self._leaves = self._update(table_path, snapid)
+		self._bmaps, self._leaves, self._snapids = self._update(table_path, snapid)
 		self._rebuild_internal_state()
 
 	def save(self, fn):
+		""" Save the catalog in the memory-mappable format.
+
+		    The file is written to a temporary location and renamed
+		    into place, so processes that have the old file mapped
+		    are not affected.
+		"""
 		dir = os.path.dirname(os.path.normpath(fn))
 		if dir != '':
 			utils.mkdir_p(dir)
-		cPickle.dump((self._bmaps, self._leaves, self._pix), file(fn, mode='w'), -1)
 
-	def load(self, fn):
-		self._bmaps, self._leaves, self._pix = cPickle.load(file(fn))
+		arrays  = [ ('bmap%d' % lev, bmap) for lev, bmap in self._bmaps.iteritems() ]
+		arrays += [ ('leaves', self._leaves), ('cells', self._cells), ('cells_at', self._cells_at) ]
+
+		# Lay out the arrays
+		layout = []
+		offs = 0
+		for name, a in arrays:
+			offs = _round_up(offs, MMAP_ALIGN)
+			descr = a.dtype.descr if a.dtype.names else a.dtype.str
+			layout.append((name, descr, a.shape, offs))
+			offs += a.nbytes
+
+		header = cPickle.dumps(dict(pix=self._pix, snapids=self._snapids, cgroups=self._cgroups, layout=layout), -1)
+		base = _round_up(len(MMAP_MAGIC) + 8 + len(header), MMAP_ALIGN)
+
+		tmp = '%s.%s.%d.tmp' % (fn, socket.gethostname(), os.getpid())
+		with open(tmp, 'wb') as fp:
+			fp.write(MMAP_MAGIC)
+			fp.write(struct.pack('<Q', len(header)))
+			fp.write(header)
+			for (_, a), (_, _, _, offs) in izip(arrays, layout):
+				fp.seek(base + offs)
+				fp.write(np.ascontiguousarray(a).data)
+			fp.truncate(base + _round_up(offs + a.nbytes, MMAP_ALIGN))
+		os.rename(tmp, fn)
 
-		self._rebuild_internal_state()
+	def load(self, fn):
+		""" Load the catalog from fn, memory-mapping it if it's
+		    in the memory-mappable format.
+		"""
+		with open(fn, 'rb') as fp:
+			if fp.read(len(MMAP_MAGIC)) != MMAP_MAGIC:
+				# A pickled catalog, written by an older version of LSD
+				fp.seek(0)
+				self._bmaps, leaves, self._pix = cPickle.load(fp)
+				self._load_pickled_leaves(leaves)
+				self._rebuild_internal_state()
+				return
+
+			try:
+				(hlen,) = struct.unpack('<Q', fp.read(8))
+				header = cPickle.loads(fp.read(hlen))
+				layout = header['layout']
+			except Exception as e:
+				raise Exception("Corrupt catalog file %s (%s)" % (fn, e))
+			base = _round_up(len(MMAP_MAGIC) + 8 + hlen, MMAP_ALIGN)
+
+			# Check all the arrays are there
+			end = max([ offs + np.dtype(descr).itemsize * int(np.prod(shape)) for _, descr, shape, offs in layout ] + [0])
+			if os.fstat(fp.fileno()).st_size < base + end:
+				raise Exception("Truncated catalog file %s" % fn)
+
+			buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+		arrays = dict()
+		for name, descr, shape, offs in layout:
+			dtype = np.dtype(descr)
+			count = int(np.prod(shape))
+			if count:
+				arrays[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=base + offs).reshape(shape)
+			else:
+				arrays[name] = np.empty(shape, dtype=dtype)
+
+		self._pix = header['pix']
+		self._snapids = header['snapids']
+		self._cgroups = header['cgroups']
+		self._bmaps = dict( (lev, arrays['bmap%d' % lev]) for lev in xrange(self._pix.level+1) )
+		self._leaves = arrays['leaves']
+		self._rebuild_internal_state((arrays['cells'], arrays['cells_at']))
+
+	def _load_pickled_leaves(self, leaves):
+		# Convert the leaves of a pickled catalog, where the
+		# snapid column holds the snapshot IDs themselves
+		snapids = sorted(set(leaves['snapid'][2:]))
+		snapidx = dict( (snapid, k) for k, snapid in enumerate(snapids) )
+
+		self._snapids = snapids
+		self._cgroups = []
+		self._leaves = np.zeros(len(leaves), dtype=LEAF_DTYPE)
+		for name in ['mjd', 'cell_id', 'next']:
+			self._leaves[name] = leaves[name]
+		self._leaves['snapidx'][:2] = -1
+		self._leaves['snapidx'][2:] = [ snapidx[snapid] for snapid in leaves['snapid'][2:] ]
+
+		# Empty catalogs used to have an object base bitmap
+		lev = self._pix.level
+		self._bmaps[lev] = self._bmaps[lev].astype(np.int32)
 
 	def clear(self):
 		# Initialize an empty table
 		w = bhpix.width(self._pix.level)
-		self._bmaps = self._compute_mipmaps(np.zeros((w, w), dtype=object))
-		self._leaves = np.empty(2, dtype=[('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')])
-		self._leaves[:2] = [(np.inf, 0, 0, END_MARKER)]*2
+		self._bmaps = self._compute_mipmaps(np.zeros((w, w), dtype=np.int32))
+		self._leaves = np.empty(2, dtype=LEAF_DTYPE)
+		self._leaves[:2] = [(np.inf, -1, 0, END_MARKER, 0)]*2
+		self._snapids = []
+		self._cgroups = []
 		
 		self._rebuild_internal_state()
 
@@ -469,6 +842,17 @@ class TableCatalog:
 			self._pix = pix
 			self.clear()
 
+	def __getstate__(self):
+		# The get_cells() cache stays behind when the catalog is
+		# pickled (e.g., to be sent to the workers of a query)
+		state = self.__dict__.copy()
+		state.pop('_cells_cache', None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._cells_cache = OrderedDict()
+
 	def __eq__(self, b):
 		# Compare Pixelization objects
 		if self._pix != b._pix:
@@ -487,20 +871,21 @@ class TableCatalog:
 
 		# Compare the temporal siblings in each bitmap
 		for offs1, offs2 in izip(bmap1[bmap1 > 1], bmap2[bmap2 > 1]):
-			list1 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _) in iter_siblings(self._leaves, offs1))
-			list2 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _) in iter_siblings(b._leaves,    offs2))
+			list1 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _, _) in self._siblings(offs1))
+			list2 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _, _) in b._siblings(offs2))
 			if list1 != list2:
 				return False
 
 		# Compare _leaves, all columns but 'next'
-		if self._leaves.dtype != b._leaves.dtype:
+		if len(self._leaves) != len(b._leaves):
 			return False
-		names = [ name for name in self._leaves.dtype.names if name != 'next' ]
-		s1 = np.sort(self._leaves, order=names)
-		s2 = np.sort(b._leaves,    order=names)
-		for name in names:
+		s1 = self._leaves[self._cells_at]
+		s2 = b._leaves[b._cells_at]
+		for name in ['mjd', 'cell_id']:
 			if not np.all(s1[name] == s2[name]):
 				return False
+		if [ self._snapids[i] for i in s1['snapidx'] ] != [ b._snapids[i] for i in s2['snapidx'] ]:
+			return False
 
 		# Compare the signs of the 'next' column (== has_data)
 		if not np.all((s1['next'] > 0) == (s2['next'] > 0)):
@@ -524,7 +909,9 @@ def check_table_catalog(table_path, pattern, snapid=None):
 	snapshots = dict(isnapshots(table_path, return_path=True))
 	if snapid is None:
 		snapid = max(snapshots.keys())
-	fn = os.path.join(snapshots[snapid], 'catalog.pkl')
+	fn = os.path.join(snapshots[snapid], 'catalog.mmap')
+	if not os.path.isfile(fn):
+		fn = os.path.join(snapshots[snapid], 'catalog.pkl')
 	cc1 = TableCatalog(fn=fn)
 
 	# Construct one from scratch
@@ -533,6 +920,76 @@ def check_table_catalog(table_path, pattern, snapid=None):
 
 	assert cc1 == cc2
 
+########### Unit tests
+
+class Test_TableCatalog:
+	snapids = [ '20120101000000.000000', '20120102000000.000000' ]
+
+	def setUp(self):
+		import tempfile
+		self.dir = tempfile.mkdtemp()
+		self.pix = Pixelization(6, 54335, 1)
+		self.cells = [ self.pix.cell_id_for_pos(ra, dec) for ra, dec in [ (10, 10), (100, -30), (250, 60) ] ]
+
+		# Cells 0 and 1 written in the first snapshot, 1 and 2 in the second
+		self.cc = TableCatalog(pix=self.pix)
+		for snapid, cells in izip(self.snapids, [ self.cells[:2], self.cells[1:] ]):
+			for cell_id in cells:
+				fn = '%s/tablets/%s/t.main.h5' % (get_snapshot_path(self.dir, snapid), self.pix.path_to_cell(cell_id))
+				utils.mkdir_p(os.path.dirname(fn))
+				with tables.openFile(fn, 'w') as fp:
+					fp.createTable('/main', 'table', np.zeros(1, dtype=[('a', 'i4')]), createparents=True)
+			self.cc.update_cells(self.dir, 't.main.h5', snapid, cells, [ ('main', 't.main.h5') ])
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.dir)
+
+	def _check(self, cc):
+		# cc must describe the same cells as the catalog built in setUp
+		assert cc == self.cc
+		assert sorted(cc.get_cells()) == sorted(self.cells)
+		assert [ cc.snapshot_of_cell(cell_id) for cell_id in self.cells ] == [ self.snapids[0], self.snapids[1], self.snapids[1] ]
+
+	def test_roundtrip(self):
+		""" TableCatalog: save/load (mmap format) """
+		self._check(self.cc)
+
+		fn = os.path.join(self.dir, 'catalog.mmap')
+		self.cc.save(fn)
+		cc = TableCatalog(fn=fn)
+		self._check(cc)
+		assert cc.tablet_exists(self.cells[0], 'main')
+
+	def test_load_pickled(self):
+		""" TableCatalog: load a pickled catalog of older versions """
+		# The pickled leaves stored the snapshot IDs themselves
+		leaves = np.zeros(len(self.cc._leaves), dtype=[('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')])
+		for name in ['mjd', 'cell_id', 'next']:
+			leaves[name] = self.cc._leaves[name]
+		leaves['snapid'][2:] = [ self.cc._snapids[i] for i in self.cc._leaves['snapidx'][2:] ]
+
+		fn = os.path.join(self.dir, 'catalog.pkl')
+		with open(fn, 'wb') as fp:
+			cPickle.dump((self.cc._bmaps, leaves, self.pix), fp, -1)
+		self._check(TableCatalog(fn=fn))
+
+	def test_reject_corrupt(self):
+		""" TableCatalog: refuse to load truncated or corrupt files """
+		fn = os.path.join(self.dir, 'catalog.mmap')
+		self.cc.save(fn)
+		data = open(fn, 'rb').read()
+
+		for bad in [ data[:len(data) // 2], data[:len(MMAP_MAGIC) + 8 + 10], MMAP_MAGIC + data[len(MMAP_MAGIC):][::-1] ]:
+			with open(fn, 'wb') as fp:
+				fp.write(bad)
+			try:
+				TableCatalog(fn=fn)
+			except Exception:
+				pass
+			else:
+				assert False, "Loaded a corrupt catalog"
+
 if __name__ == '__main__':
 	tpath = '/n/pan/mjuric/lsd_test5/ps1_det'
 	#check_table_catalog(tpath, 'ps1_det.astrometry.h5'); exit()
@@ -89,9 +89,7 @@ def compute_coverage(db, query, dx = 0.5, bounds=None, include_cached=False, fil
 def ls_mapper(cell_id, db, tabname):
 	# return the number of rows in this chunk, keyed by the filename
 	try:
-		with db.table(tabname).lock_cell(cell_id) as cell:
-			with cell.open() as fp:
-				n = fp.root.main.table.nrows
+		n = db.table(tabname).count_rows(cell_id)
 	except LookupError:
 		# This can occur when counting from cells in previous snapshots,
 		# and the cell in question was not populated there
@@ -25,6 +25,23 @@ case, returning False.
 
 Line #4 releases the lock named "mylock".
 
+Locks are leases: a lock not renewed within LEASE seconds of being
+acquired (or last renewed) expires, and can be taken by another
+client. This ensures that the locks held by a client that died are
+eventually released. The LockManager client automatically renews the
+leases of the locks it holds. Many locks can be acquired/released in
+a single call:
+
+	lm.acquire_many(["a", "b", "c"])	# 5)
+	acquired = lm.acquire_some(["c", "d"])	# 6)
+	lm.release_many(["a", "b"] + acquired)	# 7)
+
+Line #5 atomically acquires all three locks, blocking until they're
+all available. Line #6 blocks until at least one of the locks is
+available, acquires all of those that are, and returns their names.
+Waiting clients are woken up as soon as the locks they wait for are
+released (or expire).
+
 Notes:
 
 The auto-instantiation code assumes a shared filesystem, but the actual
@@ -37,10 +54,11 @@ TODO:
 
 """
 
-from utils import shell
 from multiprocessing import Process, Queue
 from contextlib import contextmanager
 import os, socket, errno
+import logging
+import locking
 import mr
 import mr.core
 import SimpleXMLRPCServer
@@ -48,13 +66,19 @@ import threading
 import xmlrpclib
 import time
 
+logger = logging.getLogger('lsd.transman')
+
+# Default lease duration (in seconds) of acquired locks
+LEASE = float(os.getenv('LSD_LOCK_LEASE', 120))
+
 class LockManagerServer(object):
 	url = None		# URL of the XMLRPC LockManager service
 	token = None		# Authentification token (password) for the session
 	server = None		# SimpleXMLRPCServer instance
 
 	lock  = None		# Lock for the entire LockManagerServer object (syncronizes access to member variables)
-	locks = None		# The locks the server is managing, dict of name -> [threading.Lock(), nclients]
+	cond  = None		# Condition variable (on lock), notified whenever locks are released
+	locks = None		# The locks the server is managing, dict of name -> (client_id, lease expiration time)
 	cli_lock = None		# Synchronization of access to cli_id and clients variables (Lock instance)
 	cli_id = None		# Next available client ID (an ever-increasing integer)
 	clients = None		# Dict of client_id -> True (for now, later it may map to something more complex)
@@ -67,6 +91,7 @@ class LockManagerServer(object):
 		self.server = server
 
 		self.lock = threading.Lock()
+		self.cond = threading.Condition(self.lock)
 		self.locks = dict()
 		self.cli_id = 0
 		self.clients = dict()
@@ -101,7 +126,7 @@ class LockManagerServer(object):
 			except KeyError:
 				val = 0
 
-			self.variables[var] += n
+			self.variables[var] = val + n
 
 		return val
 	#####
@@ -109,31 +134,131 @@ class LockManagerServer(object):
 	@contextmanager
 	def _lock(self, cred, name):
 		self.acquire(cred, name)
-		yield
-		self.release(cred, name)
+		try:
+			yield
+		finally:
+			self.release(cred, name)
 
-	def _decref(self, name):
-		""" Decrease the reference count of lock 'name' """
-		with self.lock:
-			lockarr = self.locks[name]
-			lock = lockarr[0]
+	def _is_free(self, name, now):
+		""" Test whether lock 'name' can be acquired. Must be
+		    called with self.lock held.
+		"""
+		try:
+			cli_id, expires = self.locks[name]
+		except KeyError:
+			return True
 
-			lockarr[1] -= 1
-			if lockarr[1] == 0:
-				del self.locks[name]
+		if expires > now:
+			return False
+
+		logger.warning("Lease of lock %s (held by client %s) expired." % (name, cli_id))
+		del self.locks[name]
+		return True
+
+	def _wait(self, names, now, deadline):
+		""" Wait until either a lock is released, the earliest
+		    lease on one of the locks in <names> expires, or the
+		    deadline passes. Returns False if the deadline has
+		    passed. Must be called with self.lock held.
+		"""
+		wait = min(self.locks[name][1] for name in names if name in self.locks) - now
+		if deadline is not None:
+			if deadline <= now:
+				return False
+			wait = min(wait, deadline - now)
+
+		self.cond.wait(max(wait, 0.01))
+		return True
+
+	def acquire_many(self, cred, names, timeout=None, lease=None):
+		""" Acquire all locks in <names>, or none of them.
+
+		    Blocks for up to <timeout> seconds (indefinitely, if
+		    None) for all locks to become available. Returns True
+		    if the locks were acquired, False otherwise.
+		"""
+		if not self._check_cred(cred): return None
+		_, cli_id = cred
+		lease = lease or LEASE
+
+		with self.cond:
+			deadline = time.time() + timeout if timeout is not None else None
+			while True:
+				now = time.time()
+				if all(self._is_free(name, now) for name in names):
+					for name in names:
+						self.locks[name] = (cli_id, now + lease)
+					logger.debug("Client %s acquired %d locks" % (cli_id, len(names)))
+					return True
+
+				if not self._wait(names, now, deadline):
+					return False
+
+	def acquire_some(self, cred, names, timeout=None, lease=None):
+		""" Acquire those of the locks in <names> that are
+		    available, returning the list of acquired locks.
+
+		    Blocks for up to <timeout> seconds (indefinitely, if
+		    None) for at least one of the locks to become
+		    available. Returns an empty list if none could be
+		    acquired.
+		"""
+		if not self._check_cred(cred): return None
+		_, cli_id = cred
+		lease = lease or LEASE
+
+		with self.cond:
+			deadline = time.time() + timeout if timeout is not None else None
+			while True:
+				now = time.time()
+				acquired = [ name for name in names if self._is_free(name, now) ]
+				if acquired:
+					for name in acquired:
+						self.locks[name] = (cli_id, now + lease)
+					logger.debug("Client %s acquired %d locks" % (cli_id, len(acquired)))
+					return acquired
+
+				if not self._wait(names, now, deadline):
+					return []
+
+	def release_many(self, cred, names):
+		""" Release the locks in <names> held by the client. Locks
+		    that are not held by the client (e.g., because their
+		    lease has expired) are ignored.
+		"""
+		if not self._check_cred(cred): return None
+		_, cli_id = cred
 
-		return lockarr[0]
+		with self.cond:
+			for name in names:
+				if self.locks.get(name, (None,))[0] == cli_id:
+					del self.locks[name]
+			self.cond.notify_all()
+			logger.debug("Client %s released %d locks" % (cli_id, len(names)))
+
+		return True
+
+	def renew(self, cred, lease=None):
+		""" Renew the leases of all locks held by the client,
+		    returning the number of renewed leases.
+		"""
+		if not self._check_cred(cred): return None
+		_, cli_id = cred
+		lease = lease or LEASE
 
-	def _addref(self, name):
-		""" Increase the reference count of lock 'name' """
 		with self.lock:
-			try:
-				lockarr = self.locks[name]
-				lockarr[1] += 1
-			except KeyError:
-				lockarr = self.locks[name] = [ threading.Lock(), 1 ]
+			expires = time.time() + lease
+			names = [ name for name, (owner, _) in self.locks.iteritems() if owner == cli_id ]
+			for name in names:
+				self.locks[name] = (cli_id, expires)
 
-		return lockarr[0]
+		return len(names)
+
+	def acquire(self, cred, name, blocking=True):
+		return self.acquire_many(cred, [name], None if blocking else 0)
+
+	def release(self, cred, name):
+		return self.release_many(cred, [name])
 
 	def _check_cred(self, cred, token_only=False):
 		if token_only:
@@ -143,26 +268,6 @@ class LockManagerServer(object):
 
 		return token == self.token
 
-	def acquire(self, cred, name, blocking=True):
-		if not self._check_cred(cred): return None
-
-		lock = self._addref(name)
-
-		if lock.acquire(blocking):
-			print "Acquired lock %s" % (name,)
-			return True
-		else:
-			print "Failed to acquire lock %s" % (name,)
-			self._decref(name)
-			return False
-
-	def release(self, cred, name):
-		if not self._check_cred(cred): return None
-
-		lock = self._decref(name)
-		print "Released lock %s" % (name,)
-		return lock.release()
-
 	def register(self, token):
 		if not self._check_cred(token, token_only=True): return None
 
@@ -177,11 +282,15 @@ class LockManagerServer(object):
 		if not self._check_cred(cred): return None
 
 		_, cli_id = cred
+		with self.cond:
+			for name in [ name for name, (owner, _) in self.locks.iteritems() if owner == cli_id ]:
+				del self.locks[name]
+			self.cond.notify_all()
+
 		with self.cli_lock:
 			del self.clients[cli_id]
 			if len(self.clients) == 0:
 				print "Shutting down."
-				assert len(self.locks) == 0
 				#th = threading.Thread(target=self._delayed_shutdown)
 				#th.daemon = True
 				#th.start()
@@ -232,14 +341,18 @@ class LockManager(object):
 	lms = None
 	cred = None
 
+	_held = None		# Names of locks held by this client
+	_renewer = None		# Lease renewal timer thread
+
 	def __init__(self, urlfile):
 		lfile = urlfile + ".lock"
-		shell('lockfile -1 "%s"' % (lfile) )
-		try:
+		with locking.lock(lfile):
 			try:
 				url, token = [ line.strip() for line in open(urlfile).xreadlines() ]
-				lms = xmlrpclib.ServerProxy(url)
-				id = self.lms.register(token)
+				lms = xmlrpclib.ServerProxy(url, allow_none=True)
+				id = lms.register(token)
+				if id is None:
+					raise Exception("Failed to register with the lock manager at %s" % url)
 			except:
 				# Spawn a new LMS and wait for it to become active
 				queue = Queue()
@@ -251,34 +364,105 @@ class LockManager(object):
 				print "OK"
 				lms = xmlrpclib.ServerProxy(url, allow_none=True)
 
+			self.url = url
 			self.lms = lms
 			self.cred = (token, id)
-		finally:
-			os.unlink(lfile)
+
+		self._lock = threading.Lock()
+		self._held = set()
+		self._local = threading.local()
 
 	def __del__(self):
+		if self._renewer is not None:
+			self._renewer.cancel()
 		if self.lms is not None:
 			self.lms.unregister(self.cred)
 
+	## Lease renewal
+	def _renew(self):
+		# Renew the leases from a separate connection, as
+		# ServerProxy instances can't be shared between threads
+		with self._lock:
+			self._renewer = None
+			if not self._held:
+				return
+
+		try:
+			xmlrpclib.ServerProxy(self.url, allow_none=True).renew(self.cred)
+		except Exception as e:
+			logger.warning("Failed to renew lock leases (%s)" % (e,))
+
+		self._schedule_renewal()
+
+	def _schedule_renewal(self):
+		with self._lock:
+			if self._renewer is None and self._held:
+				self._renewer = threading.Timer(LEASE / 3., self._renew)
+				self._renewer.daemon = True
+				self._renewer.start()
+
+	def _acquired(self, names):
+		with self._lock:
+			self._held.update(names)
+		self._schedule_renewal()
+
+	def _released(self, names):
+		with self._lock:
+			self._held.difference_update(names)
+
+	def _proxy(self):
+		# The calling thread's connection to the server, as
+		# ServerProxy instances can't be shared between threads
+		lms = getattr(self._local, 'lms', None)
+		if lms is None:
+			lms = self._local.lms = xmlrpclib.ServerProxy(self.url, allow_none=True)
+		return lms
+
+	## Locking
 	def acquire(self, name, blocking=True):
-		return self.lms.acquire(self.cred, name, blocking)
+		return self.acquire_many([name], None if blocking else 0)
 
 	def release(self, name):
-		return self.lms.release(self.cred, name)
+		return self.release_many([name])
+
+	def acquire_many(self, names, timeout=None):
+		""" Acquire all locks in <names> (or none), waiting for up
+		    to <timeout> seconds. Returns True on success.
+		"""
+		ok = self._proxy().acquire_many(self.cred, names, timeout)
+		if ok:
+			self._acquired(names)
+		return ok
+
+	def acquire_some(self, names, timeout=None):
+		""" Acquire the available locks among <names>, waiting for
+		    up to <timeout> seconds for at least one to become
+		    available. Returns the list of acquired locks.
+		"""
+		acquired = self._proxy().acquire_some(self.cred, names, timeout)
+		self._acquired(acquired)
+		return acquired
+
+	def release_many(self, names):
+		self._released(names)
+		return self._proxy().release_many(self.cred, names)
 
 	def atomic_get(self, name):
-		return self.lms.atomic_get(self.cred, name)
+		return self._proxy().atomic_get(self.cred, name)
 
 	def atomic_add(self, name, val):
-		return self.lms.atomic_add(self.cred, name, val)
+		return self._proxy().atomic_add(self.cred, name, val)
+
+	def atomic_set(self, name, val):
+		return self._proxy().atomic_set(self.cred, name, val)
 
 	@contextmanager
 	def lock(self, name):
 		self.acquire(name)
-		
-		yield True
-		
-		self.release(name)
+		try:
+			yield True
+		finally:
+			self.release(name)
 
 if __name__ == "__main__":
 	print "Here"
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Benchmarking of HDF5 tablet layouts (chunk shapes and compression).
+
+The chunk shape and compression filters of a tablet determine both
+its size on disk and how fast it can be read back. What's best depends
+on the data (how well it compresses) and on the size of the cells, so
+the candidate layouts are benchmarked on a sample of real cells of a
+cgroup: the sampled rows are written out with each candidate layout
+(one HDF5 table per cell, just like in a tablet), and read back.
+
+A layout is scored by its effective read throughput, the number of
+(uncompressed) bytes read per second, counting both the time to read
+and decompress the data from the page cache and the time to bring
+the compressed file in at io_bandwidth bytes per second. The layout
+with the highest effective throughput wins. See lsd-admin tune.
+"""
+
+import os
+import time
+import tempfile
+import tables
+import numpy as np
+
+CHUNK_KB = [ 16, 64, 256, 1024 ]	# Candidate chunk sizes (in kilobytes of uncompressed rows)
+CODECS = [ ('none', 0), ('blosc', 1), ('blosc', 5), ('blosc', 9), ('zlib', 1), ('zlib', 5) ]	# Candidate (complib, complevel) pairs
+IO_BANDWIDTH = 100*1024*1024	# Default assumed bandwidth (bytes/sec) of the filesystem holding the tablets
+REPEAT = 3			# Number of times to read back the samples (the fastest is kept)
+
+class Layout(object):
+	""" A candidate tablet layout """
+	def __init__(self, chunkrows, complib, complevel, shuffle):
+		self.chunkrows = chunkrows
+		self.complib   = complib
+		self.complevel = complevel
+		self.shuffle   = shuffle
+
+	@property
+	def filters(self):
+		""" The filters, as kwargs for tables.Filters (and as stored in cgroup schemas) """
+		if self.complevel == 0:
+			return { 'complevel': 0 }
+		return { 'complib': self.complib, 'complevel': self.complevel, 'shuffle': self.shuffle }
+
+	def __str__(self):
+		if self.complevel == 0:
+			codec = 'none'
+		else:
+			codec = '%s:%d%s' % (self.complib, self.complevel, '+shuffle' if self.shuffle else '')
+		return '%8d rows  %-16s' % (self.chunkrows, codec)
+
+def candidates(dtype, chunk_kb=CHUNK_KB, codecs=CODECS):
+	""" Return the list of candidate Layouts for rows of the given dtype """
+	layouts = []
+	for kb in chunk_kb:
+		chunkrows = max(1, kb * 1024 // dtype.itemsize)
+		for complib, complevel in codecs:
+			for shuffle in ([False] if complevel == 0 else [True, False]):
+				layouts.append(Layout(chunkrows, complib, complevel, shuffle))
+	return layouts
+
+def benchmark(samples, layout, dir=None):
+	""" Write the samples (a list of structured ndarrays, the rows
+	    of sampled cells) with the given layout, and read them back.
+
+	    Returns (nbytes, size, read_time): the number of bytes in
+	    the samples, the size of the file they were stored to, and
+	    the (best) time it took to read them.
+	"""
+	fd, fn = tempfile.mkstemp(suffix='.h5', dir=dir)
+	os.close(fd)
+	try:
+		with tables.openFile(fn, 'w') as fp:
+			for i, rows in enumerate(samples):
+				t = fp.createTable('/', 'cell%d' % i, rows.dtype, expectedrows=len(rows),
+					chunkshape=(layout.chunkrows,), filters=tables.Filters(**layout.filters))
+				t.append(rows)
+		size = os.path.getsize(fn)
+
+		read_time = None
+		for _ in xrange(REPEAT):
+			t0 = time.time()
+			with tables.openFile(fn) as fp:
+				for i in xrange(len(samples)):
+					getattr(fp.root, 'cell%d' % i).read()
+			dt = time.time() - t0
+			read_time = dt if read_time is None else min(read_time, dt)
+	finally:
+		os.unlink(fn)
+
+	nbytes = sum(rows.nbytes for rows in samples)
+	return nbytes, size, read_time
+
+def effective_throughput(nbytes, size, read_time, io_bandwidth=IO_BANDWIDTH):
+	""" Bytes (uncompressed) per second read from a tablet of the
+	    given size, which took read_time to read once cached.
+	"""
+	return nbytes / (read_time + float(size) / io_bandwidth)
+
+def tune(samples, chunk_kb=CHUNK_KB, codecs=CODECS, io_bandwidth=IO_BANDWIDTH, dir=None):
+	""" Benchmark all candidate layouts on the samples.
+
+	    Returns a list of (layout, nbytes, size, read_time,
+	    throughput) tuples, the best layout first.
+	"""
+	results = []
+	for layout in candidates(samples[0].dtype, chunk_kb, codecs):
+		nbytes, size, read_time = benchmark(samples, layout, dir)
+		results.append((layout, nbytes, size, read_time, effective_throughput(nbytes, size, read_time, io_bandwidth)))
+
+	results.sort(key=lambda r: -r[4])
+	return results
@@ -162,6 +162,8 @@ import datetime
 import glob
 import cgi, urllib, urlparse
 import cPickle
+import json
+import math
 import random
 import tempfile
 import mmap
@@ -169,6 +171,7 @@ import struct
 import platform
 import gc
 import binascii
+import zlib
 import select
 import contextlib
 import collections
@@ -178,6 +181,11 @@ from heapq import heappop, heappush, heapify
 import traceback
 import weakref
 
+try:
+	import blosc
+except ImportError:
+	blosc = None
+
 class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
 	def __init__(self, *args, **kwargs):
 		#print >>sys.stderr, kwargs
@@ -192,6 +200,49 @@ class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.Simpl
 # won't fit in memory)
 BUFSIZE = 100 * 2**20 if platform.architecture()[0] == '32bit' else 200 * 2**30
 
+# Gatherer buffers start at this size, and grow as needed. They're
+# backed by files in $TMP (which should be on a local disk), and
+# written back every GATHER_FLUSH bytes so that the kernel can evict
+# them from memory.
+GATHER_BUFSIZE = 64 * 2**20
+GATHER_FLUSH = 64 * 2**20
+
+# Flow control: a Gatherer stops reading from the network while it
+# holds more than GATHER_HIGHWATER bytes not yet consumed by its
+# stage threads (unless one of them waits for data), and a stage
+# thread pauses while it has more than SEND_HIGHWATER bytes that
+# the Scatterer hasn't managed to send.
+GATHER_HIGHWATER = int(float(os.getenv("PYMR_GATHER_HIGHWATER", 2**30)))
+SEND_HIGHWATER = int(float(os.getenv("PYMR_SEND_HIGHWATER", 256 * 2**20)))
+
+# When placing items by data locality, a worker may take up to this many
+# times its fair share of items before the rest go to remote workers
+PLACEMENT_SLACK = float(os.getenv("PYMR_PLACEMENT_SLACK", 1.25))
+
+# Speculative execution (enabled by setting PYMR_SPECULATE=1 in the
+# client's environment): once this fraction of items has been mapped,
+# items running longer than SPECULATE_FACTOR times the median are
+# started again on an idle worker
+SPECULATE_AFTER = float(os.getenv("PYMR_SPECULATE_AFTER", 0.9))
+SPECULATE_FACTOR = float(os.getenv("PYMR_SPECULATE_FACTOR", 3))
+# Number of outputs of a speculatively executed item buffered between
+# its kernel and the stage thread emitting them
+SPECULATE_QUEUE = int(os.getenv("PYMR_SPECULATE_QUEUE", 16))
+
+# Keys sent to reduce stages are hashed into BUCKETS_PER_PEER buckets
+# per Peer. The Coordinator samples the sizes of the buckets for
+# SKEW_SAMPLE_TIME seconds before placing them on workers, and gives
+# the heaviest ones workers of their own.
+BUCKETS_PER_PEER = int(os.getenv("PYMR_BUCKETS_PER_PEER", 8))
+SKEW_SAMPLE_TIME = float(os.getenv("PYMR_SKEW_SAMPLE_TIME", 2))
+
+# The maximum number of Workers streaming the results back to the
+# client (0: one per Peer)
+RESULT_STREAMS = int(os.getenv("PYMR_RESULT_STREAMS", 0))
+
+# Shuffled values shorter than this (pickled) are never compressed
+COMPRESS_MIN = 1024
+
 logger = logging.getLogger('mr')
 
 def RLock(name):
@@ -454,13 +505,15 @@ class Pool:
 
 	def print_status(self, status, nitems):
 		keys_out_prev = nitems
-		for stage, keys_in, values_out, keys_out, ended in status:
+		for stage, keys_in, values_out, keys_out, ended, imbalance in status:
 			try:
 				pct = "%6.2f%%" % (100. * keys_in / keys_out_prev)
 			except TypeError:
 				pct = "       "
 
 			state = "COMPLETED" if ended else "IN PROGRESS"
+			if imbalance is not None:
+				state += ", imbalance %.1fx" % imbalance
 
 			print >>sys.stderr, "Stage %2d: %7d keys to %7d values, %s (%s)" % (stage, keys_in, values_out, pct, state)
 
@@ -468,7 +521,7 @@ class Pool:
 
 	def print_status1(self, status, nitems):
 		keys_out_prev = nitems
-		for stage, keys_in, values_out, keys_out, ended in status:
+		for stage, keys_in, values_out, keys_out, ended, imbalance in status:
 			try:
 				pct = "%6.2f%%" % (100. * keys_in / keys_out_prev)
 			except TypeError:
@@ -479,6 +532,8 @@ class Pool:
 				continue
 
 			state = "COMPLETED" if ended else "IN PROGRESS"
+			if imbalance is not None:
+				state += ", imbalance %.1fx" % imbalance
 
 			sys.stderr.write("\r"+" "*75+"\r")
 			sys.stderr.write("Stage %1d/%1d: %7d keys to %7d values, %s (%s)" % (stage+1, len(status), keys_in, values_out, pct, state))
@@ -497,17 +552,31 @@ class Pool:
 		rfp = urllib.urlopen(rurl)
 		try:
 			while True:
-				queue.put(("RITEM", cPickle.load(rfp)))
+				queue.put(("RITEM", read_frame(rfp)))
 		except EOFError:
 			rfp.close()
+		finally:
+			queue.put(("REOF", rurl))
 
-	def map_reduce_chain(self, items, kernels, locals=[], progress_callback=None):
+	def map_reduce_chain(self, items, kernels, locals=[], progress_callback=None, locality=None):
+		"""
+		Run the chain of kernels on items.
+
+		If given, locality is a list with one entry per item,
+		giving the paths to the data the item will read. The
+		Coordinator uses it to prefer running each item on a
+		Peer that holds those paths on its local disk (see
+		Peer.local_paths).
+		"""
 		# Prepare request
 		spec = TaskSpec(fn, argv, cwd, env, len(items), len(kernels), len(locals))
 		req = {
 			'spec': spec.serialize(),
 			'data': b64encode(cPickle.dumps([kernels, locals], -1) + cPickle.dumps(items, -1)),
 		      }
+		if locality is not None:
+			assert len(locality) == len(items)
+			req['locality'] = json.dumps([ list(paths) for paths in locality ])
 		req = urllib.urlencode(req)
 
 		# Choose a random peer
@@ -526,9 +595,16 @@ class Pool:
 		th.start()
 
 		# Listen for progress messages: a stream of pickled
-		# (msg, args) tuples
-		for (msg, args) in iter(queue.get, ("DONE", None)):
-			if msg == "STATUS":
+		# (msg, args) tuples. The results come from one or more
+		# streams, which must all end before we're done.
+		done, nstreams = False, 0
+		while not done or nstreams:
+			msg, args = queue.get()
+			if msg == "DONE":
+				done = True
+			elif msg == "REOF":
+				nstreams -= 1
+			elif msg == "STATUS":
 				##self.print_status1(args, len(items))
 				##status_args = args
 				self.print_status1(args, len(items))
@@ -538,6 +614,7 @@ class Pool:
 				rurl = args
 				rth = threading.Thread(target=self._result_stream_thread, args=(rurl, queue))
 				rth.start()
+				nstreams += 1
 			elif msg == "RITEM":
 				yield args
 #			else:
@@ -650,7 +727,112 @@ class AsyncoreThread(Thread):
 		#logger.info(self.map)
 		self.schedule( lambda: asyncore.close_all(self.map, ignore_all) )
 
-def serialize_message(fp, stage, key, value):
+def parse_shuffle_codecs(s):
+	"""
+	Parse the value of PYMR_SHUFFLE_COMPRESS into a dict of
+	stage -> codec ('zlib' or 'blosc'), with the key None giving
+	the codec for stages not listed explicitly.
+
+	The value is either a codec name (used for all stages), or a
+	comma-separated list of <stage>:<codec> pairs (e.g., '1:zlib,2:blosc').
+	"""
+	codecs = {}
+	for spec in s.split(','):
+		spec = spec.strip()
+		if not spec:
+			continue
+		stage, _, codec = spec.rpartition(':')
+		stage = int(stage) if stage else None
+		if codec not in ('zlib', 'blosc', 'none'):
+			raise Exception("Unknown shuffle codec '%s'" % codec)
+		if codec == 'blosc' and blosc is None:
+			logger.warning("blosc is not available, using zlib to compress stage %s" % (stage,))
+			codec = 'zlib'
+		codecs[stage] = codec if codec != 'none' else None
+	return codecs
+
+def compress_value(pkl_value, codec):
+	# Compress a pickled value with the given codec, prefixing it
+	# with the codec identifier. Pickles (protocol 2) begin with
+	# '\x80', so uncompressed values need no prefix.
+	if codec is None or len(pkl_value) < COMPRESS_MIN:
+		return pkl_value
+
+	if codec == 'zlib':
+		data = 'Z' + zlib.compress(pkl_value, 1)
+	else:
+		data = 'B' + blosc.compress(pkl_value, 8)
+
+	return data if len(data) < len(pkl_value) else pkl_value
+
+def load_value(data):
+	# Unpickle a value stored by compress_value
+	codec = data[0]
+	if codec == 'Z':
+		data = zlib.decompress(data[1:])
+	elif codec == 'B':
+		data = blosc.decompress(data[1:])
+	return cPickle.loads(data)
+
+def write_frame(fp, value):
+	"""
+	Write a value to a binary result stream.
+
+	The numpy arrays within the value (e.g., the columns of a
+	ColGroup) are sent as raw buffers, following a pickled
+	skeleton of the value that refers to them:
+
+	    [uint64] length of the skeleton
+	    [uint32] number of buffers
+	    [pickle] the skeleton
+	    for each buffer:
+	        [uint64] length of the buffer
+	        [bytes]  the data of the array (C order)
+	"""
+	arrays = []
+	def persistent_id(obj):
+		if type(obj) is np.ndarray and not obj.dtype.hasobject:
+			arrays.append(np.ascontiguousarray(obj))
+			return (len(arrays)-1, obj.dtype, obj.shape)
+		return None
+
+	skel = cStringIO.StringIO()
+	pickler = cPickle.Pickler(skel, -1)
+	pickler.persistent_id = persistent_id
+	pickler.dump(value)
+	skel = skel.getvalue()
+
+	fp.write(struct.pack('<QI', len(skel), len(arrays)))
+	fp.write(skel)
+	for arr in arrays:
+		fp.write(struct.pack('<Q', arr.nbytes))
+		fp.write(buffer(arr))
+
+def read_frame(fp):
+	"""
+	Read a value written by write_frame. Raises EOFError at the
+	end of the stream.
+	"""
+	hdr = fp.read(12)
+	if len(hdr) < 12:
+		raise EOFError()
+	skel_len, nbufs = struct.unpack('<QI', hdr)
+	skel = fp.read(skel_len)
+
+	bufs = []
+	for _ in xrange(nbufs):
+		nbytes, = struct.unpack('<Q', fp.read(8))
+		bufs.append(fp.read(nbytes))
+
+	def persistent_load(pid):
+		idx, dtype, shape = pid
+		return np.fromstring(bufs[idx], dtype=dtype).reshape(shape)
+
+	unpickler = cPickle.Unpickler(cStringIO.StringIO(skel))
+	unpickler.persistent_load = persistent_load
+	return unpickler.load()
+
+def serialize_message(fp, stage, key, value, codec=None):
 	# Serialize the key/value. This defines the packet format
 	# on the wire.
 	pkt_beg = fp.tell()
@@ -660,7 +842,10 @@ def serialize_message(fp, stage, key, value):
 	fp.write(struct.pack('<I', stage))		# 2. [uint32] Destination stage
 
 	cPickle.dump(key, fp, -1)				# 3. [pickle] Key
-	cPickle.dump(value, fp, -1)				# 4. [pickle] Value
+	if codec is None:
+		cPickle.dump(value, fp, -1)			# 4. [pickle] Value
+	else:
+		fp.write(compress_value(cPickle.dumps(value, -1), codec))	# 4. [pickle, optionally compressed] Value
 
 	end = fp.tell()
 	fp.seek(pkt_beg)
@@ -881,6 +1066,14 @@ class Worker(object):
 			assert len(self.buffers[stage]) == 0
 			del self.stage_destinations[stage]
 			del self.buffers[stage]
+			# Forget the destinations of this stage's keys, so that a
+			# later (speculative) run re-registers its channels
+			for key in self.key_destinations.keys():
+				if key[0] == stage:
+					del self.key_destinations[key]
+			for key in self.local_destinations.keys():
+				if key[0] == stage:
+					del self.local_destinations[key]
 			# Close all connections that are serving no-one
 			fd_dest = {}
 			for scs in self.stage_destinations.itervalues():
@@ -963,6 +1156,10 @@ class Worker(object):
 					# Exit if we've filled up the buffer
 					break
 
+			# Let the writer know if it's waiting for us to drain the buffer
+			if stored:
+				buffer.drained_evt.set()
+
 			# Return True if we managed to queue an entire packet, or
 			# if we haven't even begun.
 			return buffer.hash is None or buffer.length == buffer.full_length
@@ -1121,6 +1318,11 @@ class Worker(object):
 
 				asyncore.dispatcher_with_send.__init__(self, sock, map=map)
 
+			def readable(self):
+				# Stop reading (and let TCP flow control push back on
+				# the sender) if our stage threads have fallen behind
+				return self.parent.accepting_data()
+
 			def handle_read(self):
 				# Receive as much as possible into self.buf, and attempt to
 				# process it if the message is complete.
@@ -1204,9 +1406,14 @@ class Worker(object):
 							# we trigger a new_value_evts[key] event and let the _worker know
 							# more is available (performance optimization)
 
-			def __init__(self, size, stage):
+			gatherer = None		# The parent Gatherer
+			nconsumed = 0		# The number of bytes consumed by the readers
+			flushed = 0			# Offset up to which mm has been written back to disk
+
+			def __init__(self, size, stage, gatherer):
 				self.lock = Lock("Buffer(stage=%s)" % stage)
 				self.new_key_evt = Event("new_key_evt")
+				self.gatherer = gatherer
 
 				self.chains = {}
 				self.new_value_evts = {}
@@ -1227,9 +1434,34 @@ class Worker(object):
 				with self.lock:
 					return self._append(key, pkl_value)
 
+			def unconsumed(self):
+				# The number of bytes not yet consumed by the readers
+				return self.mm.tell() - self.nconsumed
+
+			def _consumed(self, nbytes):
+				# Called by the readers to record the consumption of data
+				with self.lock:
+					self.nconsumed += nbytes
+				self.gatherer.data_consumed()
+
+			def _reserve(self, nbytes):
+				# Make room for nbytes more in the buffer, growing the
+				# memory map (and the file behind it) if needed
+				mm = self.mm
+				if mm.tell() + nbytes > len(mm):
+					mm.resize(max(2 * len(mm), mm.tell() + nbytes))
+
+				# Write back what's been buffered so far, so that
+				# these pages may be evicted from memory
+				if mm.tell() - self.flushed > GATHER_FLUSH:
+					end = mm.tell() - mm.tell() % mmap.ALLOCATIONGRANULARITY
+					mm.flush(self.flushed, end - self.flushed)
+					self.flushed = end
+
 			def _append(self, key, pkl_value):
 				# Append the pickled value to the chain of values
 				# for key 'key'
+				self._reserve(len(pkl_value) + 16)
 
 				# Find/create the chain for the key, append pickled value
 				mm = self.mm
@@ -1292,21 +1524,30 @@ class Worker(object):
 				and that the data does not change while this generator exists.
 				"""
 				at = first
-				while True:
-					len, = struct.unpack('<Q', self.mm[at:at+8])
-					at += 8
-					v = cPickle.loads(self.mm[at:at+len])
-					at += len
+				consumed = 0
+				try:
+					while True:
+						len, = struct.unpack('<Q', self.mm[at:at+8])
+						at += 8
+						v = load_value(self.mm[at:at+len])
+						at += len
 
-					yield v
+						consumed += len + 16
+						if consumed >= 2**20:
+							self._consumed(consumed)
+							consumed = 0
 
-					# Reached the end of chain?
-					if at == last:
-						break
+						yield v
+
+						# Reached the end of chain?
+						if at == last:
+							break
 
-					# Load the position of the next packet
-					offs, = struct.unpack('<Q', self.mm[at:at+8])
-					at += offs + 8
+						# Load the position of the next packet
+						offs, = struct.unpack('<Q', self.mm[at:at+8])
+						at += offs + 8
+				finally:
+					self._consumed(consumed)
 
 			def itervalues(self, key, at, last, all_recvd = False):
 				"""
@@ -1354,7 +1595,11 @@ class Worker(object):
 										# Register so that append() and all_received() trip us
 										self.new_value_evts[key] = val_evt, 0
 								#logger.info("Here")
-								val_evt.wait()
+								self.gatherer.consumer_waiting(1)
+								try:
+									val_evt.wait()
+								finally:
+									self.gatherer.consumer_waiting(-1)
 								#logger.info("Woken up key=%s" % key)
 							else:
 								# More data is available
@@ -1409,7 +1654,11 @@ class Worker(object):
 						yield key, value_gen
 					else:
 						# No keys to work on. Sleep waiting for a new one to be added.
-						self.new_key_evt.wait()
+						self.gatherer.consumer_waiting(1)
+						try:
+							self.new_key_evt.wait()
+						finally:
+							self.gatherer.consumer_waiting(-1)
 						self.new_key_evt.clear()
 
 			def all_received(self):
@@ -1432,7 +1681,10 @@ class Worker(object):
 		asyncore_map = None	# asyncore map that Gatherer participates in
 
 		port = None		# The port we're listening on for incoming Scatterer connections
-		bufsize = BUFSIZE	# Buffer size (per stage)
+		bufsize = GATHER_BUFSIZE	# Initial buffer size (per stage)
+
+		nwaiting = 0		# The number of stage threads waiting for data
+		paused = False		# True if we've stopped reading from the network
 
 		buffers = {}		# A dictionary of Buffer instances, keyed by stage
 		lock = None		# Lock guarding the buffers variable
@@ -1464,7 +1716,8 @@ class Worker(object):
 				<h2>Gatherer</h2>
 				<table border=1>
 					<tr><th>Port</th><td>{port}</td></tr>
-					<tr><th>BUFSIZE</th><td>{bufsize}</td></tr>
+					<tr><th>Initial buffer size</th><td>{bufsize}</td></tr>
+					<tr><th>Paused</th><td>{paused}</td></tr>
 				</table>
 				""".format(bufsize=self.bufsize, **self.__dict__)
 
@@ -1497,7 +1750,7 @@ class Worker(object):
 				buf = self.buffers[stage]
 			else:
 				#logger.debug("Creating buffer for stage=%d" % stage)
-				buf = self.buffers[stage] = self.Buffer(self.bufsize, stage)
+				buf = self.buffers[stage] = self.Buffer(self.bufsize, stage, self)
 
 			return buf
 
@@ -1523,6 +1776,38 @@ class Worker(object):
 
 			return buffer.append(key, pkl_value)
 
+		def accepting_data(self):
+			# Return True if we should read more data from the
+			# network. We stop once the stage threads fall behind
+			# by more than GATHER_HIGHWATER bytes, but only while
+			# none of them waits for data, or is blocked sending
+			# (otherwise the data it waits for may be queued behind
+			# the data we refuse to read, and we'd deadlock).
+			with self.lock:
+				accept = self.nwaiting > 0 or sum(buf.unconsumed() for buf in self.buffers.itervalues()) < GATHER_HIGHWATER
+				if self.paused != (not accept):
+					self.paused = not accept
+					logger.info("%s reading from the network" % ("Resumed" if accept else "Paused"))
+			return accept
+
+		def _wakeup(self):
+			# Make the asyncore loop re-check readable()
+			self.parent.asyncore_thread.schedule(lambda: None)
+
+		def consumer_waiting(self, inc):
+			# Called by the stage threads before (inc=1) and after
+			# (inc=-1) they wait for more data
+			with self.lock:
+				self.nwaiting += inc
+				paused = self.paused
+			if paused and inc > 0:
+				self._wakeup()
+
+		def data_consumed(self):
+			# Called by the Buffers when data is consumed
+			if self.paused:
+				self._wakeup()
+
 		def stage_ended(self, stage):
 			# Notification from the coordinator that a particular
 			# stage has ended. That means that all buffers one stage
@@ -1567,7 +1852,7 @@ class Worker(object):
 					self.end_headers()
 		
 					for v in self.server.valiter:
-						cPickle.dump(v, self.wfile, -1)
+						write_frame(self.wfile, v)
 		
 				def log_message(self, format, *args):
 					# Need to override this, otherwise log messages will
@@ -1583,6 +1868,7 @@ class Worker(object):
 			lastq = None		# dequeue containing the last watermark
 	
 			evt = None			# Event to set to signal when there's more data
+			drained_evt = None	# Event set by the Scatterer when it sends out data from the buffer
 			parent = None		# Parent StageRunner instance
 			thread_idx = None	# Thread index (0..nthreads for the stage)
 	
@@ -1594,10 +1880,12 @@ class Worker(object):
 	
 			values_generated = 0 # The number of generated values
 			keys_processed = 0 # The number of processed keys
+			bucket_bytes = None # defaultdict(int): the number of bytes generated for each key hash
 	
 			def __init__(self, parent, thread_idx):
 				self.parent = parent
 				self.thread_idx = thread_idx
+				self.bucket_bytes = defaultdict(int)
 
 				# Cache frequently used values from the parent Runner
 				self.stage = parent.stage
@@ -1606,9 +1894,14 @@ class Worker(object):
 				self.kernels = parent.parent.kernels
 				self.hostname = parent.parent.hostname
 
+				# Compression of the output sent to other Workers
+				codecs = parent.parent.shuffle_codecs
+				self.codec = codecs.get(self.stage+1, codecs.get(None))
+
 				# Output buffer	
 				self.mm = _make_buffer_mmap(self.bufsize)	
 				self.lastq = deque(maxlen=1)
+				self.drained_evt = Event("drained_evt")
 
 				# Support for bypassing TCP if the destination is local
 				self.scatterer = parent.parent.scatterer
@@ -1639,17 +1932,34 @@ class Worker(object):
 					except AttributeError:
 						buffer = self._gatherer_buffer_cache = self.gatherer.get_or_create_buffer(self.stage+1)
 					buffer.append(key, pkl_value)
+					self.bucket_bytes[keyhash] += len(pkl_value)
 				else:
 					# Prepend key hash
 					self.mm.write(struct.pack('<I', keyhash))	# 0. [uint32] Key hash
 		
 					# store the message
-					serialize_message(self.mm, self.stage+1, key, value)
+					at = self.mm.tell()
+					serialize_message(self.mm, self.stage+1, key, value, self.codec)
+					self.bucket_bytes[keyhash] += self.mm.tell() - at
 
 					# Notify the scatterer
 					self.lastq.append(self.mm.tell())
 					if not self.evt.is_set():
 						self.evt.set()
+
+					# Pause while the Scatterer can't keep up (i.e., the
+					# receivers are not accepting more data). While
+					# paused, count as a consumer waiting for data, so
+					# that our own Gatherer keeps reading: the peer we're
+					# blocked on may itself be blocked sending to us.
+					if self.mm.tell() - self.at > SEND_HIGHWATER:
+						self.gatherer.consumer_waiting(1)
+						try:
+							while self.mm.tell() - self.at > SEND_HIGHWATER:
+								self.drained_evt.wait(1)
+								self.drained_evt.clear()
+						finally:
+							self.gatherer.consumer_waiting(-1)
 	
 			def _serve_results(self, kv):
 				"""
@@ -1669,6 +1979,87 @@ class Worker(object):
 				httpd.handle_request()
 				logger.info("Results served")
 
+			def _run_item(self, idx, val, K_fun, K_args):
+				# Run the stage 0 kernel on a single item. With
+				# speculative execution, another copy of the item
+				# may be running elsewhere: the outputs are emitted
+				# only if the Coordinator lets us claim the item
+				# (once it yields its first output, or ends), so
+				# that downstream stages see them once.
+				worker = self.parent.parent
+				if not worker.speculate:
+					for res in K_fun(val, *K_args):
+						yield res
+					return
+
+				if idx in worker.cancelled:
+					# Another copy has already been claimed
+					logger.info("Item %s already done elsewhere, skipping on %s" % (idx, worker.url))
+					return
+
+				with self.coordinator() as coord:
+					coord.item_started(worker.url, idx)
+
+				# Run the kernel in a separate daemon thread, streaming
+				# its outputs through a bounded queue. This thread (and
+				# with it, the end of the stage) then doesn't wait for a
+				# straggler whose item has been claimed elsewhere: the
+				# straggler is abandoned, and stops at its next output.
+				stop = Event("item_stop")
+				def stopped():
+					return stop.is_set() or idx in worker.cancelled
+
+				outq = Queue.Queue(SPECULATE_QUEUE)
+				def put(msg):
+					while not stopped():
+						try:
+							outq.put(msg, timeout=1.)
+							return
+						except Queue.Full:
+							pass
+
+				def _kernel():
+					try:
+						for res in K_fun(val, *K_args):
+							if stopped():
+								return
+							put(('RESULT', res))
+						put(('END', None))
+					except:
+						put(('EXCEPT', sys.exc_info()))
+
+				th = threading.Thread(target=_kernel, name="Item-%s" % (idx,))
+				th.daemon = True
+				th.start()
+
+				claimed = False
+				try:
+					while True:
+						if not claimed and idx in worker.cancelled:
+							logger.info("Item %s cancelled on %s, abandoning it" % (idx, worker.url))
+							return
+
+						try:
+							what, data = outq.get(timeout=1.)
+						except Queue.Empty:
+							continue
+
+						if what == 'EXCEPT':
+							raise data[0], data[1], data[2]
+
+						if not claimed:
+							with self.coordinator() as coord:
+								claimed = coord.claim_item(worker.url, idx)
+							if not claimed:
+								return
+
+						if what == 'END':
+							return
+						yield data
+				finally:
+					# Let the kernel thread know if we've given up on it
+					stop.set()
+
 			def run(self):
 				# Executes the kernel for a given stage in
 				# a separate thread (called from start())
@@ -1683,7 +2074,7 @@ class Worker(object):
 						_, v = kv
 						items = list(v)
 						for k, item in enumerate(items[0]):
-							yield k, item
+							yield k, (k, item)
 					K_fun, K_args = K_start, ()
 				elif stage == len(self.kernels):
 					# Server kernel (serves the results back to the user)
@@ -1693,25 +2084,32 @@ class Worker(object):
 	
 					if stage == 0:
 						# stage = 0 kernel has a thin wrapper removing
-						# the keys before passing the values to the mapper
+						# the keys (and item indices) before passing the
+						# values to the mapper
 						def K(kv, K_fun, K_args):
 							_, v = kv
-							for val in v:
-								for res in K_fun(val, *K_args):
+							for idx, val in v:
+								for res in self._run_item(idx, val, K_fun, K_args):
 									yield res
 						K_fun, K_args = K, (K_fun, K_args)
 	
 					if stage == len(self.kernels)-1:
 						# last stage has a wrapper keying the outputs
-						# to the same value (so they get redirected to
-						# the collector)
-						def K(kv, K_fun, K_args):
+						# by this Worker (so that all of them get
+						# redirected to the same collector)
+						def K(kv, K_fun, K_args, url=self.parent.parent.url):
 							for res in K_fun(kv, *K_args):
-								yield (0, res)
+								yield (url, res)
 						K_fun, K_args = K, (K_fun, K_args)
 	
 				# Do the actual work
-				for key, valgen in self.gatherer.iteritems(stage):
+				if self.parent.items is None:
+					source = self.gatherer.iteritems(stage)
+				else:
+					# Speculative run of selected stage 0 items
+					items = self.parent.parent.task_items()
+					source = [ (None, ((idx, items[idx]) for idx in self.parent.items)) ]
+				for key, valgen in source:
 					for kv in K_fun((key, valgen), *K_args):
 						self.values_generated += 1
 						self.queue(kv)
@@ -1727,20 +2125,30 @@ class Worker(object):
 		stage = None
 		parent = None		# Parent Worker instance
 		nthreads = None		# The total number of threads to be executed for this stage
+		items = None		# Indices of items to run for a speculative run of stage 0 (None otherwise)
+		key = None			# The key of this runner in parent.stage_runners
 
 		threads = None		# dict:thread_idx->StageThread of threads still running
 		lock = None			# Lock protecting self.threads
 
 		keys_processed = None	# The number of keys processed by _completed_ threads
 		values_generated = None	# The number of values generated by _completed_ threads
+		bucket_bytes = None		# The number of bytes generated for each key hash by _completed_ threads
 		
 		monitor_evt = None	# Event used to signal the monitor thread that something happened
 
-		def __init__(self, parent, stage, maxpeers, nthreads):
+		def __init__(self, parent, stage, maxpeers, nthreads, placement=None, items=None):
 			self.parent = parent
 			self.stage = stage
 			self.maxpeers = maxpeers
 			self.nthreads = nthreads
+			self.items = items
+			self.key = stage if items is None else (stage, tuple(items))
+
+			if placement is not None:
+				# The Coordinator has decided where each
+				# key goes (see _Coordinator._place_items)
+				self.hash_key = placement.__getitem__
 			
 			self.threads = dict()
 			self.lock = Lock("StageRunner-%s" % stage)
@@ -1749,6 +2157,7 @@ class Worker(object):
 			
 			self.keys_processed = 0
 			self.values_generated = 0
+			self.bucket_bytes = defaultdict(int)
 
 			# Initialize the thread object
 			threading.Thread.__init__(self, name='Monitor-%1d' % (self.stage))
@@ -1763,6 +2172,8 @@ class Worker(object):
 
 				# Remember the number of keys/values processed, for later
 				self.keys_processed, self.values_generated = th.keys_processed, th.values_generated
+				for keyhash, nbytes in th.bucket_bytes.iteritems():
+					self.bucket_bytes[keyhash] += nbytes
 
 			# Let the coordinator know a thread has ended
 			with self.parent.coordinator() as coord:
@@ -1783,10 +2194,11 @@ class Worker(object):
 			# Ran from the monitor thread, once all stage threads exit.
 			# Let the parent know we're done.
 			logger.debug("Here")
-			self.parent._unregister_stage_runner(self.stage)
+			self.parent._unregister_stage_runner(self.key)
 
 			# Let the gatherer know we're done consuming
-			self.parent.gatherer.worker_done_with_stage(self.stage)
+			if self.items is None:
+				self.parent.gatherer.worker_done_with_stage(self.stage)
 
 		def run(self):
 			# Periodically report our progress to the Coordinator,
@@ -1831,17 +2243,26 @@ class Worker(object):
 		def report_progress(self, force=False):
 			# Collect progress info from threads processing this
 			# stage, and report to the Coordinator
+			if self.items is not None:
+				# Speculative runs are tracked per item
+				return
+
 			keys_processed = self.keys_processed
 			values_generated = self.values_generated
+			bucket_bytes = defaultdict(int, self.bucket_bytes)
 
 			with self.lock:
 				for th in self.threads.itervalues():
 					keys_processed += th.keys_processed
 					values_generated += th.values_generated
+					for keyhash, nbytes in th.bucket_bytes.items():
+						bucket_bytes[keyhash] += nbytes
 
-			# Report back to the coordinator
+			# Report back to the coordinator (sizes as floats,
+			# as XMLRPC integers are limited to 32 bits)
+			bucket_bytes = [ (keyhash, float(nbytes)) for keyhash, nbytes in bucket_bytes.iteritems() ]
 			with self.parent.coordinator() as coord:
-				coord.progress_report(self.parent.url, self.stage, keys_processed, values_generated)
+				coord.progress_report(self.parent.url, self.stage, keys_processed, values_generated, bucket_bytes)
 
 	### Worker ################################
 	server  = None		# XMLRPC server instance
@@ -1857,7 +2278,11 @@ class Worker(object):
 	scatterer = None	# Scatterer instance
 	asyncore_thread = None	# AsyncoreThread instance running asyncore.loop with the gatherer and scatterer
 
-	stage_runners = None	# dict:stage->StageRunner for active stages
+	stage_runners = None	# dict:stage->StageRunner for active stages (StageRunner.key->StageRunner, in general)
+
+	speculate = False	# True if stage 0 items may be executed speculatively
+	shuffle_codecs = None	# dict: stage -> codec used to compress data sent to that stage (see parse_shuffle_codecs)
+	cancelled = None	# set of indices of stage 0 items that another worker has completed
 	
 	t_started = None	# Time when we launched
 
@@ -1942,6 +2367,12 @@ class Worker(object):
 		self.stage_runners = dict()
 		self.lock      = RLock("Worker")
 
+		self.speculate = os.getenv("PYMR_SPECULATE", "0") not in ("", "0")
+		self.cancelled = set()
+
+		# Compression of shuffled values, per destination stage
+		self.shuffle_codecs = parse_shuffle_codecs(os.getenv("PYMR_SHUFFLE_COMPRESS", ""))
+
 		# Time when we launched
 		self.t_started = datetime.datetime.now()
 
@@ -1973,15 +2404,27 @@ class Worker(object):
 
 		# Place the (pickled) items on the gatherer's queue
 		if True:
-			self.gatherer.append(-1, 0, fp.read())
+			self._items_pkl = fp.read()
+			self.gatherer.append(-1, 0, self._items_pkl)
 		else:
 			items = cPickle.load(fp)
 			for item in items:
 				self.gatherer.append(-1, 0, cPickle.dumps(item, -1))
 		self.stage_ended(-2)
 
-	def run_stage(self, stage, maxpeers):#, nthreads=1, npeers=100):
-		# Start running a stage, in a separate thread
+	def task_items(self):
+		# Return the list of all items of the task
+		with self.lock:
+			try:
+				return self._items
+			except AttributeError:
+				self._items = cPickle.loads(self._items_pkl)
+				return self._items
+
+	def run_stage(self, stage, maxpeers, placement=None, items=None):#, nthreads=1, npeers=100):
+		# Start running a stage, in a separate thread. If given,
+		# placement[key] is the hash of output key 'key'. If items
+		# is given, run (speculatively) only these stage 0 items.
 		# WARNING: This routine must not call back into the
 		#          Coordinator (will deadlock)
 		logger.debug("Starting stage %s on %s (maxpeers=%s)" % (stage, self.url, maxpeers))
@@ -1990,17 +2433,25 @@ class Worker(object):
 		with self.lock:
 			logger.debug("Entered lock")
 			assert -1 <= stage <= len(self.kernels)
-			assert stage not in self.stage_runners
-			sr = self.stage_runners[stage] = self.StageRunner(self, stage, maxpeers, 1)
+			sr = self.StageRunner(self, stage, maxpeers, 1, placement, items)
+			assert sr.key not in self.stage_runners
+			self.stage_runners[sr.key] = sr
 
 		sr.start()
 
-	def _unregister_stage_runner(self, stage):
+	def cancel_item(self, idx):
+		# Notification from the coordinator that another worker
+		# has completed stage 0 item idx
+		with self.lock:
+			self.cancelled.add(idx)
+		return True
+
+	def _unregister_stage_runner(self, key):
 		# Called by StageRunner._monitor when all stage threads end
 		with self.lock:
-			logger.debug("Unregistering runner for stage=%s" % stage)
-			assert stage in self.stage_runners
-			del self.stage_runners[stage]
+			logger.debug("Unregistering runner %s" % (key,))
+			assert key in self.stage_runners
+			del self.stage_runners[key]
 
 	def stage_ended(self, stage):
 		# Notification from the coordinator that a particular
@@ -2058,6 +2509,7 @@ class Peer:
 			nkeys                 = None	# defaultdict(int): the number of keys assigned to this worker, per stage
 			process               = None	# subprocess.Popen class for local workers, None for remote workers
 			processing_status = None # dict:stage->count -- The number of keys already processed
+			bucket_bytes = None	# dict:stage->dict(keyhash->bytes) -- The amount of data generated for each key hash of stage
 
 			def __eq__(self, other):
 				return self.url == other.url
@@ -2078,7 +2530,8 @@ class Peer:
 				the run in running_stage_threads
 				"""
 				self.running_stage_threads[stage] += 1
-				self.processing_status[stage] = np.zeros(2, dtype=int)
+				if stage not in self.processing_status:
+					self.processing_status[stage] = np.zeros(2, dtype=int)
 				ret = self.__getattr__('run_stage')(stage, *args, **kwargs)
 
 				for worker in self.parent.workers.itervalues():
@@ -2092,7 +2545,7 @@ class Peer:
 				return ret
 
 			def __init__(self, parent, url, purl, process=None):
-				xmlrpclib.ServerProxy.__init__(self, url)
+				xmlrpclib.ServerProxy.__init__(self, url, allow_none=True)
 
 				self.parent = parent
 				self.url = url
@@ -2102,6 +2555,7 @@ class Peer:
 				self.running_stage_threads = defaultdict(int)
 				self.nkeys = defaultdict(int)
 				self.processing_status = {}
+				self.bucket_bytes = {}
 
 		## _Coordinator ####################
 		id		= None	# Unique task ID
@@ -2122,6 +2576,20 @@ class Peer:
 		destinations = None	# destinations[stage][key] gives the WorkerProxy that receives (stage, key) data
 		maxpeers = None # dict:stage -> maxpeers
 
+		locality = None		# list of lists of paths to data read by each item (or None)
+		slot_workers = None	# slot_workers[key] gives the WorkerProxy for stage 0 key, if placed by locality
+
+		balanced_workers = None	# dict: stage -> list of WorkerProxy among which buckets are balanced by size
+		dedicated_workers = None # dict: stage -> set(WorkerProxy) of workers given a heavy bucket of their own
+		final_imbalance = None	# dict: stage -> the imbalance of a balanced stage, once it has ended
+		sampling = None		# Condition notified once the buckets of a stage are placed
+
+		speculate = False	# True if straggling stage 0 items are to be re-executed on idle workers
+		item_attempts = None	# dict: item -> list of (wurl, t_started) of its running copies
+		item_done = None	# dict: item -> wurl of the worker whose copy finished first
+		item_durations = None	# list of durations of finished items
+		speculated = None	# set of items for which a speculative copy was started
+
 		all_peers = None		# The set of all peers
 		free_peers = None		# The set of currently unused peers
 		free_peers_last_refresh = 0	# The last time when free_peers was refreshed from the Directory
@@ -2131,10 +2599,11 @@ class Peer:
 		
 		ended_stages = None # dict: stages->nkeys_produced for stages that have ended
 
-		def progress_report(self, wurl, stage, keys_processed, values_generated):
+		def progress_report(self, wurl, stage, keys_processed, values_generated, bucket_bytes=()):
 			with self.lock:
 				worker = self.workers[wurl]
 				worker.processing_status[stage][:] = (keys_processed, values_generated)
+				worker.bucket_bytes[stage+1] = dict(bucket_bytes)
 
 				self._report_status_to_client()
 
@@ -2168,7 +2637,7 @@ class Peer:
 						except KeyError:
 							keys_out, ended = None, False
 						keys_in, values_out = stage_status[stage] if stage in stage_status else (0, 0)
-						report.append((stage, keys_in, values_out, keys_out, ended))
+						report.append((stage, keys_in, values_out, keys_out, ended, self._imbalance(stage)))
 				self._progress("STATUS", report)
 				self.tprog = time.time()
 
@@ -2207,7 +2676,7 @@ class Peer:
 		
 			return info
 
-		def __init__(self, server, hostname, parent_url, id, spec, data):
+		def __init__(self, server, hostname, parent_url, id, spec, data, locality=None):
 			self.lock    = RLock("Coordinator")
 
 			self.pserver = xmlrpclib.ServerProxy(parent_url)
@@ -2220,11 +2689,22 @@ class Peer:
 			self.id      = id
 			self.spec    = TaskSpec.unserialize(spec)
 			self.data    = data
+			self.locality = locality
+
+			self.speculate = self.spec.env.get("PYMR_SPECULATE", "0") not in ("", "0")
+			self.item_attempts = defaultdict(list)
+			self.item_done = {}
+			self.item_durations = []
+			self.speculated = set()
 			self.queue   = Queue.Queue()
 			self.workers = {}
 			self.worker_heap = []
 			self.destinations = defaultdict(dict)
 			self.maxpeers = dict()
+			self.balanced_workers = {}
+			self.dedicated_workers = {}
+			self.final_imbalance = {}
+			self.sampling = threading.Condition(self.lock)
 			
 			self.ended_stages = {}
 
@@ -2355,6 +2835,8 @@ class Peer:
 					self.ended_stages[stage] = nkeys
 
 					# Remove this stage from the destinations map
+					if stage in self.balanced_workers:
+						self.final_imbalance[stage] = self._imbalance(stage)
 					try:
 						del self.destinations[stage]
 						del self.maxpeers[stage]
@@ -2423,21 +2905,255 @@ class Peer:
 			Return the maximum number of Peers that will execute a stage
 			
 			This is taken to be equal to the number of peers that are
-			running at the time of first call for a given stage. If stage
-			is equal to spec.nkernels, 1 is returned (as all results
-			have to be funneled to a single Worker, for the delivery to
-			the user)
+			running at the time of first call for a given stage. For
+			stage spec.nkernels, this is the maximum number of streams
+			that return the results to the user (RESULT_STREAMS, if
+			set).
 			"""
 			with self.lock:
 				if stage not in self.maxpeers:
-					if stage == self.spec.nkernels:
-						return 1
-					else:
-						self._refresh_peers()
-						self.maxpeers[stage] = len(self.all_peers)
+					self._refresh_peers()
+					self.maxpeers[stage] = len(self.all_peers)
+					if stage == self.spec.nkernels and RESULT_STREAMS:
+						self.maxpeers[stage] = min(self.maxpeers[stage], RESULT_STREAMS)
 
 				return self.maxpeers[stage]			
 
+		def _place_items(self):
+			"""
+			Assign items to workers, preferring the workers whose
+			Peers hold the items' data locally.
+
+			Each worker gets a stage 0 key (its slot), and the
+			list of the slots of the items is returned. An item
+			goes to the least loaded of the workers holding most
+			of its data. Items with no local worker, or whose
+			local workers already have more than PLACEMENT_SLACK
+			times their fair share of items, are used to balance
+			the load among the remaining workers.
+			"""
+			with self.lock:
+				workers = sorted(self.workers.itervalues(), key=lambda w: w.purl)
+
+			# Ask the Peers which of the paths they hold locally
+			paths = sorted(set(path for item_paths in self.locality for path in item_paths))
+			pidx = dict((path, i) for i, path in enumerate(paths))
+			is_local = np.zeros((len(workers), len(paths)), dtype=bool)
+			for i, worker in enumerate(workers):
+				peer = self.pserver if worker.purl == self.purl else xmlrpclib.ServerProxy(worker.purl)
+				is_local[i, np.array(peer.local_paths(paths), dtype=int)] = True
+
+			# score[item, worker]: the number of item's paths local to the worker
+			nitems, nworkers = len(self.locality), len(workers)
+			score = np.zeros((nitems, nworkers), dtype=int)
+			for k, item_paths in enumerate(self.locality):
+				for path in item_paths:
+					score[k] += is_local[:, pidx[path]]
+			nlocal = (score != 0).sum(axis=1)
+
+			# Place the items with the fewest choices first, leaving
+			# the items with no local data for the end
+			cap = int(math.ceil(PLACEMENT_SLACK * nitems / nworkers))
+			load = np.zeros(nworkers, dtype=int)
+			placement = [ None ] * nitems
+			nplaced_local = 0
+			for k in sorted(xrange(nitems), key=lambda k: (nlocal[k] == 0, nlocal[k])):
+				candidates = np.flatnonzero(score[k] == score[k].max()) if nlocal[k] else []
+				if len(candidates):
+					i = candidates[np.argmin(load[candidates])]
+					if load[i] < cap:
+						nplaced_local += 1
+					else:
+						i = None
+				else:
+					i = None
+				if i is None:
+					i = np.argmin(load)
+
+				placement[k] = int(i)
+				load[i] += 1
+
+			with self.lock:
+				self.slot_workers = workers
+				self.maxpeers[0] = nworkers
+
+			logger.info("Placed %d of %d items on workers holding their data" % (nplaced_local, nitems))
+			self._progress("PLACEMENT", (nplaced_local, nitems))
+
+			return placement
+
+		def item_started(self, wurl, idx):
+			# Called by a Worker when it starts mapping an item
+			with self.lock:
+				self.item_attempts[idx].append((wurl, time.time()))
+
+		def claim_item(self, wurl, idx):
+			# Called by a Worker before it emits the results of an
+			# item (once the kernel yields its first output, or
+			# ends). Returns True if this is the first copy of the
+			# item to get there, and cancels the others.
+			with self.lock:
+				if idx in self.item_done:
+					return False
+				self.item_done[idx] = wurl
+
+				attempts = self.item_attempts.pop(idx)
+				for url, t_started in attempts:
+					if url == wurl:
+						self.item_durations.append(time.time() - t_started)
+					else:
+						logger.info("Cancelling item %s on %s (finished on %s)" % (idx, url, wurl))
+						Thread(target=self.workers[url].cancel_item, args=(idx,)).start()
+
+				if len(attempts) > 1:
+					self._progress("SPECULATION_RESULT", (idx, wurl))
+
+			return True
+
+		def _speculate(self):
+			"""
+			Launch speculative copies of straggling stage 0 items.
+
+			Once SPECULATE_AFTER of all items have been mapped,
+			an item running for more than SPECULATE_FACTOR
+			times the median item duration is also started on an
+			idle worker (one not running stage 0). The copy that
+			finishes first claims the item (see claim_item),
+			and the other one is cancelled.
+			"""
+			with self.lock:
+				ndone = len(self.item_done)
+				if ndone == 0 or ndone < SPECULATE_AFTER * self.spec.nitems:
+					return
+				tmax = SPECULATE_FACTOR * np.median(self.item_durations)
+
+				idle = [ worker for worker in self.workers.itervalues()
+						if 0 not in worker.running_stage_threads and -1 not in worker.running_stage_threads ]
+				now = time.time()
+				for idx, attempts in self.item_attempts.iteritems():
+					if not len(idle):
+						break
+					if idx in self.speculated or now - attempts[0][1] <= tmax:
+						continue
+
+					worker = idle.pop()
+					logger.info("Item %s running for %.1fs on %s, starting a copy on %s" % (idx, now - attempts[0][1], attempts[0][0], worker.url))
+					worker.run_stage(0, self._nbuckets(1), None, [idx])
+					self.speculated.add(idx)
+					self._progress("SPECULATE", (idx, attempts[0][0], worker.url))
+
+		def _speculation_thread(self):
+			# Look for stragglers until stage 0 ends
+			while 0 not in self.ended_stages:
+				time.sleep(1)
+				self._speculate()
+
+		def _pop_worker(self, worker):
+			# Remove the worker from worker_heap, returning its load
+			for i, (nkeys, w) in enumerate(self.worker_heap):
+				if w is worker:
+					del self.worker_heap[i]
+					heapify(self.worker_heap)
+					return nkeys
+			raise KeyError(worker.url)
+
+		def _nbuckets(self, stage):
+			"""
+			Return the number of buckets that the keys sent to
+			stage 'stage' are hashed into.
+
+			Reduce stages get BUCKETS_PER_PEER buckets per Peer,
+			so that the buckets can be balanced by their sizes (see
+			_assign_buckets).
+			"""
+			if stage > self.spec.nkernels:
+				return 1
+
+			nbuckets = self._maxpeers(stage)
+			if 1 <= stage < self.spec.nkernels:
+				nbuckets *= BUCKETS_PER_PEER
+			return nbuckets
+
+		def _bucket_sizes(self, stage):
+			# Return a dict with the number of bytes generated
+			# so far for each bucket of the stage
+			sizes = defaultdict(float)
+			for worker in self.workers.itervalues():
+				for keyhash, nbytes in worker.bucket_bytes.get(stage, {}).iteritems():
+					sizes[int(keyhash)] += nbytes
+			return sizes
+
+		def _worker_loads(self, stage):
+			# Return a dict with the number of bytes sent so far
+			# to each worker running the (balanced) stage
+			sizes = self._bucket_sizes(stage)
+			loads = dict((worker, 0.) for worker in self.balanced_workers[stage])
+			for keyhash, worker in self.destinations[stage].iteritems():
+				loads[worker] = loads.get(worker, 0.) + sizes.get(keyhash, 0.)
+			return loads
+
+		def _imbalance(self, stage):
+			# Return the ratio of the data sent to the most loaded
+			# worker and the average, for stages whose buckets were
+			# placed by size (None otherwise)
+			with self.lock:
+				if stage in self.final_imbalance:
+					return self.final_imbalance[stage]
+				if stage not in self.balanced_workers:
+					return None
+				loads = self._worker_loads(stage)
+
+			mean = sum(loads.itervalues()) / len(loads)
+			return max(loads.itervalues()) / mean if mean else None
+
+		def _least_loaded(self, stage, loads):
+			# Return the worker with the least data of the stage,
+			# that was not given a heavy bucket of its own
+			dedicated = self.dedicated_workers[stage]
+			candidates = [ worker for worker in loads if worker not in dedicated ] or loads.keys()
+			return min(candidates, key=lambda worker: (loads[worker], worker.url))
+
+		def _assign_buckets(self, stage):
+			"""
+			Place the buckets of stage seen so far on workers,
+			balancing the amount of data they'll receive.
+
+			The buckets are placed from the largest down, each on
+			the least loaded worker. A bucket larger than the
+			average load of a worker gets that worker to itself.
+			"""
+			sizes = self._bucket_sizes(stage)
+			self.balanced_workers[stage] = self.workers.values()
+			dedicated = self.dedicated_workers[stage] = set()
+			loads = self._worker_loads(stage)
+			mean = sum(sizes.itervalues()) / len(loads)
+
+			for keyhash, nbytes in sorted(sizes.iteritems(), key=lambda (keyhash, nbytes): (-nbytes, keyhash)):
+				worker = self._least_loaded(stage, loads)
+				if nbytes >= mean and loads[worker] == 0:
+					dedicated.add(worker)
+				loads[worker] += nbytes
+				self._set_destination(stage, keyhash, worker, self._pop_worker(worker))
+
+			logger.info("Placed %d buckets of stage %s (%d dedicated workers, imbalance %s)" % (len(sizes), stage, len(dedicated), self._imbalance(stage)))
+
+		def _set_destination(self, stage, key, worker, nkeys):
+			# Send the key of the stage to the worker, whose load
+			# (popped off the worker_heap) is nkeys
+
+			# Start the stage if not already running
+			if stage not in worker.running_stage_threads:
+				worker.run_stage(stage, self._nbuckets(stage+1))
+
+			# Remember the destination for this key
+			self.destinations[stage][key] = worker
+
+			worker.nkeys[stage] += 1
+			nkeys += 1
+			heappush(self.worker_heap, (nkeys, worker))
+
+			logger.info("Returning %s (load: nkeys=%s)" % (worker.url, nkeys))
+
 		def start(self):
 			# Called by the Peer that launched us to start the 
 			# first Worker and stage.
@@ -2453,13 +3169,22 @@ class Peer:
 			for th in ths:
 				th.join()
 
+			# If the client told us where the data of each item
+			# lives, decide up front which worker will map it
+			placement = self._place_items() if self.locality is not None else None
+
 			# Start the first stage on one of the workers
 			with self.lock:
 				nkeys, worker = heappop(self.worker_heap)
-				worker.run_stage(-1, self._maxpeers(0))
+				worker.run_stage(-1, self._nbuckets(0), placement)
 				worker.nkeys[-1] += 1
 				heappush(self.worker_heap, (nkeys+1, worker))
 
+			if self.speculate:
+				th = Thread(name='Speculate', target=self._speculation_thread)
+				th.daemon = True
+				th.start()
+
 		def get_destinations(self, stage, key):
 			"""
 			Get all known key->wurl pairs for the stage 'stage', ensuring
@@ -2467,12 +3192,32 @@ class Peer:
 			"""
 			logger.info("Get destination for stage=%s key=%s" % (stage, key))
 			with self.lock:
+				balance = BUCKETS_PER_PEER > 1 and 1 <= stage < self.spec.nkernels
+				if key not in self.destinations[stage] and balance and stage not in self.balanced_workers:
+					# First key of a reduce stage. Let the upstream
+					# workers generate some data to sample the sizes of
+					# the buckets, and then place them.
+					deadline = time.time() + SKEW_SAMPLE_TIME
+					while stage not in self.balanced_workers and time.time() < deadline:
+						self.sampling.wait(deadline - time.time())
+					if stage not in self.balanced_workers:
+						self._assign_buckets(stage)
+						self.sampling.notify_all()
+
 				if key not in self.destinations[stage]:
 					# Refresh the list of unused peers every 60 sec or so...
 					self._refresh_peers()
 
 					logging.debug("Here: free_peers=%s", self.free_peers)
-					if len(self.free_peers):
+					if stage == 0 and self.slot_workers is not None:
+						# Placed by data locality
+						worker = self.slot_workers[key]
+						nkeys = self._pop_worker(worker)
+					elif balance:
+						# Placed by size
+						worker = self._least_loaded(stage, self._worker_loads(stage))
+						nkeys = self._pop_worker(worker)
+					elif len(self.free_peers):
 						# Prefer a Peer we're not yet running on
 						purl = random.choice(self.free_peers)
 						worker = self._start_remote_worker(purl)
@@ -2483,18 +3228,7 @@ class Peer:
 						#worker = random.choice(self.workers.values())
 						nkeys, worker = heappop(self.worker_heap)
 
-					# Start the stage if not already running
-					if stage not in worker.running_stage_threads:
-						worker.run_stage(stage, self._maxpeers(stage))
-
-					# Remember the destination for this key
-					self.destinations[stage][key] = worker
-
-					worker.nkeys[stage] += 1
-					nkeys += 1
-					heappush(self.worker_heap, (nkeys, worker))
-
-					logger.info("Returning %s (load: nkeys=%s)" % (worker.url, nkeys))
+					self._set_destination(stage, key, worker, nkeys)
 
 				return [ (key, worker.url) for key, worker in self.destinations[stage].iteritems() ]
 
@@ -2510,6 +3244,9 @@ class Peer:
 		self.directory       = os.getenv("PYMR", 'peers')
 		self.directory_entry = self.directory + '/' + self.hostname + ':' + str(port) + '.peer'
 
+		# Directories holding data on this node's local disks
+		self.local_data = [ os.path.realpath(path) for path in os.getenv("PYMR_LOCAL_DATA", '').split(':') if path ]
+
 		# Initialize coordinated tasks array
 		self.coordinators = {}
 		self.coordinator_ctr = 0
@@ -2587,7 +3324,7 @@ class Peer:
 			pass
 		logger.debug("Unregistered %s" % (self.directory_entry))
 
-	def _execute(self, spec, data):
+	def _execute(self, spec, data, locality=None):
 		"""
 		Execute a task.
 		"""
@@ -2597,7 +3334,7 @@ class Peer:
 			self.coordinator_ctr += 1
 
 			server, _ = start_threaded_xmlrpc_server(HTMLAndXMLRPCRequestHandler, 1023, self.hostname)
-			coordinator = self.coordinators[task_id] = self._Coordinator(server, self.hostname, self.url, task_id, spec, data)
+			coordinator = self.coordinators[task_id] = self._Coordinator(server, self.hostname, self.url, task_id, spec, data, locality)
 			server.register_instance(coordinator)
 			server.register_introspection_functions()
 			th = Thread(name='Coord-%03d' % (self.coordinator_ctr-1,), target=server.serve_forever, kwargs={'poll_interval': 0.1})
@@ -2654,6 +3391,21 @@ class Peer:
 		# Read the first line of each *.peer file in the Directory
 		return list( file(fn).readline().strip() for fn in glob.iglob(self.directory + '/*.peer') )
 
+	def local_paths(self, paths):
+		"""
+		Return the indices of paths that exist on this Peer's local
+		disks (i.e., within one of the directories listed in
+		PYMR_LOCAL_DATA).
+		"""
+		local = []
+		for i, path in enumerate(paths):
+			path = os.path.realpath(path)
+			for dir in self.local_data:
+				if (path == dir or path.startswith(dir + '/')) and os.path.exists(path):
+					local.append(i)
+					break
+		return local
+
 	def start_worker(self, task_id, spec):
 		"""
 		Start a Worker for the given task.
@@ -2779,12 +3531,15 @@ class PeerRequestHandler(HTMLAndXMLRPCRequestHandler):
 				return
 			req[arg] = req[arg][0]
 
+		# Optional: the paths to data read by each item
+		locality = json.loads(req['locality'][0]) if 'locality' in req else None
+
 		self.send_response(200)
 		self.send_header("Content-type", "binary/octet-stream")
 		self.end_headers()
 
 		# Forward progress reports
-		for msg in self.server.instance._execute(req['spec'], req['data']):
+		for msg in self.server.instance._execute(req['spec'], req['data'], locality):
 			cPickle.dump(msg, self.wfile, -1)
 			self.wfile.flush()
 